@@ -0,0 +1,436 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from collections import deque
+import tempfile
+import zipfile
+import hashlib
+import json
+import time
+import zlib
+import csv
+import sys
+import io
+import os
+
+
+# already compressed formats, deflating them costs a lot of cpu for ~1% savings
+MEDIA_EXTENSIONS = {
+    ".flac", ".mp3", ".opus", ".ogg", ".m4a", ".aac", ".webm", ".mp4", ".mka",
+    ".jpg", ".jpeg", ".png", ".webp",
+    ".zip", ".gz", ".xz", ".bz2", ".7z", ".parquet",
+}
+
+# files larger than this are deflated while being copied (on the calling thread)
+# instead of being read into memory and compressed on the pool
+MAX_POOLED_SIZE = 64 * 1024 * 1024
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# members deflated on the pool are written by `ArchiveWriter._write_deflated`,
+# which relies on zipfile internals that are the same in every version up to here
+MAX_RAW_WRITE_VERSION = (3, 14)
+RAW_WRITE_ATTRIBUTES = ("_lock", "_seekable", "_writecheck", "_didModify", "start_dir", "filelist", "NameToInfo")
+
+
+def _deflate(path: str, compresslevel: int) -> tuple[bytes, int, int]:
+    """
+    raw deflate stream (what zip stores for ZIP_DEFLATED), crc32, and size of `path`
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    chunks = []
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            chunks.append(compressor.compress(chunk))
+    chunks.append(compressor.flush())
+    return b"".join(chunks), crc, size
+
+
+class ArchiveWriter:
+    """
+    Zip writer for exporting a library of audio files
+
+    ```
+    with ArchiveWriter("./tracks.zip") as archive:
+        archive.write_tree("./tracks", exclude={"music.db"})
+    print(archive)  # files, sizes, and throughput
+
+    with ArchiveWriter("-") as archive:  # stream to stdout
+        archive.write_tree("./tracks")
+    ```
+    `sink`: path of the zip file, "-" for stdout, or a binary file object (e.g. a pipe)
+
+    files in `MEDIA_EXTENSIONS` (and .wav files if `store_wav` is True) are
+    stored without compression. everything else is deflated on a pool of
+    `workers` threads (zlib releases the GIL) while media files are being
+    copied, so exporting is limited by the disk rather than the cpu
+
+    when `sink` is a path, the archive is written to a temporary file and
+    renamed into place once it is complete
+
+    on a Python newer than `MAX_RAW_WRITE_VERSION` (or whose zipfile has
+    changed) files are deflated by `ZipFile.write` on the calling thread instead
+    """
+    def __init__(self, sink, workers: int = None, store_wav: bool = False, compresslevel: int = 6):
+        self.sink = sink
+        self.workers = workers or os.cpu_count() or 1
+        self.store_wav = store_wav
+        self.compresslevel = compresslevel
+        self.stats = {
+            "files": 0,
+            "stored": 0,       # written without compression
+            "deflated": 0,
+            "bytes_in": 0,     # size of the files added
+            "bytes_out": 0,    # size of the archive
+            "seconds": 0.0,
+        }
+        self._tmp_path = None
+        if sink == "-":
+            fileobj = sys.stdout.buffer
+        elif isinstance(sink, (str, os.PathLike)):
+            directory = os.path.dirname(os.path.abspath(sink))
+            os.makedirs(directory, exist_ok=True)
+            fd, self._tmp_path = tempfile.mkstemp(dir=directory, prefix=".archive-", suffix=".zip.tmp")
+            fileobj = os.fdopen(fd, "wb")
+        else:
+            fileobj = sink
+        self._fileobj = fileobj
+        # zipfile falls back to data descriptors when `fileobj` isn't seekable
+        self.zf = zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+        self.raw_writes = (sys.version_info[:2] <= MAX_RAW_WRITE_VERSION
+                           and all(hasattr(self.zf, name) for name in RAW_WRITE_ATTRIBUTES))
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        # deflated members are written in the order they were added
+        self._in_flight = deque()
+        self._start = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(discard=exc_type is not None)
+
+    def is_stored(self, path: str) -> bool:
+        extension = os.path.splitext(path)[1].lower()
+        return extension in MEDIA_EXTENSIONS or (self.store_wav and extension == ".wav")
+
+    def add_file(self, path: str, arcname: str = None):
+        if arcname is None:
+            arcname = os.path.basename(path)
+        size = os.path.getsize(path)
+        self.stats["files"] += 1
+        self.stats["bytes_in"] += size
+        if self.is_stored(path):
+            self.stats["stored"] += 1
+            self.zf.write(path, arcname, compress_type=zipfile.ZIP_STORED)
+        elif size > MAX_POOLED_SIZE or not self.raw_writes:
+            self.stats["deflated"] += 1
+            self.zf.write(path, arcname, compress_type=zipfile.ZIP_DEFLATED)
+        else:
+            self.stats["deflated"] += 1
+            future = self._executor.submit(_deflate, path, self.compresslevel)
+            self._in_flight.append((path, arcname, future))
+        self._drain(block=len(self._in_flight) >= 2 * self.workers)
+
+    def add_bytes(self, arcname: str, data: bytes):
+        """
+        add a small generated member (e.g. a manifest)
+        """
+        self._drain(block=True, everything=True)
+        self.stats["files"] += 1
+        self.stats["deflated"] += 1
+        self.stats["bytes_in"] += len(data)
+        self.zf.writestr(arcname, data, compress_type=zipfile.ZIP_DEFLATED)
+
+    def write_tree(self, source_dir: str, exclude: set[str] = frozenset(), prefix: str = ""):
+        """
+        add every file under `source_dir`, named relative to it, skipping
+        file names in `exclude`
+        """
+        for root, dirs, files in os.walk(source_dir):
+            # hidden directories hold work in progress (e.g. .staging)
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for file in sorted(files):
+                if file in exclude:
+                    continue
+                file_path = os.path.join(root, file)
+                arcname = os.path.join(prefix, os.path.relpath(file_path, source_dir))
+                self.add_file(file_path, arcname)
+
+    def _drain(self, block: bool = False, everything: bool = False):
+        while self._in_flight:
+            path, arcname, future = self._in_flight[0]
+            if not (block or future.done()):
+                return
+            self._in_flight.popleft()
+            data, crc, size = future.result()
+            self._write_deflated(path, arcname, data, crc, size)
+            if not everything:
+                block = len(self._in_flight) >= 2 * self.workers
+
+    def _write_deflated(self, path: str, arcname: str, data: bytes, crc: int, size: int):
+        """
+        write a member that was already compressed, mirrors what
+        `zipfile.ZipFile._open_to_write` does, but the sizes and crc are
+        known up front so the header is written once (only when `self.raw_writes`)
+        """
+        zf = self.zf
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.file_size = size
+        zinfo.compress_size = len(data)
+        zinfo.CRC = crc
+        zip64 = max(size, len(data)) > zipfile.ZIP64_LIMIT
+        with zf._lock:
+            if zf._seekable:
+                zf.fp.seek(zf.start_dir)
+            zinfo.header_offset = zf.fp.tell()
+            zf._writecheck(zinfo)
+            zf._didModify = True
+            zf.fp.write(zinfo.FileHeader(zip64))
+            zf.fp.write(data)
+            zf.start_dir = zf.fp.tell()
+            zf.filelist.append(zinfo)
+            zf.NameToInfo[zinfo.filename] = zinfo
+
+    def close(self, discard: bool = False):
+        """
+        finish the archive, when `discard` is True a partially written
+        archive file is removed instead of being renamed into place
+        """
+        if self.zf.fp is None:
+            return
+        try:
+            if discard:
+                for _, _, future in self._in_flight:
+                    future.cancel()
+                self._in_flight.clear()
+            else:
+                self._drain(block=True, everything=True)
+        finally:
+            self._executor.shutdown(wait=True)
+            # zipfile wraps unseekable sinks in an object that counts bytes written
+            fp = self.zf.fp
+            self.zf.close()
+            self.stats["bytes_out"] = fp.tell()
+            if self._tmp_path is not None:
+                self._fileobj.close()
+                if discard:
+                    os.remove(self._tmp_path)
+                else:
+                    os.replace(self._tmp_path, self.sink)
+            else:
+                self._fileobj.flush()
+            self.stats["seconds"] = time.perf_counter() - self._start
+
+    def __str__(self):
+        seconds = self.stats["seconds"] or 1e-9
+        mb_in = self.stats["bytes_in"] / 1e6
+        mb_out = self.stats["bytes_out"] / 1e6
+        return (f"{self.stats['files']} files ({self.stats['stored']} stored, {self.stats['deflated']} deflated), "
+                f"{mb_in:.1f} MB -> {mb_out:.1f} MB in {seconds:.1f}s ({mb_in / seconds:.1f} MB/s)")
+
+
+def write_archive(sink, source_dir: str, exclude: set[str] = frozenset(), **kwargs) -> ArchiveWriter:
+    """
+    zip every file in `source_dir` to `sink` (see `ArchiveWriter`)
+    """
+    with ArchiveWriter(sink, **kwargs) as archive:
+        archive.write_tree(source_dir, exclude=exclude)
+    return archive
+
+
+############################################################
+# incremental exports
+############################################################
+
+# written inside every archive made by `export_library`
+MANIFEST_NAME = "manifest.json"
+# kept in the exported directory, describes the last export
+EXPORT_MANIFEST = ".export_manifest.json"
+# kept in the directory an archive was extracted to, see `dataloader.extract_zip`
+IMPORT_MANIFEST = ".import_manifest.json"
+
+MANIFEST_FORMAT = 1
+
+
+def file_sha1(path: str) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def load_manifest(path: str) -> dict:
+    """
+    returns the manifest stored at `path`, or an empty one (sequence 0)
+    """
+    if not os.path.exists(path):
+        return {"format": MANIFEST_FORMAT, "sequence": 0, "files": {}, "tracks": []}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(path: str, manifest: dict):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".manifest-", suffix=".json.tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def scan_tree(source_dir: str, exclude: set[str] = frozenset(), previous: dict[str, dict] = None, workers: int = None) -> dict[str, dict]:
+    """
+    arcname -> {"size", "mtime_ns", "sha1"} for every file under `source_dir`
+
+    hashes in `previous` are reused for files whose size and mtime haven't
+    changed, so only new or modified files are read
+    """
+    previous = previous or {}
+    files = {}
+    to_hash = []
+    for root, dirs, filenames in os.walk(source_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for file in sorted(filenames):
+            if file in exclude:
+                continue
+            file_path = os.path.join(root, file)
+            arcname = os.path.relpath(file_path, source_dir).replace(os.sep, "/")
+            stat = os.stat(file_path)
+            entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": None}
+            old = previous.get(arcname)
+            if old is not None and old["size"] == entry["size"] and old["mtime_ns"] == entry["mtime_ns"]:
+                entry["sha1"] = old["sha1"]
+            else:
+                to_hash.append((arcname, file_path))
+            files[arcname] = entry
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        for (arcname, _), sha1 in zip(to_hash, executor.map(file_sha1, (path for _, path in to_hash))):
+            files[arcname]["sha1"] = sha1
+    return files
+
+
+def _csv_rows(path: str) -> tuple[list[str], list[dict]]:
+    if not os.path.exists(path):
+        return [], []
+    with open(path, "r", newline="") as f:
+        reader = csv.DictReader(f)
+        return list(reader.fieldnames or []), list(reader)
+
+
+def _csv_bytes(fieldnames: list[str], rows: list[dict]) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames, lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue().encode("utf-8")
+
+
+def export_library(sink, source_dir: str, exclude: set[str] = frozenset(), since_last_export: bool = False,
+                   key: str = "youtube_url", **kwargs) -> ArchiveWriter:
+    """
+    zip `source_dir` (audio files and tracks.csv) to `sink`, see `ArchiveWriter`
+    ```
+    export_library("./full.zip", "./tracks")                            # everything
+    export_library("./delta.zip", "./tracks", since_last_export=True)   # only what changed
+    ```
+    every export is numbered and records what it contained in
+    `source_dir`/.export_manifest.json (path, size, mtime, and sha1 of each file).
+    with `since_last_export`, the archive only contains new or modified files,
+    and tracks.csv only contains the rows that were not exported before
+
+    the archive's manifest.json lets `dataloader.extract_zip` apply deltas in order
+    """
+    manifest_path = os.path.join(source_dir, EXPORT_MANIFEST)
+    previous = load_manifest(manifest_path)
+    exclude = set(exclude) | {EXPORT_MANIFEST, IMPORT_MANIFEST}
+    files = scan_tree(source_dir, exclude, previous["files"], workers=kwargs.get("workers"))
+    fieldnames, rows = _csv_rows(os.path.join(source_dir, "tracks.csv"))
+    keys = [row[key] for row in rows if row.get(key)]
+
+    base_sequence = None
+    if since_last_export:
+        if previous["sequence"] == 0:
+            print("no previous export found, exporting everything")
+        else:
+            base_sequence = previous["sequence"]
+
+    if base_sequence is None:
+        included = [arcname for arcname in files if arcname != "tracks.csv"]
+        new_rows = rows
+    else:
+        included = [
+            arcname for arcname, entry in files.items()
+            if arcname != "tracks.csv" and previous["files"].get(arcname, {}).get("sha1") != entry["sha1"]
+        ]
+        exported_keys = set(previous["tracks"])
+        changed = {os.path.normpath(arcname) for arcname in included}
+        new_rows = [
+            row for row in rows
+            if row.get(key) not in exported_keys or os.path.normpath(row.get("audio_path") or "") in changed
+        ]
+
+    sequence = previous["sequence"] + 1
+    with ArchiveWriter(sink, **kwargs) as archive:
+        for arcname in included:
+            archive.add_file(os.path.join(source_dir, arcname), arcname)
+        if base_sequence is None and "tracks.csv" in files:
+            archive.add_file(os.path.join(source_dir, "tracks.csv"), "tracks.csv")
+        elif fieldnames:
+            archive.add_bytes("tracks.csv", _csv_bytes(fieldnames, new_rows))
+        archive.add_bytes(MANIFEST_NAME, json.dumps({
+            "format": MANIFEST_FORMAT,
+            "sequence": sequence,
+            "base_sequence": base_sequence,
+            "created": datetime.now(timezone.utc).isoformat(),
+            "rows": len(new_rows),
+            "files": {arcname: files[arcname] for arcname in included},
+        }, indent=1).encode("utf-8"))
+
+    save_manifest(manifest_path, {
+        "format": MANIFEST_FORMAT,
+        "sequence": sequence,
+        "files": files,
+        "tracks": keys,
+    })
+    return archive
+
+
+def check_sequence(manifest: dict, audio_directory: str) -> int:
+    """
+    make sure the archive described by `manifest` can be applied to `audio_directory`,
+    returns the sequence number of the last archive applied to it (0 if none)
+
+    full exports can always be applied, deltas need the export they are based on
+    """
+    applied = load_manifest(os.path.join(audio_directory, IMPORT_MANIFEST))["sequence"]
+    base_sequence = manifest.get("base_sequence")
+    if base_sequence is not None and base_sequence != applied:
+        raise ValueError(
+            f"archive {manifest['sequence']} is a delta of export {base_sequence}, "
+            f"but the last export applied to {audio_directory} is {applied or 'none'} "
+            "(deltas need to be applied in order)"
+        )
+    return applied
+
+
+def record_import(manifest: dict, audio_directory: str):
+    save_manifest(os.path.join(audio_directory, IMPORT_MANIFEST), {
+        "format": MANIFEST_FORMAT,
+        "sequence": manifest["sequence"],
+        "applied": datetime.now(timezone.utc).isoformat(),
+    })
@@ -0,0 +1,237 @@
+from sqlite3 import connect
+import unicodedata
+import threading
+import math
+import json
+import time
+import zlib
+import os
+
+from platformdirs import user_cache_dir
+
+from .config import config
+
+
+def default_cache_path(filename: str) -> str:
+    """
+    returns `filename` inside of musicdl's user cache directory
+    """
+    cache_dir = user_cache_dir("musicdl")
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, filename)
+
+
+class CacheMissError(LookupError):
+    """Exception raised when running offline and a response is not cached."""
+    def __init__(self, key: str):
+        self.key = key
+        super().__init__(f"{key} is not cached (running in offline mode)")
+
+
+class SQLiteCache:
+    """
+    Small key -> value store kept in a sqlite file, with a time to live
+    and least-recently-used eviction once `max_entries` is exceeded
+    (access times are only as precise as `touch_after`, so hits don't
+    each cost a write)
+
+    safe to share between threads
+    ```
+    cache = SQLiteCache("./cache.db", table="things", ttl=3600, max_entries=1000)
+    cache.set("key", "value")
+    cache.get("key")  # "value", or None if missing / expired
+    print(cache.stats)
+    ```
+    """
+    # how many set() calls happen between checks of `max_entries`
+    evict_every = 64
+    # hits only update an entry's access time after this many seconds,
+    # and those updates are written together (see `_touch`)
+    touch_after = 60.0
+    touch_every = 64
+
+    def __init__(self, path: str, table: str, ttl: float = None, max_entries: int = None):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0}
+        self._sets = 0
+        # key -> access time not written to the table yet
+        self._accessed: dict[str, float] = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = connect(path, check_same_thread=False)
+        self.conn.executescript(f"""
+        PRAGMA journal_mode=WAL;
+        CREATE TABLE IF NOT EXISTS {table} (
+            key TEXT PRIMARY KEY,
+            value BLOB,
+            created REAL,
+            accessed REAL
+        );
+        CREATE INDEX IF NOT EXISTS {table}_accessed ON {table}(accessed);
+        """)
+
+    def get(self, key: str, ttl: float = None):
+        """
+        returns the value stored under `key`, or None if it is missing or
+        older than `ttl` seconds (defaults to the cache's ttl)
+        """
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(f"SELECT value, created, accessed FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            value, created, accessed = row
+            if ttl is not None and now - created > ttl:
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            if now - accessed > self.touch_after:
+                self._accessed[key] = now
+                if len(self._accessed) >= self.touch_every:
+                    self._touch()
+                    self.conn.commit()
+            self.stats["hits"] += 1
+            return value
+
+    def set(self, key: str, value):
+        now = time.time()
+        with self._lock:
+            self.conn.execute(f"""
+            INSERT INTO {self.table} (key, value, created, accessed)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+            value = excluded.value,
+            created = excluded.created,
+            accessed = excluded.accessed;
+            """, (key, value, now, now))
+            self._accessed.pop(key, None)
+            self._sets += 1
+            if self._sets % self.evict_every == 0:
+                self._evict()
+            self.conn.commit()
+
+    def _touch(self):
+        """
+        write the access times recorded by `get`, in the transaction of the caller
+        """
+        if self._accessed:
+            self.conn.executemany(f"UPDATE {self.table} SET accessed = ? WHERE key = ?",
+                                  [(accessed, key) for key, accessed in self._accessed.items()])
+            self._accessed.clear()
+
+    def _evict(self):
+        if self.max_entries is None:
+            return
+        self._touch()
+        cursor = self.conn.execute(f"""
+        DELETE FROM {self.table} WHERE key IN (
+            SELECT key FROM {self.table} ORDER BY accessed DESC LIMIT -1 OFFSET ?
+        )
+        """, (self.max_entries,))
+        self.stats["evicted"] += cursor.rowcount
+
+    def delete(self, key: str):
+        with self._lock:
+            self._accessed.pop(key, None)
+            self.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self.conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._accessed.clear()
+            self.conn.execute(f"DELETE FROM {self.table}")
+            self.conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._touch()
+            self._evict()
+            self.conn.commit()
+            self.conn.close()
+
+    def __str__(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        hit_rate = self.stats["hits"] / lookups if lookups else 0
+        return (f"{self.stats['hits']} hits, {self.stats['misses']} misses ({hit_rate:.0%} hit rate), "
+                f"{self.stats['expired']} expired, {self.stats['evicted']} evicted")
+
+
+class SearchCache(SQLiteCache):
+    """
+    YouTube search query -> video id, used by `SPTrackDownloader._search`
+
+    stored in `user_cache_dir("musicdl")/search_cache.db` by default
+    """
+    def __init__(self, path: str = None, ttl: float = None, max_entries: int = None):
+        if path is None:
+            path = default_cache_path("search_cache.db")
+        if ttl is None:
+            ttl = config["search_cache_ttl"]
+        if max_entries is None:
+            max_entries = config["search_cache_size"]
+        super().__init__(path, table="searches", ttl=ttl, max_entries=max_entries)
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """
+        case, unicode form, and whitespace don't change YouTube's results
+        """
+        return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+    def get_video_id(self, query: str) -> str|None:
+        return self.get(self.normalize(query))
+
+    def set_video_id(self, query: str, video_id: str):
+        self.set(self.normalize(query), video_id)
+
+
+class ResponseCache(SQLiteCache):
+    """
+    Spotify Web API responses, used by `SpotifyInterface`
+
+    entries are keyed by endpoint and id (e.g. `album:0ESBFn4IKNcvgD53QJPlpD`),
+    stored as zlib compressed json, and expire based on the endpoint
+    (see `config["spotify_cache_ttl"]`, endpoints without a ttl use its "default")
+
+    at most `max_entries` responses are kept (default: `config["spotify_cache_size"]`)
+
+    stored in `user_cache_dir("musicdl")/spotify_cache.db` by default
+    """
+    def __init__(self, path: str = None, ttls: dict[str, float] = None, max_entries: int = None):
+        if path is None:
+            path = default_cache_path("spotify_cache.db")
+        self.ttls = dict(config["spotify_cache_ttl"])
+        if ttls is not None:
+            self.ttls.update(ttls)
+        if max_entries is None:
+            max_entries = config["spotify_cache_size"]
+        super().__init__(path, table="responses", ttl=None, max_entries=max_entries)
+
+    @staticmethod
+    def make_key(endpoint: str, *args, **kwargs) -> str:
+        key = ":".join([endpoint, *(str(arg) for arg in args)])
+        if kwargs:
+            key += "?" + "&".join(f"{k}={v}" for k, v in sorted(kwargs.items()))
+        return key
+
+    def get_response(self, endpoint: str, key: str, offline: bool = False) -> dict|None:
+        """
+        when `offline` is True, expired entries are still returned
+        """
+        ttl = math.inf if offline else self.ttls.get(endpoint, self.ttls["default"])
+        value = self.get(key, ttl=ttl)
+        if value is None:
+            return None
+        return json.loads(zlib.decompress(value))
+
+    def set_response(self, key: str, response: dict):
+        self.set(key, zlib.compress(json.dumps(response, separators=(",", ":")).encode("utf-8")))
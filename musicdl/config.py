@@ -31,7 +31,44 @@ def load_config(dotenv_path: str = None):
         "datadir": env.get("DATADIR") or "./tracks",
 
         # specify where zip file should be stored (default: tracks_{TODAYSDATE}.zip)
-        "zip": env.get("ZIPFILE") or None
+        "zip": env.get("ZIPFILE") or None,
+
+        # requests per second (and burst size) allowed to YouTube, see musicdl.ratelimit
+        "yt_rate": float(env.get("YT_RATE") or os.getenv("YT_RATE") or 1.0),
+        "yt_burst": int(env.get("YT_BURST") or os.getenv("YT_BURST") or 4),
+
+        # how long (days) and how many YouTube search results are cached, see musicdl.cache
+        "search_cache_ttl": float(env.get("SEARCH_CACHE_TTL_DAYS") or os.getenv("SEARCH_CACHE_TTL_DAYS") or 30) * 24 * 60 * 60,
+        "search_cache_size": int(env.get("SEARCH_CACHE_SIZE") or os.getenv("SEARCH_CACHE_SIZE") or 100_000),
+
+        # what to do when a track resolves to a YouTube video that was already downloaded
+        # for another track: "share" the audio file, "hardlink" or "copy" it, or "none" (download again)
+        "reuse_audio": (env.get("REUSE_AUDIO") or os.getenv("REUSE_AUDIO") or "share").lower(),
+
+        # requests made outside of yt-dlp and spotipy (YouTube search, oEmbed), see musicdl.httpclient:
+        # connect / read timeouts in seconds, retries after 5xx responses, and connections kept per host
+        "http_connect_timeout": float(env.get("HTTP_CONNECT_TIMEOUT") or os.getenv("HTTP_CONNECT_TIMEOUT") or 5),
+        "http_read_timeout": float(env.get("HTTP_READ_TIMEOUT") or os.getenv("HTTP_READ_TIMEOUT") or 30),
+        "http_retries": int(env.get("HTTP_RETRIES") or os.getenv("HTTP_RETRIES") or 3),
+        "http_pool_size": int(env.get("HTTP_POOL_SIZE") or os.getenv("HTTP_POOL_SIZE") or 16),
+
+        # with the yt-dlp cli (use_ytdlp_cli=True), how many tracks are downloaded by a single
+        # yt-dlp process, starting the binary takes a few seconds (1 = a process per track)
+        "ytdlp_batch_size": int(env.get("YTDLP_BATCH_SIZE") or os.getenv("YTDLP_BATCH_SIZE") or 50),
+
+        # seconds until a cached Spotify response is fetched again, by endpoint
+        # ("default" is used for endpoints that aren't listed)
+        "spotify_cache_ttl": {
+            "track": 30 * 24 * 60 * 60,
+            "album": 30 * 24 * 60 * 60,
+            "album_tracks": 30 * 24 * 60 * 60,
+            "artist": 7 * 24 * 60 * 60,
+            "artist_albums": 24 * 60 * 60,
+            "playlist_tracks": 60 * 60,
+            "default": 24 * 60 * 60,
+        },
+        # how many Spotify responses are cached (least recently used ones are removed first)
+        "spotify_cache_size": int(env.get("SPOTIFY_CACHE_SIZE") or os.getenv("SPOTIFY_CACHE_SIZE") or 50_000),
     }
     client_id, client_secret = config.get("client_id"), config.get("client_secret")
 
@@ -43,18 +80,22 @@ def load_config(dotenv_path: str = None):
     if config["zip"] is None:
         config["zip"] = lambda: f'tracks-{datetime.today().strftime("%Y-%m-%d")}.zip'
     else:
-        config["zip"] = lambda: config["zip"]
+        zip_file = config["zip"]
+        config["zip"] = lambda: zip_file
 
     #config["hash_mp3_storage"] = config["hash_mp3_storage"] == "True"
-    #config["num_bins"] = int(config["num_bins"])
     #config["single_file"] = config["single_file"] == "True"
 
     ###################################################################
     # NOTE: utilize the following config options if you find yourself 
     #       wanting to download a massive number of mp3 files
 
-    config["hash_audio_storage"] = False
-    config["num_bins"] = 10   # [1,100]
+    # store audio in audio/ab/cd/ (sha1 of the video id) instead of a single
+    # directory, HASH_WIDTH hex digits per directory level, HASH_DEPTH levels
+    # (see musicdl.storage, move existing files with `musicdl --migrate-storage`)
+    config["hash_audio_storage"] = (env.get("HASH_AUDIO_STORAGE") or os.getenv("HASH_AUDIO_STORAGE") or "False").lower() in ("true", "1", "yes")
+    config["hash_width"] = int(env.get("HASH_WIDTH") or os.getenv("HASH_WIDTH") or 2)
+    config["hash_depth"] = int(env.get("HASH_DEPTH") or os.getenv("HASH_DEPTH") or 2)
 
     ###################################################################
 
@@ -1,9 +1,18 @@
+from array import array
+import threading
+import tempfile
+import sys
+import csv
+import io
 import os
+import copy
 
 import abc
 
 import pandas as pd
 
+from .storage import video_id_from_path, relocate
+
 # this is what is contained in track_info dictionaries
 # tracks_info: list of track_info dictionaries
 #class TrackInfo:
@@ -21,30 +30,243 @@ def format_for_zip(filepath: str):
     if "audio" in parts:
         #audio_index = parts.index("audio")
         audio_index = max(i for i, v in enumerate(parts) if v=="audio")
-        # Reconstruct the path as ./audio/SONG.wav
+        # Reconstruct the path as ./audio/SONG.wav (or ./audio/ab/cd/SONG.wav, see musicdl.storage)
         return os.path.join(".", *parts[audio_index:],)
     else:
         # likely doesn't ever run
+        video_id = video_id_from_path(filepath)
+        if video_id is not None:
+            return relocate(os.path.join("./audio", os.path.basename(filepath)), video_id)
         return os.path.join("./audio", os.path.basename(filepath))
 
 def update_csv(orig_tracks_csv: str, new_tracks_info: list[dict]):
-    if os.path.exists(orig_tracks_csv):
-        orig_df = pd.read_csv(orig_tracks_csv)
-        if isinstance(new_tracks_info, dict):
-            new_tracks_info = [new_tracks_info]
-        new_df = pd.DataFrame(new_tracks_info)
-        combined_df = pd.concat([orig_df, new_df], ignore_index=True)
-        combined_df = combined_df.drop_duplicates(subset=["youtube_url"])
-        os.remove(orig_tracks_csv)
-        combined_df.to_csv(orig_tracks_csv, index=False)
-    else:
-        pd.DataFrame(new_tracks_info).to_csv(orig_tracks_csv, index=False)
+    """
+    add the tracks in `new_tracks_info` to `orig_tracks_csv`, skipping
+    tracks whose youtube_url is already in it (see `TracksCSV`)
+    """
+    if isinstance(new_tracks_info, dict):
+        new_tracks_info = [new_tracks_info]
+    return tracks_csv_journal(orig_tracks_csv).append(new_tracks_info)
+
+
+class TracksCSV:
+    """
+    Append-only journal for tracks.csv
+
+    keeps an in-memory index of the youtube_urls in the file, so adding
+    tracks only writes the new rows instead of re-reading and rewriting
+    the whole file. the index is rebuilt if the file is changed by
+    something else (e.g. `MusicDB.to_csv`)
+    ```
+    journal = TracksCSV("./tracks/tracks.csv")
+    journal.append(tracks_info)   # returns the number of rows written
+    journal.compact()             # rewrite without duplicates, on demand
+    ```
+    new files and compactions are written to a temporary file that is
+    renamed over tracks.csv, so an interrupted write never loses the file.
+    appends are a single write of complete rows, and an append that fails
+    part of the way through is truncated back to where it started. reading
+    never modifies the file
+    """
+    def __init__(self, path: str, key: str = "youtube_url"):
+        self.path = path
+        self.key = key
+        self.columns: list[str] = []
+        self._keys: set[str] = set()
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _refresh(self):
+        """
+        (re)build the index if tracks.csv changed since we last touched it
+        """
+        signature = self._stat()
+        if signature == self._signature:
+            return
+        self.columns = []
+        self._keys = set()
+        if signature is not None:
+            with open(self.path, "r", newline="", encoding="utf-8") as f:
+                reader = csv.DictReader(f)
+                self.columns = list(reader.fieldnames or [])
+                for row in reader:
+                    self._keys.add(row.get(self.key))
+        self._signature = self._stat()
+
+    def _append_text(self, text: str):
+        """
+        append `text` to tracks.csv, undoing the write if it fails part of the way
+        """
+        data = text.encode("utf-8")
+        fd = os.open(self.path, os.O_RDWR | os.O_APPEND | getattr(os, "O_BINARY", 0))
+        try:
+            size = os.fstat(fd).st_size
+            os.lseek(fd, max(0, size - 1), os.SEEK_SET)
+            if size > 0 and os.read(fd, 1) != b"\n":
+                # written by something else without a final newline, keep its last row intact
+                data = b"\n" + data
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+            except BaseException:
+                os.ftruncate(fd, size)
+                raise
+        finally:
+            os.close(fd)
+
+    def _format(self, rows: list[dict], columns: list[str], header: bool) -> str:
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=columns, restval="", extrasaction="ignore", lineterminator="\n")
+        if header:
+            writer.writeheader()
+        writer.writerows(rows)
+        return buffer.getvalue()
+
+    def _write_atomic(self, text: str):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tracks-", suffix=".csv.tmp")
+        try:
+            with os.fdopen(fd, "w", newline="", encoding="utf-8") as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def append(self, tracks_info: list[dict]) -> int:
+        """
+        write the tracks in `tracks_info` that aren't already in tracks.csv,
+        returns the number of rows written
+        """
+        with self._lock:
+            self._refresh()
+            rows = []
+            for track_info in tracks_info:
+                key = track_info.get(self.key)
+                # failed downloads are recorded with an empty youtube_url
+                if not key or key in self._keys:
+                    continue
+                self._keys.add(key)
+                rows.append(track_info)
+            if not rows:
+                return 0
+            new_columns = [c for row in rows for c in row if c not in self.columns]
+            try:
+                if self._signature is None or new_columns:
+                    # new file or new columns: the header has to be (re)written
+                    self.columns.extend(dict.fromkeys(new_columns))
+                    self._rewrite(extra_rows=rows)
+                else:
+                    self._append_text(self._format(rows, self.columns, header=False))
+            except BaseException:
+                # the rows didn't make it, rebuild the index from the file next time
+                self._signature = None
+                self._keys = set()
+                raise
+            self._signature = self._stat()
+            return len(rows)
+
+    def _rewrite(self, extra_rows: list[dict] = ()):
+        """
+        rewrite tracks.csv with `self.columns`, keeping the first row for each key
+        """
+        rows = []
+        seen = set()
+        if self._signature is not None:
+            with open(self.path, "r", newline="", encoding="utf-8") as f:
+                for row in csv.DictReader(f):
+                    key = row.get(self.key)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    rows.append(row)
+        rows.extend(extra_rows)
+        self._write_atomic(self._format(rows, self.columns, header=True))
+
+    def update_rows(self, update) -> int:
+        """
+        rewrite tracks.csv with `update(row)` applied to every row,
+        returns the number of rows that changed
+        """
+        with self._lock:
+            self._refresh()
+            if self._signature is None:
+                return 0
+            rows = []
+            changed = 0
+            with open(self.path, "r", newline="", encoding="utf-8") as f:
+                for row in csv.DictReader(f):
+                    new_row = update(dict(row))
+                    changed += new_row != row
+                    rows.append(new_row)
+            if changed:
+                self._write_atomic(self._format(rows, self.columns, header=True))
+                self._signature = None
+                self._refresh()
+            return changed
+
+    def compact(self):
+        """
+        remove duplicate rows (e.g. from files merged by hand)
+        """
+        with self._lock:
+            self._refresh()
+            if self._signature is None:
+                return
+            self._rewrite()
+            self._signature = self._stat()
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._keys)
+
+    def __contains__(self, key: str):
+        with self._lock:
+            self._refresh()
+            return key in self._keys
+
+
+_journals: dict[str, TracksCSV] = {}
+_journals_lock = threading.Lock()
+
+def tracks_csv_journal(tracks_csv: str) -> TracksCSV:
+    """
+    returns the shared `TracksCSV` for `tracks_csv`, so the index is only built once per process
+    """
+    path = os.path.abspath(tracks_csv)
+    with _journals_lock:
+        if path not in _journals:
+            _journals[path] = TracksCSV(path)
+        return _journals[path]
+
+
+def _intern(value):
+    """
+    artist/album fields repeat across many tracks, share a single string for each
+    """
+    return sys.intern(value) if isinstance(value, str) else value
 
 
 class TrackContainer(abc.ABC):
     """
     Abstract Base Class representing a Track, Album, Playlist, or Artist
     """
+    # subclasses declare __slots__ so that instances don't carry a __dict__
+    __slots__ = ()
+
     @abc.abstractmethod
     def __init__(self):
         pass
@@ -68,17 +290,23 @@ class TrackContainer(abc.ABC):
 
 
 class Track(TrackContainer):
-    def __init__(self, track_id: str, name: str, artist_id: str, artist_name: str, album_id: str, album_name: str, image_url: str, release_date: str, video_id: str = None, audio_path: str = None):
+    __slots__ = ("id", "name", "artist_id", "artist_name", "album_id", "album_name", "image_url", "release_date", "video_id", "audio_path", "container", "codec")
+
+    def __init__(self, track_id: str, name: str, artist_id: str, artist_name: str, album_id: str, album_name: str, image_url: str, release_date: str, video_id: str = None, audio_path: str = None,
+                 container: str = None, codec: str = None):
         self.id = track_id
         self.name = name
-        self.artist_id = artist_id
-        self.artist_name = artist_name
-        self.album_id = album_id
-        self.album_name = album_name
-        self.image_url = image_url
-        self.release_date = release_date
+        self.artist_id = _intern(artist_id)
+        self.artist_name = _intern(artist_name)
+        self.album_id = _intern(album_id)
+        self.album_name = _intern(album_name)
+        self.image_url = _intern(image_url)
+        self.release_date = _intern(release_date)
         self.video_id = video_id
         self.audio_path = audio_path
+        # e.g. "flac"/"flac", "m4a"/"aac", "webm"/"opus" (see musicdl.transcode.describe_audio)
+        self.container = _intern(container)
+        self.codec = _intern(codec)
 
     @staticmethod
     def from_spotify(track_id, sp_track, album=None):
@@ -109,16 +337,33 @@ class Track(TrackContainer):
             audio_path=None
         )
 
+    def with_audio(self, video_id: str, audio_path: str, container: str = None, codec: str = None) -> "Track":
+        """
+        copy of this track with `video_id` and `audio_path` (and `container` / `codec`)
+        replaced, other fields are shared
+        """
+        track = copy.copy(self)
+        track.video_id = video_id
+        track.audio_path = audio_path
+        track.container = _intern(container)
+        track.codec = _intern(codec)
+        return track
+
     def to_list(self):
         return [{
             "youtube_url": f"https://www.youtube.com/watch?v={self.video_id}",
             "title": self.name,
             "artist": self.artist_name,
             "artwork_url": self.image_url,
-            "audio_path": format_for_zip(self.audio_path)
+            "audio_path": format_for_zip(self.audio_path),
+            "container": self.container,
+            "codec": self.codec,
             #"duration_s": None
         }]
 
+    def to_table(self) -> "TrackTable":
+        return TrackTable.from_tracks([self])
+
     def __getitem__(self, key):
         return getattr(self, key)
 
@@ -131,9 +376,13 @@ class Track(TrackContainer):
         s += f"\n\trelease_date = {self.release_date}"
         s += f"\n\tvideo_id = {self.video_id}"
         s += f"\n\taudio_path = {self.audio_path}"
+        if self.codec is not None:
+            s += f"\n\tcodec = {self.codec} ({self.container})"
         return s
 
 class Album(TrackContainer):
+    __slots__ = ("name", "id", "artist_id", "artist_name", "release_date", "image_url", "tracks")
+
     def __init__(self, album_name: str = None, album_id: str = None, artist_name: str = None, artist_id: str = None, release_date: str = None, image_url: str = None, tracks: dict[str, Track] = None):
         self.name = album_name
         self.id = album_id
@@ -156,17 +405,39 @@ class Album(TrackContainer):
             image_url = sp_album_details["images"][0]["url"],
             tracks = {}
         )
-        for track in sp_album_details['tracks']['items']:
-            track_id = track['id']
-            album.tracks[track_id] = Track.from_spotify(track_id, track, album)
+        album.extend_from_spotify(sp_album_details['tracks']['items'])
+        return album
+
+    def shallow_copy(self) -> "Album":
+        """
+        copy with its own `tracks` dict, the Track objects themselves are shared
+        """
+        album = copy.copy(self)
+        album.tracks = dict(self.tracks)
         return album
 
+    def extend_from_spotify(self, sp_album_tracks: list[dict]) -> list[Track]:
+        """
+        add a page of album tracks (`sp_album["tracks"]["items"]`), returns the tracks that were added
+        """
+        added = []
+        for track in sp_album_tracks:
+            track_id = track['id']
+            if track_id in self.tracks:
+                continue
+            self.tracks[track_id] = Track.from_spotify(track_id, track, self)
+            added.append(self.tracks[track_id])
+        return added
+
     def to_list(self):
         output_list = []
         for track in self.tracks.values():
             output_list.extend(track.to_list())
         return output_list
 
+    def to_table(self) -> "TrackTable":
+        return TrackTable.from_tracks(self.tracks.values())
+
     def __getitem__(self, key):
         return getattr(self, key)
 
@@ -177,6 +448,8 @@ class Album(TrackContainer):
         return s
 
 class Playlist(TrackContainer):
+    __slots__ = ("id", "tracks")
+
     def __init__(self, playlist_id: str, tracks: dict[str, Track]):
         self.id = playlist_id
         self.tracks: dict[str, Track] = tracks
@@ -187,14 +460,36 @@ class Playlist(TrackContainer):
             playlist_id = playlist_id,
             tracks = {}
         )
-        for track in sp_playlist_tracks['items']:
+        playlist.extend_from_spotify(sp_playlist_tracks['items'])
+        return playlist
+
+    def shallow_copy(self) -> "Playlist":
+        """
+        copy with its own `tracks` dict, the Track objects themselves are shared
+        """
+        playlist = copy.copy(self)
+        playlist.tracks = dict(self.tracks)
+        return playlist
+
+    def extend_from_spotify(self, sp_playlist_items: list[dict]) -> list[Track]:
+        """
+        add a page of playlist items (`sp_playlist_tracks["items"]`), returns the tracks that were added
+        """
+        added = []
+        for track in sp_playlist_items:
             try: 
                 track_id = track['track']['id']
             except TypeError:
                 print("\t\tTrack has been removed from Spotify, skipping...")
                 continue
-            playlist.tracks[track_id] = Track.from_spotify(track_id, track)
-        return playlist
+            if track_id is None:
+                print("\t\tLocal files can't be downloaded, skipping...")
+                continue
+            if track_id in self.tracks:
+                continue
+            self.tracks[track_id] = Track.from_spotify(track_id, track)
+            added.append(self.tracks[track_id])
+        return added
 
     def to_list(self):
         output_list = []
@@ -202,6 +497,9 @@ class Playlist(TrackContainer):
             output_list.extend(track.to_list())
         return output_list
 
+    def to_table(self) -> "TrackTable":
+        return TrackTable.from_tracks(self.tracks.values())
+
     def __getitem__(self, key):
         return getattr(self, key)
 
@@ -212,6 +510,8 @@ class Playlist(TrackContainer):
         return s
 
 class Artist(TrackContainer):
+    __slots__ = ("name", "id", "albums")
+
     def __init__(self, artist_name: str = None, artist_id: str = None):
         self.name = artist_name
         self.id = artist_id
@@ -221,12 +521,23 @@ class Artist(TrackContainer):
     def from_spotify():
         raise NotImplementedError("use `SpotifyInterface.retrieve_artist(artist_id)` to retrieve artist tracks")
 
+    def shallow_copy(self) -> "Artist":
+        """
+        copy with its own `albums` (and their `tracks` dicts), the Track objects themselves are shared
+        """
+        artist = copy.copy(self)
+        artist.albums = {album_id: album.shallow_copy() for album_id, album in self.albums.items()}
+        return artist
+
     def to_list(self):
         output_list = []
         for album in self.albums.values():
             output_list.extend(album.to_list())
         return output_list
 
+    def to_table(self) -> "TrackTable":
+        return TrackTable.from_tracks(track for album in self.albums.values() for track in album.tracks.values())
+
     def __getitem__(self, key):
         return getattr(self, key)
 
@@ -236,4 +547,150 @@ class Artist(TrackContainer):
             s += f"\n\t{i+1}. {album.name} ({album.release_date})"
             for j, track in enumerate(album.tracks.values()):
                 s += f"\n\t\t{j+1}. {track.name}"
-        return s
\ No newline at end of file
+        return s
+
+
+class TrackTable:
+    """
+    Columnar copy of a set of tracks, for exporting / analyzing large numbers
+    of them (catalog-scale planning)
+
+    this is a snapshot: the containers keep their own `Track` objects, and
+    changes made to them after `to_table()` don't show up in the table
+
+    fields that repeat across tracks (artist, album, artwork, release date)
+    are dictionary encoded: each is stored once, and tracks hold a 4 byte
+    code into it. converting to a DataFrame or Arrow table works column by
+    column, without creating a dict per track
+    ```
+    table = artist.to_table()            # or TrackTable.from_tracks(tracks)
+    len(table), table[0]                 # Track objects are created on demand
+    df = table.to_dataframe()            # encoded columns become categoricals
+    table = TrackTable.from_dataframe(df)
+    arrow_table = table.to_arrow()       # requires pyarrow
+    ```
+    """
+    columns = Track.__slots__
+    encoded_columns = ("artist_id", "artist_name", "album_id", "album_name", "image_url", "release_date", "container", "codec")
+
+    def __init__(self):
+        self._plain: dict[str, list] = {c: [] for c in self.columns if c not in self.encoded_columns}
+        # column -> (codes, values, value -> code), code -1 is None
+        self._codes: dict[str, array] = {c: array("i") for c in self.encoded_columns}
+        self._values: dict[str, list] = {c: [] for c in self.encoded_columns}
+        self._index: dict[str, dict] = {c: {} for c in self.encoded_columns}
+
+    def _encode(self, column: str, value) -> int:
+        if value is None or value != value:  # None or NaN
+            return -1
+        index = self._index[column]
+        code = index.get(value)
+        if code is None:
+            code = len(self._values[column])
+            index[value] = code
+            self._values[column].append(_intern(value))
+        return code
+
+    def append(self, track: Track):
+        for c in self._plain:
+            self._plain[c].append(getattr(track, c))
+        for c in self.encoded_columns:
+            self._codes[c].append(self._encode(c, getattr(track, c)))
+
+    def extend(self, tracks):
+        for track in tracks:
+            self.append(track)
+
+    @classmethod
+    def from_tracks(cls, tracks) -> "TrackTable":
+        table = cls()
+        table.extend(tracks)
+        return table
+
+    def __len__(self):
+        return len(self._plain["id"])
+
+    def column(self, name: str) -> list:
+        """
+        decoded values of a single column
+        """
+        if name in self._plain:
+            return self._plain[name]
+        values = self._values[name]
+        return [values[code] if code >= 0 else None for code in self._codes[name]]
+
+    def __getitem__(self, i: int) -> Track:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("TrackTable index out of range")
+        fields = {}
+        for c in self.columns:
+            if c in self._plain:
+                fields[c] = self._plain[c][i]
+            else:
+                code = self._codes[c][i]
+                fields[c] = self._values[c][code] if code >= 0 else None
+        fields["track_id"] = fields.pop("id")
+        return Track(**fields)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_dataframe(self) -> pd.DataFrame:
+        data = {}
+        for c in self.columns:
+            if c in self._plain:
+                data[c] = self._plain[c]
+            else:
+                data[c] = pd.Categorical.from_codes(self._codes[c], categories=self._values[c])
+        return pd.DataFrame(data)
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> "TrackTable":
+        table = cls()
+        for c in cls.columns:
+            if c not in df:
+                # frames saved before the column existed
+                if c in table._plain:
+                    table._plain[c] = [None] * len(df)
+                else:
+                    table._codes[c] = array("i", [-1] * len(df))
+                continue
+            if c in table._plain:
+                table._plain[c] = [None if v != v else v for v in df[c].tolist()]
+            elif isinstance(df[c].dtype, pd.CategoricalDtype):
+                categories = df[c].cat.categories.tolist()
+                remap = array("i", [table._encode(c, v) for v in categories])
+                table._codes[c] = array("i", [remap[code] if code >= 0 else -1 for code in df[c].cat.codes.tolist()])
+            else:
+                table._codes[c] = array("i", [table._encode(c, v) for v in df[c].tolist()])
+        return table
+
+    def to_arrow(self):
+        """
+        returns a `pyarrow.Table`, encoded columns become dictionary arrays
+        """
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("TrackTable.to_arrow() requires pyarrow (pip install pyarrow)")
+        arrays = []
+        fields = []
+        for c in self.columns:
+            if c in self._plain:
+                arrays.append(pa.array(self._plain[c], type=pa.string()))
+                fields.append(pa.field(c, pa.string()))
+            else:
+                codes = pa.array(self._codes[c], type=pa.int32(), mask=[code < 0 for code in self._codes[c]])
+                arrays.append(pa.DictionaryArray.from_arrays(codes, pa.array(self._values[c], type=pa.string())))
+                fields.append(pa.field(c, pa.dictionary(pa.int32(), pa.string())))
+        return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+    @classmethod
+    def from_arrow(cls, arrow_table) -> "TrackTable":
+        """
+        inverse of `to_arrow()`, goes through pandas' arrow conversion
+        """
+        return cls.from_dataframe(arrow_table.to_pandas())
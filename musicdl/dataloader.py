@@ -1,10 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+import itertools
+import threading
+import pathlib
 import os
+import io
+import csv
+import zlib
 import zipfile
-import shutil
-import pathlib
+import json
+import sys
 
 import pandas as pd
 
+from .archive import write_archive, check_sequence, record_import, MANIFEST_NAME, EXPORT_MANIFEST, IMPORT_MANIFEST, COPY_BUFFER_SIZE
+from .containers import tracks_csv_journal
+from .storage import locate_audio
+from .transcode import EXTENSION_CODECS
+
 # zip file structure:
 # tracks.zip:
 # │
@@ -25,61 +38,281 @@ import pandas as pd
 
 # filepaths are relative to where the tracks.csv file is located
 
-def extract_zip(zip_file: str = "./tracks.zip", audio_directory: str = "./tracks"):
+def _matches(path: str, info: zipfile.ZipInfo) -> bool:
+    """
+    True if `path` already has the contents of zip member `info`
+    """
+    try:
+        if os.path.getsize(path) != info.file_size:
+            return False
+    except OSError:
+        return False
+    crc = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+    return crc == info.CRC
+
+def extract_zip(zip_file: str = "./tracks.zip", audio_directory: str = "./tracks", workers: int = None):
     """
     Extract `zip_file` to given `audio_directory`.
 
     If tracks already exist in `audio_directory`, this updates directory
-    by adding tracks from `zip_file` to it
+    by adding tracks from `zip_file` to it: files that are already there
+    (same size and CRC) are skipped, the rest are extracted using `workers`
+    threads, and new rows of tracks.csv are appended to the existing tracks.csv
+
+    zip files made with `musicdl --export --since-last-export` only contain
+    the tracks added since the previous export, these need to be extracted
+    in order (a ValueError is raised otherwise)
     """
     if os.path.exists(audio_directory):
         print(f"audio_directory={audio_directory} already exists")
-    
-    tmp_dir = pathlib.Path(audio_directory)/"tmp"
     os.makedirs(audio_directory, exist_ok=True)
 
     with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-        #zip_ref.extractall(audio_directory)
         files_in_zip = zip_ref.namelist()
-        for file in files_in_zip:
-            if file == "tracks.csv":
-                zip_ref.extract(file, tmp_dir)
-            else:
-                print(file)
-                zip_ref.extract(file, audio_directory)
-
-    orig_csv = pathlib.Path(audio_directory)/"tracks.csv"
-    zip_csv = tmp_dir/"tracks.csv"
-    if not os.path.exists(orig_csv):
-        shutil.move(zip_csv, orig_csv)
-        os.rmdir(tmp_dir)
-        return
-    orig_df = pd.read_csv(orig_csv)
-    zip_df = pd.read_csv(zip_csv)
-    combined_df = pd.concat([orig_df, zip_df], ignore_index=True)
-    combined_df = combined_df.drop_duplicates(subset=["youtube_url"])
-    os.remove(orig_csv)
-    combined_df.to_csv(orig_csv, index=False)
-    os.remove(zip_csv)
-    try:
-        os.rmdir(tmp_dir)
-    except:
-        pass
+        manifest = None
+        if MANIFEST_NAME in files_in_zip:
+            manifest = json.loads(zip_ref.read(MANIFEST_NAME))
+            check_sequence(manifest, audio_directory)
+        members = [
+            info for info in zip_ref.infolist()
+            if not info.is_dir() and info.filename not in (MANIFEST_NAME, "tracks.csv")
+        ]
+
+        # ZipFile.extract creates missing parent directories without exist_ok,
+        # which fails when two threads extract into the same new directory
+        # (skipping "", "." and ".." like ZipFile.extract does)
+        directories = {tuple(part for part in os.path.dirname(info.filename).split("/") if part not in ("", os.curdir, os.pardir))
+                       for info in members}
+        for directory in directories:
+            os.makedirs(os.path.join(audio_directory, *directory), exist_ok=True)
+
+        # zipfile serializes reads on a shared handle, so each thread opens its own
+        local = threading.local()
+        handles = []
+        handles_lock = threading.Lock()
+        def extract(info: zipfile.ZipInfo) -> bool:
+            if _matches(os.path.join(audio_directory, info.filename), info):
+                return False
+            if not hasattr(local, "zip_ref"):
+                local.zip_ref = zipfile.ZipFile(zip_file, 'r')
+                with handles_lock:
+                    handles.append(local.zip_ref)
+            local.zip_ref.extract(info, audio_directory)
+            return True
+        try:
+            with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+                extracted = sum(executor.map(extract, members))
+        finally:
+            for handle in handles:
+                handle.close()
+        print(f"extracted {extracted} files to {audio_directory} ({len(members) - extracted} already existed)")
+
+        if "tracks.csv" in files_in_zip:
+            _merge_csv(zip_ref, os.path.join(audio_directory, "tracks.csv"))
 
-def create_zip(zip_file: str = "./tracks.zip", audio_directory: str = "./tracks"):
+    if manifest is not None:
+        record_import(manifest, audio_directory)
+
+def _merge_csv(zip_ref: zipfile.ZipFile, orig_csv: str, chunksize: int = 10_000):
+    """
+    append the rows of the zip file's tracks.csv that aren't in `orig_csv` yet
+    (by youtube_url), without rewriting `orig_csv`
+    """
+    journal = tracks_csv_journal(orig_csv)
+    with zip_ref.open("tracks.csv") as f:
+        reader = csv.DictReader(io.TextIOWrapper(f, encoding="utf-8", newline=""))
+        while True:
+            rows = list(itertools.islice(reader, chunksize))
+            if not rows:
+                break
+            journal.append(rows)
+
+def create_zip(zip_file: str = "./tracks.zip", audio_directory: str = "./tracks", workers: int = None, store_wav: bool = False):
     """
-    Compress `audio_directory` to a zip file located at `zip_file`.
+    Compress `audio_directory` to a zip file located at `zip_file`
+    (or "-" to stream the zip file to stdout).
+
+    If `zip_file` already exists, it is replaced once the new zip file is complete.
 
-    If `zip_file` already exists, deletes it.
+    audio files are stored as is, see `musicdl.archive.ArchiveWriter`
     """
     try:
-        if os.path.exists(zip_file):
-            os.remove(zip_file)
-        shutil.make_archive(os.path.splitext(zip_file)[0], "zip", audio_directory)
+        archive = write_archive(zip_file, audio_directory, exclude={EXPORT_MANIFEST, IMPORT_MANIFEST},
+                                workers=workers, store_wav=store_wav)
+        print(archive, file=sys.stderr)
         return zip_file
     except FileNotFoundError as e:
         print(e)
 
+def _records(f, offset: int = 0):
+    """
+    yields (offset, raw bytes) for each csv record in binary file `f`,
+    starting at `offset`; quoted fields may contain newlines
+    """
+    f.seek(offset)
+    record = b""
+    start = offset
+    for line in f:
+        if not record:
+            start = offset
+        offset += len(line)
+        record += line
+        # a record is complete once its quotes are balanced
+        if record.count(b'"') % 2 == 0:
+            yield start, record
+            record = b""
+    if record:
+        yield start, record
+
+
+def _parse(record: bytes) -> list[str]:
+    return next(csv.reader([record.decode("utf-8")]))
+
+
+class TrackDataset:
+    """
+    Lazy, filterable view of the tracks in `audio_directory`/tracks.csv
+    ```
+    ds = TrackDataset("./tracks", columns=["title", "audio_path"], artist="Don Toliver", audio_exists=True)
+    for track_info in ds:       # streams the csv, one row at a time
+        ...
+    len(ds), ds[0], ds[-1]      # builds a small index of row offsets on first use
+    ds.shard(4, 0)              # rows 0, 4, 8, ... of tracks.csv (before filtering)
+    ```
+    `columns`: only include these columns (default: every column)
+
+    `artist`: only include tracks by this artist (or any of a list of artists)
+
+    `audio_exists`: only include tracks whose audio file is present on disk
+    (also finds files moved to the hashed layout, see `musicdl.storage`)
+
+    `codec`: only include tracks whose audio has this codec (or any of a list of codecs),
+    e.g. "opus" or ["aac", "opus"] for tracks downloaded with a passthrough format
+    (rows without a codec column use the one implied by the file extension)
+
+    `where`: only include rows for which `where(track_info)` is True
+    (applied to the full row, before `columns` is applied)
+
+    `num_shards`, `shard_index`: deterministic split for parallel workers, based on
+    each row's position in tracks.csv
+
+    like `load()`, `audio_path` is relative to the current directory; unlike
+    `load()`, empty values are None and other values are strings
+    """
+    def __init__(self, audio_directory: str = "./tracks", columns: list[str] = None, artist: str|list[str] = None,
+                 audio_exists: bool = False, codec: str|list[str] = None, where=None, num_shards: int = 1, shard_index: int = 0):
+        if not 0 <= shard_index < num_shards:
+            raise ValueError(f"shard_index should be in the interval [0,{num_shards - 1}] (recieved {shard_index})")
+        self.audio_directory = audio_directory
+        self.tracks_csv = os.path.join(audio_directory, "tracks.csv")
+        self.columns = columns
+        self.artists = {artist} if isinstance(artist, str) else (set(artist) if artist is not None else None)
+        self.audio_exists = audio_exists
+        self.codecs = {codec} if isinstance(codec, str) else (set(codec) if codec is not None else None)
+        self.where = where
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self._offsets: array|None = None
+        self._header: list[str] = None
+
+    def shard(self, num_shards: int, shard_index: int) -> "TrackDataset":
+        return TrackDataset(self.audio_directory, self.columns, self.artists, self.audio_exists,
+                            self.codecs, self.where, num_shards, shard_index)
+
+    def _to_track_info(self, values: list[str]) -> dict|None:
+        """
+        returns the (projected) row, or None if it is filtered out
+        """
+        track_info = {name: (value if value != "" else None) for name, value in zip(self._header, values)}
+        if track_info.get("audio_path") is not None:
+            track_info["audio_path"] = os.path.normpath(os.path.join(self.audio_directory, track_info["audio_path"]))
+        if self.artists is not None and track_info.get("artist") not in self.artists:
+            return None
+        if self.audio_exists:
+            if track_info.get("audio_path") is None:
+                return None
+            # tracks.csv may predate `musicdl --migrate-storage`
+            track_info["audio_path"] = locate_audio(track_info["audio_path"])
+            if not os.path.exists(track_info["audio_path"]):
+                return None
+        if self.codecs is not None:
+            codec = track_info.get("codec")
+            if codec is None and track_info.get("audio_path") is not None:
+                codec = EXTENSION_CODECS.get(os.path.splitext(track_info["audio_path"])[1].lstrip(".").lower())
+            if codec not in self.codecs:
+                return None
+        if self.where is not None and not self.where(track_info):
+            return None
+        if self.columns is not None:
+            track_info = {name: track_info.get(name) for name in self.columns}
+        return track_info
+
+    def _scan(self):
+        """
+        yields (offset, track_info) for every row in this shard that passes the filters
+        """
+        with open(self.tracks_csv, "rb") as f:
+            records = _records(f)
+            try:
+                _, header = next(records)
+            except StopIteration:
+                return
+            self._header = _parse(header)
+            if self.columns is not None:
+                missing = [name for name in self.columns if name not in self._header]
+                if missing:
+                    raise ValueError(f"{self.tracks_csv} has no column(s) {missing}")
+            for i, (offset, record) in enumerate(records):
+                if i % self.num_shards != self.shard_index or record.strip() == b"":
+                    continue
+                track_info = self._to_track_info(_parse(record))
+                if track_info is not None:
+                    yield offset, track_info
+
+    def __iter__(self):
+        if self._offsets is not None:
+            for i in range(len(self._offsets)):
+                yield self[i]
+            return
+        for _, track_info in self._scan():
+            yield track_info
+
+    def _build_index(self):
+        self._offsets = array("q", (offset for offset, _ in self._scan()))
+
+    def __len__(self):
+        if self._offsets is None:
+            self._build_index()
+        return len(self._offsets)
+
+    def __getitem__(self, i: int) -> dict:
+        if self._offsets is None:
+            self._build_index()
+        offset = self._offsets[i]
+        with open(self.tracks_csv, "rb") as f:
+            _, record = next(_records(f, offset))
+        track_info = self._to_track_info(_parse(record))
+        return track_info
+
+
+def iter_tracks(audio_directory: str = "./tracks", **kwargs):
+    """
+    stream track_info dictionaries from `audio_directory`/tracks.csv,
+    see `TrackDataset` for the available filters
+    ```
+    for track_info in iter_tracks("./tracks", artist="Don Toliver", audio_exists=True):
+        ...
+    ```
+    """
+    return iter(TrackDataset(audio_directory, **kwargs))
+
+
 def load(audio_directory: str = "./tracks"):
     """
     Retrieves list of track_info dictionaries from given `audio_directory`.
@@ -87,6 +320,9 @@ def load(audio_directory: str = "./tracks"):
     Converts `audio_path` of each track to a relative path, based on `audio_directory`:
 
     if `load(audio_directory="./tracks")` then `./audio/track.flac -> tracks/audio/track.flac`
+
+    values have the types pandas gives them (e.g. `duration_s` is an int, empty
+    values are NaN); use `iter_tracks()` to avoid holding every track in memory
     """
     tracks_csv = pathlib.Path(audio_directory)/"tracks.csv"
     with open(tracks_csv, "r") as f:
@@ -1,72 +1,272 @@
 from sqlite3 import connect, Connection, Cursor
-from copy import deepcopy as copy
+import threading
+import tempfile
+import json
+import time
+import csv
+import re
 import os
 
 import pandas as pd
 
-from .containers import Track, Playlist, Album, Artist, TrackContainer, format_for_zip
+from .containers import Track, Playlist, Album, Artist, TrackContainer
 from .config import config
 
 
+# schema changes applied on top of `MusicDB.create_tables`, in order;
+# PRAGMA user_version records how many have been applied to a music.db,
+# so existing databases are upgraded when they are opened.
+# only ever append to this list
+MIGRATIONS = [
+    # 1: secondary indexes for lookups by video and for exports
+    """
+    CREATE INDEX IF NOT EXISTS audio_files_video_id ON audio_files(video_id);
+    CREATE INDEX IF NOT EXISTS tracks_album_id ON tracks(album_id);
+    CREATE INDEX IF NOT EXISTS tracks_artist_id ON tracks(artist_id);
+    """,
+    # 2: container / codec of each audio file (passthrough formats keep YouTube's stream)
+    """
+    ALTER TABLE audio_files ADD COLUMN container TEXT;
+    ALTER TABLE audio_files ADD COLUMN codec TEXT;
+    """,
+]
+
+
+def lookup_audio(cursor: Cursor, track_ids: list[str]) -> dict[str, tuple[str, str]]:
+    """
+    returns {track_id: (video_id, audio_path)} for every track in `track_ids`
+    that has audio recorded in music.db, using a single query
+    """
+    track_ids = list(track_ids)
+    if not track_ids:
+        return {}
+    cursor.execute("""
+    SELECT track_id, video_id, audio_path FROM audio_files
+    WHERE track_id IN (SELECT value FROM json_each(?))
+    """, (json.dumps(track_ids),))
+    return {track_id: (video_id, audio_path) for track_id, video_id, audio_path in cursor.fetchall()}
+
+
+def lookup_video(cursor: Cursor, video_id: str) -> list[str]:
+    """
+    audio_paths already recorded for `video_id` (uses the audio_files_video_id index)
+    """
+    cursor.execute("""
+    SELECT DISTINCT audio_path FROM audio_files
+    WHERE video_id = ? AND audio_path IS NOT NULL
+    """, (video_id,))
+    return [audio_path for (audio_path,) in cursor.fetchall()]
+
+
+# youtube urls are built in SQL, audio paths are rewritten per chunk (see _zip_path)
+EXPORT_COLUMNS = [
+    "track_id", "track_name", "artist_id", "artist_name", "album_id",
+    "album_name", "release_date", "artwork_url", "youtube_url", "audio_path",
+    "container", "codec"
+]
+EXPORT_QUERY = """
+SELECT
+    t.id AS track_id,
+    t.name AS track_name,
+    t.artist_id AS artist_id,
+    ar.name AS artist_name,
+    t.album_id AS album_id,
+    al.name AS album_name,
+    al.release_date AS release_date,
+    al.image_url AS artwork_url,
+    'https://www.youtube.com/watch?v=' || af.video_id AS youtube_url,
+    af.audio_path AS audio_path,
+    af.container AS container,
+    af.codec AS codec
+FROM tracks t
+LEFT JOIN artists ar ON t.artist_id = ar.id
+LEFT JOIN albums al ON t.album_id = al.id
+LEFT JOIN audio_files af ON t.id = af.track_id;
+"""
+
+
+_IN_AUDIO_DIR = re.compile(r"^(?:.*[\\/])?(audio[\\/].*)$")
+
+def _zip_path(audio_path: str|None) -> str|None:
+    """
+    same result as `musicdl.containers.format_for_zip` without touching the filesystem:
+    keep everything from the last `audio` directory onwards
+    (`./tracks/audio/x.flac -> ./audio/x.flac`)
+    """
+    if audio_path is None:
+        return None
+    match = _IN_AUDIO_DIR.match(audio_path)
+    if match:
+        return "./" + match.group(1)
+    return "./audio/" + re.split(r"[\\/]", audio_path)[-1]
+
+
+def _export_columns(rows: list[tuple]) -> dict[str, list]:
+    columns = {name: list(values) for name, values in zip(EXPORT_COLUMNS, zip(*rows))}
+    columns["audio_path"] = [_zip_path(path) for path in columns["audio_path"]]
+    return columns
+
+
+def _write_csv(path: str, chunks):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(EXPORT_COLUMNS)
+        for columns in chunks:
+            writer.writerows(zip(*columns.values()))
+
+
+def _write_jsonl(path: str, chunks):
+    with open(path, "w", encoding="utf-8") as f:
+        for columns in chunks:
+            names = list(columns)
+            f.writelines(json.dumps(dict(zip(names, row)), ensure_ascii=False) + "\n" for row in zip(*columns.values()))
+
+
+def _write_parquet(path: str, chunks):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("exporting to parquet requires pyarrow (pip install pyarrow)")
+    schema = pa.schema([pa.field(name, pa.string()) for name in EXPORT_COLUMNS])
+    with pq.ParquetWriter(path, schema) as writer:
+        for columns in chunks:
+            writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+
+
+EXPORT_WRITERS = {
+    "csv": _write_csv,
+    "jsonl": _write_jsonl,
+    "parquet": _write_parquet,
+}
+
 
 class MusicDB:
-    def __init__(self, music_db=None):
+    """
+    ```
+    db = MusicDB()
+    db.add(album)  # buffered
+    db.flush()     # written in a single transaction
+    print(db.stats)
+    ```
+    `batch_size = 256`: number of buffered tracks that triggers a flush
+
+    `flush_interval = 2.0`: seconds after which an `add()` flushes the buffer regardless of its size
+
+    safe to use from several threads (see `MusicDB.lock`)
+    """
+    def __init__(self, music_db=None, batch_size: int = 256, flush_interval: float = 2.0):
         if music_db is None:
             self.music_db = config["music_db"]
         else:
             self.music_db = music_db
         self.conn=None
         self.cursor=None
+        # the connection is shared with SPTrackDownloader worker threads
+        self.lock = threading.RLock()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending: list[Track] = []
+        self._last_flush = time.monotonic()
+        self.stats = {
+            "commits": 0,
+            "rows": 0,               # tracks written
+            "commit_seconds": 0.0,   # total time spent writing
+            "max_commit_seconds": 0.0,
+        }
         self.connect_to_database()
      
 
-    def _insert_track(self, track: Track):
-        self.cursor.execute('''
+    def _insert_tracks(self, tracks: list[Track]):
+        self.cursor.executemany('''
         INSERT OR IGNORE INTO tracks (id, name, album_id, artist_id)
         VALUES (?, ?, ?, ?)
-        ''', (track.id, track.name, track.album_id, track.artist_id))
+        ''', [(track.id, track.name, track.album_id, track.artist_id) for track in tracks])
 
-        self.cursor.execute('''
+        self.cursor.executemany('''
         INSERT OR IGNORE INTO artists (id, name)
         VALUES (?, ?)
-        ''', (track.artist_id, track.artist_name))
+        ''', [(track.artist_id, track.artist_name) for track in tracks])
 
-        self.cursor.execute('''
+        self.cursor.executemany('''
         INSERT OR IGNORE INTO albums (id, name, artist_id, release_date, image_url)
         VALUES (?, ?, ?, ?, ?)
-        ''', (track.album_id, track.album_name, track.artist_id, track.release_date, track.image_url))
+        ''', [(track.album_id, track.album_name, track.artist_id, track.release_date, track.image_url) for track in tracks])
 
-        self.cursor.execute('''
-        INSERT INTO audio_files (track_id, video_id, audio_path)
-        VALUES (?, ?, ?)
+        self.cursor.executemany('''
+        INSERT INTO audio_files (track_id, video_id, audio_path, container, codec)
+        VALUES (?, ?, ?, ?, ?)
         ON CONFLICT(track_id) DO UPDATE SET
         track_id = excluded.track_id,
         video_id = excluded.video_id,
-        audio_path = excluded.audio_path;
-        ''', (track.id, track.video_id, track.audio_path))
-        self.conn.commit()
+        audio_path = excluded.audio_path,
+        container = excluded.container,
+        codec = excluded.codec;
+        ''', [(track.id, track.video_id, track.audio_path, track.container, track.codec) for track in tracks])
 
-    def _insert_collection(self, c: Album|Playlist):
-        for track in c.tracks.values():
-            print(track)
-            self._insert_track(track)
+    def flush(self):
+        """
+        write every buffered track to music.db in one transaction
+        """
+        with self.lock:
+            self._last_flush = time.monotonic()
+            if not self._pending:
+                return
+            tracks, self._pending = self._pending, []
+            start = time.perf_counter()
+            try:
+                self._insert_tracks(tracks)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                self._pending = tracks + self._pending
+                raise
+            elapsed = time.perf_counter() - start
+            self.stats["commits"] += 1
+            self.stats["rows"] += len(tracks)
+            self.stats["commit_seconds"] += elapsed
+            self.stats["max_commit_seconds"] = max(self.stats["max_commit_seconds"], elapsed)
 
-    def add(self, tc: TrackContainer):
-        assert isinstance(tc, TrackContainer)
+    def _tracks(self, tc: TrackContainer) -> list[Track]:
         if isinstance(tc, Track):
-            self._insert_track(tc)
+            return [tc]
         elif isinstance(tc, Album) or isinstance(tc, Playlist):
-            self._insert_collection(tc)
+            return list(tc.tracks.values())
         elif isinstance(tc, Artist):
-            for album in tc.albums.values():
-                self._insert_collection(album)
+            return [track for album in tc.albums.values() for track in album.tracks.values()]
+        return []
+
+    def add(self, tc: TrackContainer):
+        """
+        buffer the tracks of `tc`, flushing once `batch_size` tracks are
+        waiting or `flush_interval` seconds have passed since the last flush
+        """
+        assert isinstance(tc, TrackContainer)
+        with self.lock:
+            self._pending.extend(self._tracks(tc))
+            if len(self._pending) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def __str__(self):
+        commits = self.stats["commits"]
+        mean_ms = 1000 * self.stats["commit_seconds"] / commits if commits else 0
+        return (f"{self.stats['rows']} tracks in {commits} commits, "
+                f"{mean_ms:.1f}ms per commit (max {1000 * self.stats['max_commit_seconds']:.1f}ms)")
 
     def connect_to_database(self, musicdb=None) -> tuple[Connection, Cursor]:
         if musicdb is not None:
             self.music_db = musicdb
         basedir = os.path.dirname(os.path.abspath(self.music_db))
         os.makedirs(basedir, exist_ok=True)
-        self.conn = connect(self.music_db)
+        self.conn = connect(self.music_db, check_same_thread=False)
+        # WAL lets readers (exports, other processes) run while we write,
+        # synchronous=NORMAL is durable in WAL mode except for the last commits on power loss
+        self.conn.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA busy_timeout=5000;
+        """)
         self.cursor = self.conn.cursor()
         self.create_tables()
 
@@ -103,14 +303,83 @@ class MusicDB:
         );
         """
         self.cursor.executescript(sql_script)
+        self.migrate()
+
+    def migrate(self):
+        """
+        apply any entries of `MIGRATIONS` that this database hasn't seen yet
+        """
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        for i, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            try:
+                self.conn.executescript(f"BEGIN; {script} PRAGMA user_version = {i}; COMMIT;")
+            except Exception:
+                # executescript stops at the failing statement, inside the transaction
+                if self.conn.in_transaction:
+                    self.conn.rollback()
+                raise
+
+    def lookup_audio(self, track_ids: list[str]) -> dict[str, tuple[str, str]]:
+        """
+        ```
+        db.lookup_audio(["7AzlLxHn24DxjgQX73F9fU", ...])
+        # {"7AzlLxHn24DxjgQX73F9fU": ("_r-nPqWGG6c", "./tracks/audio/DonToliver_NoIdea__r-nPqWGG6c.flac")}
+        ```
+        tracks without recorded audio are left out
+        """
+        with self.lock:
+            self.flush()
+            return lookup_audio(self.conn.cursor(), track_ids)
+
+    def lookup_video(self, video_id: str) -> list[str]:
+        """
+        audio_paths already recorded for `video_id`, including tracks that are still buffered
+        """
+        with self.lock:
+            self.flush()
+            return lookup_video(self.conn.cursor(), video_id)
+
+    def audio_paths(self) -> list[tuple[str, str]]:
+        """
+        (video_id, audio_path) of every row in audio_files
+        """
+        with self.lock:
+            self.flush()
+            return self.cursor.execute("SELECT video_id, audio_path FROM audio_files").fetchall()
+
+    def relocate_audio(self, new_path) -> int:
+        """
+        set `audio_path = new_path(video_id, audio_path)` for every row in audio_files
+        (used by `musicdl.storage.migrate_storage`), returns the number of rows changed
+        """
+        with self.lock:
+            self.flush()
+            rows = self.cursor.execute("SELECT track_id, video_id, audio_path FROM audio_files").fetchall()
+            updates = []
+            for track_id, video_id, audio_path in rows:
+                path = new_path(video_id, audio_path)
+                if path != audio_path:
+                    updates.append((path, track_id))
+            try:
+                self.cursor.executemany("UPDATE audio_files SET audio_path = ? WHERE track_id = ?", updates)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            return len(updates)
     
     def reset_database(self):
         # todo: also delete wav files and track info csv
-        if os.path.exists(self.music_db):
-            os.remove(self.music_db)
-        self.connect_to_database()
+        with self.lock:
+            self._pending = []
+            self.conn.close()
+            for path in [self.music_db, f"{self.music_db}-wal", f"{self.music_db}-shm"]:
+                if os.path.exists(path):
+                    os.remove(path)
+            self.connect_to_database()
 
     def close(self):
+        self.flush()
         self.conn.close()
 
     def to_csv(self) -> str|list[str]:
@@ -122,34 +391,46 @@ class MusicDB:
             #file = os.path.join(csv_storage, f"{col}.csv")
             #if os.path.exists(file): os.remove(file)
         output_csv = os.path.join(csv_storage, "tracks.csv")
-        if os.path.exists(output_csv):
-            os.remove(output_csv)
-        query = """
-        SELECT
-            t.id AS track_id,
-            t.name AS track_name,
-            t.artist_id AS artist_id,
-            ar.name AS artist_name,
-            t.album_id AS album_id,
-            al.name AS album_name,
-            al.release_date AS release_date,
-            al.artwork_url AS artwork_url,
-            af.video_id AS youtube_url,
-            af.audio_path AS audio_path
-        FROM tracks t
-        LEFT JOIN artists ar ON t.artist_id = ar.id
-        LEFT JOIN albums al ON t.album_id = al.id
-        LEFT JOIN audio_files af ON t.id = af.track_id;
-        """
-
-        df = pd.read_sql_query(query, self.conn)
-        df["audio_path"] = df["audio_path"].apply(format_for_zip)
-
-        # use full url for simplicity during later processing
-        df["youtube_url"] = df["youtube_url"].apply(lambda v_id: f"https://www.youtube.com/watch?v={v_id}")
-
-        df.to_csv(output_csv, index=False)
-        return output_csv
+        return self.export(output_csv, file_format="csv")
+
+    def export(self, output_path: str, file_format: str = None, chunksize: int = 10_000) -> str:
+        """
+        ```
+        db.export("./tracks/tracks.csv")
+        db.export("./tracks/tracks.jsonl")
+        db.export("./tracks/tracks.parquet")  # requires pyarrow
+        ```
+        write every track (joined with its artist, album, and audio file) to
+        `output_path`, reading `chunksize` rows at a time so memory use doesn't
+        depend on the size of the library
+
+        `file_format`: "csv", "jsonl", or "parquet" (default: based on the extension)
+
+        the output is written to a temporary file and renamed into place
+        """
+        if file_format is None:
+            file_format = os.path.splitext(output_path)[1].lstrip(".").lower()
+        if file_format not in EXPORT_WRITERS:
+            raise ValueError(f"Must use either 'csv', 'jsonl', or 'parquet' (recieved {file_format})")
+        self.flush()
+
+        directory = os.path.dirname(os.path.abspath(output_path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".export-", suffix=f".{file_format}.tmp")
+        os.close(fd)
+        # a separate connection reads a consistent snapshot (WAL) without
+        # holding up writers on self.conn
+        conn = connect(self.music_db)
+        try:
+            cursor = conn.execute(EXPORT_QUERY)
+            chunks = iter(lambda: cursor.fetchmany(chunksize), [])
+            EXPORT_WRITERS[file_format](tmp_path, (_export_columns(rows) for rows in chunks))
+            os.replace(tmp_path, output_path)
+        finally:
+            conn.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return output_path
 
 
         #else:
@@ -174,6 +455,7 @@ class MusicDB:
             "video_id", "audio_path"
         ]
         df = pd.read_csv(csv, names=col_names, header=0)
+        tracks = []
         for _, row in df.iterrows():
             track = Track(
                 track_id=row["track_id"],
@@ -187,6 +469,8 @@ class MusicDB:
                 video_id=row["video_id"],
                 audio_path=row["audio_path"]
             )
+            tracks.append(track)
 
-
-            self._insert_track(track)
\ No newline at end of file
+        with self.lock:
+            self._pending.extend(tracks)
+            self.flush()
\ No newline at end of file
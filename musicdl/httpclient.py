@@ -0,0 +1,109 @@
+import threading
+import os
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+import requests
+
+from .config import config
+
+
+# server errors that are worth another try; 403/429 are left to the
+# rate limiters (see musicdl.ratelimit), which slow every thread down
+RETRY_STATUS = (500, 502, 503, 504)
+
+# only requests that can safely be sent twice are retried
+RETRY_METHODS = ("GET", "HEAD")
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    `HTTPAdapter` with a default (connect, read) timeout, so a stalled
+    socket can't hang a run forever
+    """
+    def __init__(self, timeout: tuple[float, float], **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=self.timeout if timeout is None else timeout, **kwargs)
+
+
+def make_session(timeout: tuple[float, float] = None, retries: int = None, pool_size: int = None) -> requests.Session:
+    """
+    `requests.Session` that keeps connections alive between requests
+    ```
+    session = make_session(timeout=(5, 30), retries=3, pool_size=16)
+    response = session.get("https://www.youtube.com/oembed?format=json&url=...")
+    ```
+    `timeout`: (connect, read) seconds, unless a request passes its own
+
+    `retries`: GET / HEAD requests are retried with exponential backoff after
+    connection errors and 5xx responses (honoring Retry-After)
+
+    `pool_size`: connections kept open per host, about the number of threads
+    making requests at the same time
+    """
+    timeout = (config["http_connect_timeout"], config["http_read_timeout"]) if timeout is None else timeout
+    retries = config["http_retries"] if retries is None else retries
+    pool_size = config["http_pool_size"] if pool_size is None else pool_size
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=RETRY_STATUS,
+        allowed_methods=RETRY_METHODS,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = TimeoutHTTPAdapter(timeout, max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # gzip / deflate, plus brotli and zstd when their packages are installed
+    session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def session() -> requests.Session:
+    """
+    the `make_session()` shared by every request musicdl makes outside of
+    yt-dlp and spotipy (YouTube search pages, oEmbed, the yt-dlp binary),
+    safe to use from several threads
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = make_session()
+    return _session
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """
+    `requests.get` using the shared session
+    """
+    return session().get(url, **kwargs)
+
+
+def download_file(url: str, path: str):
+    """
+    stream `url` to `path`, which only appears once the download is complete
+    """
+    tmp_path = f"{path}.part"
+    try:
+        with get(url, stream=True) as response:
+            response.raise_for_status()
+            with open(tmp_path, "wb") as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
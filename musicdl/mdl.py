@@ -1,17 +1,21 @@
+import contextlib
+import asyncio
+import sys
 import os
-import re
-import zipfile
 
-import pandas as pd
 import argparse
 from argparse import ArgumentParser, RawTextHelpFormatter
 from platformdirs import user_cache_dir
-from tqdm import tqdm
 
-from .containers import Track, TrackContainer, update_csv
+from .containers import update_csv
 from .sp import SpotifyInterface
 from .yt import YoutubeDownloader, SPTrackDownloader, uninstall_ytdlpcli
 from .db import MusicDB
+from .pipeline import Pipeline
+from .archive import export_library
+from .storage import migrate_storage
+from .cache import SearchCache
+from .ratelimit import youtube_limiter
 from .config import config
 
 class MusicDownloader:
@@ -24,53 +28,89 @@ class MusicDownloader:
     `use_db = True`: optionally save all information in `music.db` using SQLite if `use_db` is True, for keeping a 
     structured internal database of songs for musicdl use. (different from db used for Shazam)
     
+    `audio_format = "flac"`: "mp3", "wav", "flac", or a list (e.g. `["flac", "mp3"]`) to convert each download
+    to several formats; the first one is recorded as the track's audio_path
+
+    `audio_format = "native"`, "opus", or "m4a": keep YouTube's audio stream without re-encoding it
+    ("native" keeps whatever container was downloaded, "opus" / "m4a" remux it when the codec allows);
+    the container and codec of each file are recorded in music.db and tracks.csv
+
     `use_ytdlp_cli = False`: (default) use Python version of yt-dlp, with static version of ffmpeg installed via pip 
 
     `use_ytdlp_cli = True`: Optional download yt-dlp from github, seems less prone to 403 Forbidden errors (installs to user cache)
+
+    `workers = 1`: number of tracks of an album, playlist, or artist to search for and download in parallel
+
+    `concurrency = None`: per-stage worker counts for the download pipeline, overrides `workers`
+    (e.g. `{"search": 2, "download": 8}`, see `musicdl.pipeline`)
+
+    `queue_size = 64`: maximum number of tracks waiting in front of each pipeline stage
+
+    `use_search_cache = True`: remember YouTube search results in `user_cache_dir("musicdl")`, see `musicdl.cache`
+
+    `refresh_search = False`: ignore previously cached search results (they are still updated)
+
+    `use_spotify_cache = True`: remember Spotify API responses in `user_cache_dir("musicdl")`, see `musicdl.cache`
+
+    `offline = False`: only use cached Spotify responses
     """
-    def __init__(self, audio_directory = "./tracks", audio_format = "flac", use_db = False, use_ytdlp_cli = False):
+    def __init__(self, audio_directory = "./tracks", audio_format = "flac", use_db = False, use_ytdlp_cli = False, workers = 1,
+                 concurrency: dict[str, int] = None, queue_size = 64, use_search_cache = True, refresh_search = False,
+                 use_spotify_cache = True, offline = False):
         if audio_directory is None:
             audio_directory = config["datadir"]
         self.audio_directory = audio_directory
         self.audio_format = audio_format
         self.use_db = use_db
+        self.workers = workers
+        self.concurrency = {"youtube": workers, "search": workers, "download": workers, "transcode": os.cpu_count() or 1}
+        if concurrency is not None:
+            self.concurrency.update(concurrency)
+        self.queue_size = queue_size
         self.db = MusicDB() if use_db else None
-        self.sp = SpotifyInterface()
+        self.search_cache = SearchCache() if use_search_cache else None
+        self.sp = SpotifyInterface(use_cache=use_spotify_cache, offline=offline)
         self.yt_cli = SPTrackDownloader(
-            self.db.conn.cursor() if self.db is not None else None, 
-            audio_format=audio_format, ytdlp_version="cli" if use_ytdlp_cli else "py", audio_directory=audio_directory)
-        self.yt = YoutubeDownloader(audio_directory=audio_directory, audio_format=audio_format, 
-                                    use_ytdlp_cli=use_ytdlp_cli)
+            audio_format=audio_format, ytdlp_version="cli" if use_ytdlp_cli else "py", audio_directory=audio_directory,
+            workers=workers, db=self.db, search_cache=self.search_cache, refresh_search=refresh_search)
+        self.yt = YoutubeDownloader(audio_directory=audio_directory, audio_format=self.yt_cli.audio_formats,
+                                    use_ytdlp_cli=use_ytdlp_cli, sessions=self.yt_cli.sessions, transcoder=self.yt_cli.transcoder)
 
     def download(self, urls: list[str], verbose=True) -> list[dict]:
         """
         download YouTube audio using Spotify details at each url in `urls`, 
         
-        returns `Track`, `Album`, `Playlist`, or `Artist` object
+        returns a list of track_info dictionaries
+
+        thin wrapper around `adownload()`, use that instead if already
+        running inside an event loop
+        """
+        return asyncio.run(self.adownload(urls, verbose=verbose))
+
+    async def adownload(self, urls: list[str], verbose=True) -> list[dict]:
         """
-        output_list = []
-        for url in tqdm(urls, desc="Downloading from urls"):
-            if "spotify" in url:
-                tc = self.sp.retrieve_track_container(url)
-                tc = self.yt_cli.add_audio(tc, verbose=verbose)
-                if self.use_db: 
-                    self.db.add(tc)
-                if verbose: 
-                    print(tc)
-                tracks_info = tc.to_list()
-            else:
-                if "&list=" in url:
-                    print(url)
-                    print("musicdl does not currently support youtube playlists")
-                    print("converted to single url (removing &list=...)")
-                    url = re.match("^(.*)&list=", url).group(1)
-                tracks_info = self.yt.download([url])
-                # note: does not store youtube urls into db
-                #       use spotify urls to get pretty album art
-                # note: update_csv runs in yt.download()
-
-            update_csv(os.path.join(self.audio_directory, "tracks.csv"), tracks_info)
-            output_list.extend(tracks_info)
+        ```
+        tracks_info = await mdl.adownload(urls)
+        ```
+        runs `urls` through a staged pipeline (metadata -> search -> download -> transcode -> persist),
+        see `musicdl.pipeline.Pipeline`
+        """
+        if isinstance(urls, str):
+            urls = [urls]
+        pipeline = Pipeline(self, concurrency=self.concurrency, queue_size=self.queue_size, verbose=verbose)
+        output_list = await pipeline.run(urls)
+        if self.use_db:
+            self.db.flush()
+        if verbose:
+            print(f"YouTube rate limiter: {youtube_limiter}")
+            if self.use_db:
+                print(f"music.db: {self.db}")
+            if self.search_cache is not None:
+                print(f"YouTube search cache: {self.search_cache}")
+            print(f"audio: {self.yt_cli.stats['downloaded']} downloaded, {self.yt_cli.stats['reused']} reused ({self.yt_cli.reuse_audio})")
+            print(f"transcoding: {self.yt_cli.transcoder}")
+            if self.yt_cli.sessions is not None:
+                print(f"yt-dlp: {self.yt_cli.sessions}")
         return output_list
 
     def to_csv(self, tracks_info: list[dict] = None) -> str|list[str]:
@@ -84,48 +124,55 @@ class MusicDownloader:
             return self.db.to_csv()
         else:
             tracks_info_csv = os.path.join(self.audio_directory, "tracks.csv")
-            if os.path.exists(tracks_info_csv):
-                orig_df = pd.read_csv(tracks_info_csv)
-                new_df = pd.DataFrame(tracks_info)
-                combined_df = pd.concat([orig_df, new_df], ignore_index=True)
-                combined_df = combined_df.drop_duplicates(subset=["youtube_url"])
-                os.remove(tracks_info_csv)
-                combined_df.to_csv(tracks_info_csv, index=False)
-            else:
-                os.remove(tracks_info_csv)
-                new_df = pd.DataFrame(tracks_info)
-                new_df.to_csv(tracks_info_csv, index=False)
+            if tracks_info:
+                update_csv(tracks_info_csv, tracks_info)
             return tracks_info_csv
 
-    def to_zip(self):
-        csv_path = self.to_csv()
-        db_filename = os.path.basename(config["music_db"])
-
-        source_dir = config["datadir"]
-        dest_zip = config["zip"]()
-        if os.path.exists(dest_zip):
-            os.remove(dest_zip)
-        with zipfile.ZipFile(dest_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(source_dir):
-                for file in files:
-                    if file == db_filename:
-                        continue
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, source_dir)
-                    zipf.write(file_path, arcname)
-
-        print(f"audios and track info saved to {os.path.abspath(dest_zip)}")
+    def to_zip(self, dest_zip: str = None, since_last_export: bool = False, workers: int = None, store_wav: bool = False):
+        """
+        save the audio files and tracks.csv to `dest_zip` (default: `config["zip"]()`),
+        or stream the zip file to stdout if `dest_zip` is "-"
+
+        `since_last_export = True`: only include audio files and tracks.csv rows
+        that were added since the previous export (see `musicdl.archive.export_library`)
+
+        audio files are stored as is, see `musicdl.archive.ArchiveWriter`
+        """
+        if dest_zip is None:
+            dest_zip = config["zip"]()
+        sink = dest_zip
+        if dest_zip == "-":
+            # keep stdout for the zip file, messages go to stderr
+            sink = sys.stdout.buffer
+        with contextlib.redirect_stdout(sys.stderr if dest_zip == "-" else sys.stdout):
+            self.to_csv()
+            db_filename = os.path.basename(config["music_db"])
+            exclude = {db_filename, f"{db_filename}-wal", f"{db_filename}-shm"}
+            archive = export_library(sink, config["datadir"], exclude=exclude, since_last_export=since_last_export,
+                                     workers=workers, store_wav=store_wav)
+            print(archive)
+            if dest_zip != "-":
+                print(f"audios and track info saved to {os.path.abspath(dest_zip)}")
+        return dest_zip
 
     def close(self):
         if self.use_db:
             self.db.close()
+        if self.search_cache is not None:
+            self.search_cache.close()
+            self.search_cache = None
+        self.sp.close()
+        self.yt_cli.transcoder.close()
+        if self.yt_cli.sessions is not None:
+            self.yt_cli.sessions.close()
     
     def __del__(self):
         self.close()
 
 def read_input():
     """
-    handle command line arguments and return a list of urls to be processed
+    handle command line arguments and return a list of urls to be processed,
+    along with the parsed arguments
     """
 
     class HelpFormatter(RawTextHelpFormatter):
@@ -169,15 +216,62 @@ def read_input():
                             "", 
                             hline
                             ]))
-    parser.add_argument("--export", action="store_true", default=False,
+    parser.add_argument("-j", "--jobs", dest="jobs", default=1, type=int,
+                        help="\n".join([
+                            "number of tracks to search for and download in parallel",
+                            "",
+                            "musicdl -j 8 -f example.txt",
+                            "",
+                            hline
+                            ]))
+    parser.add_argument("--refresh-search", dest="refresh_search", action="store_true", default=False,
+                        help="\n".join([
+                            "search YouTube again instead of using cached search results",
+                            "",
+                            "musicdl --refresh-search -f example.txt",
+                            "",
+                            hline
+                            ]))
+    parser.add_argument("--offline", action="store_true", default=False,
+                        help="\n".join([
+                            "only use cached Spotify metadata, urls that were never",
+                            "retrieved before are skipped",
+                            "",
+                            "musicdl --offline -f example.txt",
+                            "",
+                            hline
+                            ]))
+    parser.add_argument("--export", nargs="?", const="", default=None, metavar="ZIPFILE",
                         help="\n".join([
                             "save music to a ZIP file for further processing",
                             "",
                             "musicdl --export",
                             f">> audios and track info saved to: ./{config['zip']()}",
+                            "",
+                            "musicdl --export library.zip",
+                            "musicdl --export - | ssh host 'cat > library.zip'",
                             "", 
                             hline
                             ]))
+    parser.add_argument("--since-last-export", dest="since_last_export", action="store_true", default=False,
+                        help="\n".join([
+                            "with --export, only include tracks added since the previous export",
+                            "(apply the resulting zip files in order with musicdl.dataloader.extract_zip)",
+                            "",
+                            "musicdl --export nightly.zip --since-last-export",
+                            "", 
+                            hline
+                            ]))
+    parser.add_argument("--migrate-storage", dest="migrate_storage", action="store_true", default=False,
+                        help="\n".join([
+                            "move downloaded audio into the layout set by HASH_AUDIO_STORAGE,",
+                            "HASH_WIDTH, and HASH_DEPTH (e.g. audio/ab/cd/), updating music.db",
+                            "and tracks.csv; safe to run again if interrupted",
+                            "",
+                            "musicdl --migrate-storage",
+                            "",
+                            hline
+                            ]))
 
     parser.add_argument("--uninstall", default=False, action="store_true",
                         help=f"\n".join([
@@ -192,9 +286,14 @@ def read_input():
     args = parser.parse_args()
     urls = args.urls
     file = args.file
-    if args.export:
+    if args.export is not None:
+        mdl = MusicDownloader(use_db=True)
+        mdl.to_zip(args.export or None, since_last_export=args.since_last_export)
+        mdl.close()
+        exit(0)
+    if args.migrate_storage:
         mdl = MusicDownloader(use_db=True)
-        mdl.to_zip()
+        migrate_storage(config["datadir"], db=mdl.db)
         mdl.close()
         exit(0)
     if args.uninstall:
@@ -211,10 +310,10 @@ def read_input():
         print("no arguments specified, see --help for details")
         exit(0)
     # some terminals automatically escape certain characters (such as '?') when pasting
-    return [url.replace("\\", "") for url in urls]
+    return [url.replace("\\", "") for url in urls], args
 
 def main():
-    urls = read_input()
-    mdl = MusicDownloader(use_db=True)
+    urls, args = read_input()
+    mdl = MusicDownloader(use_db=True, workers=args.jobs, refresh_search=args.refresh_search, offline=args.offline)
     mdl.download(urls, verbose=True)
     mdl.close()
@@ -0,0 +1,344 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import asyncio
+import os
+import re
+
+from tqdm import tqdm
+
+from .containers import Track, Artist, TrackContainer, update_csv
+from .transcode import describe_audio
+
+# number of tracks looked up in music.db with a single query
+LOOKUP_CHUNK_SIZE = 50
+
+# with the yt-dlp cli, how long (seconds) the download stage waits for more
+# tracks to put in the same batch (see SPTrackDownloader.batch_size)
+BATCH_LINGER = 2.0
+
+# urls enter the pipeline at "metadata", individual tracks flow through the
+# remaining stages; each stage has its own workers and a bounded inbox so that
+# searching for track N+1 overlaps with downloading track N, and downloads
+# keep going while earlier tracks are being converted. YouTube urls skip
+# the Spotify stages and are downloaded by "youtube", so they don't hold up
+# the metadata of the urls after them
+STAGES = ("metadata", "youtube", "search", "download", "transcode", "persist")
+
+DEFAULT_CONCURRENCY = {
+    "metadata": 1,                      # Spotify API
+    "youtube": 1,                       # YoutubeDownloader, download + convert + metadata from yt-dlp
+    "search": 1,                        # YouTube search pages (also limited by musicdl.ratelimit)
+    "download": 1,                      # yt-dlp, best audio stream as is
+    "transcode": os.cpu_count() or 1,   # ffmpeg (see musicdl.transcode)
+    "persist": 1,                       # single writer for music.db and tracks.csv
+}
+
+
+class _Job:
+    """
+    one url passed to `MusicDownloader.download`
+    """
+    def __init__(self, index: int, url: str):
+        self.index = index
+        self.url = url
+        self.tc: TrackContainer|None = None
+        self.tracks_info: list[dict] = []
+        self.pending = 0        # tracks emitted but not yet persisted
+        self.emitting = True    # metadata stage is still producing tracks
+        self.emitted = set()    # keys of the tracks handed to the other stages
+        self.finished = False
+
+    def __repr__(self):
+        return f"<_Job {self.url}>"
+
+
+class _TrackItem:
+    """
+    a track of a job moving through search -> download -> persist
+    """
+    def __init__(self, job: _Job, key, track: Track):
+        self.job = job
+        self.key = key          # where the track lives in job.tc (see SpotifyInterface.iter_track_container)
+        self.track = track
+        self.cached = False     # audio already recorded in music.db
+        self.staged_path = None # downloaded stream waiting to be converted
+
+    def __repr__(self):
+        return f'<_TrackItem "{self.track.name}" of {self.job.url}>'
+
+
+def _next_chunk(iterator, n: int) -> list:
+    """
+    up to `n` items from `iterator`, an empty list once it is exhausted
+    """
+    chunk = []
+    for item in iterator:
+        chunk.append(item)
+        if len(chunk) == n:
+            break
+    return chunk
+
+
+def _remove(tc: TrackContainer, key):
+    if isinstance(tc, Artist):
+        album_id, track_id = key
+        tc.albums[album_id].tracks.pop(track_id, None)
+    else:
+        tc.tracks.pop(key, None)
+
+
+def _keys(tc: TrackContainer) -> list:
+    """
+    keys of every track in `tc`, in the form used by `_remove`
+    """
+    if isinstance(tc, Artist):
+        return [(album_id, track_id) for album_id, album in tc.albums.items() for track_id in album.tracks]
+    return list(tc.tracks)
+
+
+class Pipeline:
+    """
+    Asyncio pipeline used by `MusicDownloader.adownload`
+
+    ```
+    metadata -> search -> download -> transcode -> persist
+             -> youtube (YouTube urls)
+    ```
+    `concurrency`: number of workers per stage, e.g. `{"search": 4, "download": 8}`
+
+    `queue_size`: maximum number of items waiting in front of each stage,
+    keeps memory flat for very large inputs
+
+    blocking work (spotipy, requests, yt-dlp, sqlite) runs on a thread pool
+    sized to the total number of workers
+    """
+    def __init__(self, mdl, concurrency: dict[str, int] = None, queue_size: int = 64, verbose: bool = True):
+        self.mdl = mdl
+        self.concurrency = dict(DEFAULT_CONCURRENCY)
+        if concurrency is not None:
+            self.concurrency.update({stage: max(1, int(n)) for stage, n in concurrency.items()})
+        self.queue_size = queue_size
+        self.verbose = verbose
+        self.tracks_csv = os.path.join(mdl.audio_directory, "tracks.csv")
+        self.queues: dict[str, asyncio.Queue] = {}
+        self._executor = None
+        self._progress = None
+
+    async def run(self, urls: list[str]) -> list[dict]:
+        """
+        process every url in `urls`, returns track_info dictionaries in the order of `urls`
+        """
+        self.queues = {stage: asyncio.Queue(maxsize=self.queue_size) for stage in STAGES}
+        self._executor = ThreadPoolExecutor(max_workers=sum(self.concurrency.values()))
+        self._progress = tqdm(total=len(urls), desc="Downloading from urls")
+        workers = [
+            asyncio.create_task(self._worker(stage))
+            for stage in STAGES
+            for _ in range(self.concurrency[stage])
+        ]
+        jobs = [_Job(i, url) for i, url in enumerate(urls)]
+        try:
+            for job in jobs:
+                await self.queues["metadata"].put(job)
+            # items only ever move forward, so once a stage has drained
+            # nothing new can show up in the stages before it
+            for stage in STAGES:
+                await self.queues[stage].join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self._executor.shutdown(wait=True)
+            self._progress.close()
+
+        output_list = []
+        for job in jobs:
+            output_list.extend(job.tracks_info)
+        return output_list
+
+    async def _blocking(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def _worker(self, stage: str):
+        handler = getattr(self, f"_{stage}")
+        inbox = self.queues[stage]
+        while True:
+            item = await inbox.get()
+            try:
+                await handler(item)
+            except Exception as e:
+                try:
+                    await self._failed(item, e)
+                except Exception as e:
+                    # a stage worker must outlive any item, or the queues never drain
+                    print(f"Failed to clean up after {item}: {e!r}")
+            finally:
+                inbox.task_done()
+
+    async def _failed(self, item, e: Exception):
+        if isinstance(item, _Job):
+            print(f"Failed to retrieve {item.url}: {e}")
+            if isinstance(item.tc, Track):
+                item.tc = item.tc if None in item.emitted else None
+            elif item.tc is not None:
+                # keep the tracks that are already on their way through the pipeline
+                for key in _keys(item.tc):
+                    if key not in item.emitted:
+                        _remove(item.tc, key)
+            item.emitting = False
+            await self._maybe_finish(item)
+            return
+        print(f'Failed to add audio to "{item.track.name}": {e}')
+        job = item.job
+        if item.key is None:
+            job.tc = None
+        elif job.tc is not None:
+            _remove(job.tc, item.key)
+        job.pending -= 1
+        await self._maybe_finish(job)
+
+    ############################################################
+    # stages
+    ############################################################
+
+    async def _metadata(self, job: _Job):
+        url = job.url
+        if "spotify" in url:
+            # tracks are handed to the search stage page by page, while
+            # later pages of a long playlist are still being retrieved
+            job.tc, tracks = await self._blocking(self.mdl.sp.iter_track_container, url)
+            while True:
+                chunk = await self._blocking(_next_chunk, tracks, LOOKUP_CHUNK_SIZE)
+                if not chunk:
+                    break
+                found = await self._blocking(self.mdl.yt_cli.lookup_many, [track for _, track in chunk])
+                for key, track in chunk:
+                    item = _TrackItem(job, key, track)
+                    job.pending += 1
+                    job.emitted.add(key)
+                    if track.id in found:
+                        # audio already recorded in music.db, nothing to search for or download
+                        track.video_id, track.audio_path = found[track.id]
+                        item.cached = True
+                        if self.verbose: print(f'"{track.name}" already exists in database')
+                        await self.queues["persist"].put(item)
+                    else:
+                        await self.queues["search"].put(item)
+        else:
+            await self.queues["youtube"].put(job)
+            return
+        job.emitting = False
+        await self._maybe_finish(job)
+
+    async def _youtube(self, job: _Job):
+        url = job.url
+        if "&list=" in url:
+            print(url)
+            print("musicdl does not currently support youtube playlists")
+            print("converted to single url (removing &list=...)")
+            url = re.match("^(.*)&list=", url).group(1)
+        # note: does not store youtube urls into db
+        #       use spotify urls to get pretty album art
+        job.tracks_info = await self._blocking(self.mdl.yt.download, [url])
+        job.emitting = False
+        await self._maybe_finish(job)
+
+    async def _search(self, item: _TrackItem):
+        yt = self.mdl.yt_cli
+        item.track.video_id = await self._blocking(yt._search, item.track)
+        await self.queues["download"].put(item)
+
+    async def _download(self, item: _TrackItem):
+        yt = self.mdl.yt_cli
+        if yt.batch_size > 1:
+            await self._download_batch(item)
+            return
+        item.track.audio_path, item.staged_path = await self._blocking(yt._fetch, item.track, item.track.video_id)
+        await self.queues["transcode"].put(item)
+
+    async def _download_batch(self, item: _TrackItem):
+        """
+        `_download` for the yt-dlp cli: `item` and whatever else arrives within
+        `BATCH_LINGER` seconds (up to `batch_size` tracks) share a run of yt-dlp
+        """
+        yt = self.mdl.yt_cli
+        inbox = self.queues["download"]
+        items = [item]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + BATCH_LINGER
+        while len(items) < yt.batch_size:
+            try:
+                items.append(await asyncio.wait_for(inbox.get(), timeout=max(0, deadline - loop.time())))
+            except asyncio.TimeoutError:
+                break
+        extra = items[1:]
+        try:
+            try:
+                fetched = await self._blocking(yt._fetch_many, [(i.track, i.track.video_id) for i in items])
+            except Exception as e:
+                for other in extra:
+                    await self._failed(other, e)
+                raise
+            # failed by the worker once the rest of the batch is taken care of
+            error = None
+            deferred = []
+            for other, result in zip(items, fetched):
+                if result is None:
+                    deferred.append(other)
+                    continue
+                if isinstance(result, Exception):
+                    if other is item:
+                        error = result
+                    else:
+                        await self._failed(other, result)
+                    continue
+                other.track.audio_path, other.staged_path = result
+                await self.queues["transcode"].put(other)
+            # the same video as a track that is being converted, `_fetch` waits for it
+            for other in deferred:
+                try:
+                    other.track.audio_path, other.staged_path = await self._blocking(yt._fetch, other.track, other.track.video_id)
+                except Exception as e:
+                    if other is item:
+                        error = e
+                    else:
+                        await self._failed(other, e)
+                    continue
+                await self.queues["transcode"].put(other)
+            if error is not None:
+                raise error
+        finally:
+            for _ in extra:
+                inbox.task_done()
+
+    async def _transcode(self, item: _TrackItem):
+        yt = self.mdl.yt_cli
+        if item.staged_path is not None:
+            await self._blocking(yt._transcode, item.track.video_id, item.staged_path, item.track.audio_path)
+        if self.verbose: print(f'Audio added to "{item.track.name}"')
+        await self.queues["persist"].put(item)
+
+    async def _persist(self, item: _TrackItem):
+        track = item.track
+        track.container, track.codec = await self._blocking(describe_audio, track.audio_path)
+        if self.mdl.use_db and not item.cached:
+            await self._blocking(self.mdl.db.add, item.track)
+        item.job.pending -= 1
+        await self._maybe_finish(item.job)
+
+    async def _maybe_finish(self, job: _Job):
+        """
+        once every track of a url has gone through the pipeline, record the
+        url's tracks in tracks.csv
+        """
+        if job.finished or job.emitting or job.pending > 0:
+            return
+        job.finished = True
+        if job.tc is not None:
+            if self.verbose:
+                print(job.tc)
+            job.tracks_info = job.tc.to_list()
+        if job.tracks_info:
+            await self._blocking(update_csv, self.tracks_csv, job.tracks_info)
+        self._progress.update(1)
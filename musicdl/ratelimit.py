@@ -0,0 +1,159 @@
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import threading
+import random
+import time
+import re
+
+from .config import config
+
+
+# status codes that YouTube uses to tell us to slow down
+THROTTLE_STATUS = (403, 429)
+
+
+def parse_retry_after(value: str|None) -> float|None:
+    """
+    convert a Retry-After header (either seconds or an HTTP date) to seconds
+    """
+    if value is None or value == "":
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def status_from_error(e: Exception) -> int|None:
+    """
+    yt-dlp reports HTTP failures as text ("HTTP Error 429: Too Many Requests"),
+    returns the status code if there is one
+    """
+    match = re.search(r"HTTP Error (\d{3})", str(e))
+    if match:
+        return int(match.group(1))
+    return None
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every thread that talks to the same upstream
+
+    ```
+    limiter = RateLimiter(rate=1.0, burst=4)
+    limiter.acquire()            # blocks until a request is allowed
+    response = requests.get(url)
+    limiter.report(response)     # backs off on 403/429, ramps up on success
+    print(limiter)
+    ```
+    `rate`: requests per second when the upstream is healthy
+
+    `burst`: number of requests that can be made back to back after being idle
+
+    On a 403/429 the rate is halved and requests are held back for either
+    the Retry-After duration or an exponential backoff with jitter. After
+    `ramp_after` successes in a row the rate is doubled, up to `rate`.
+    """
+    def __init__(self, rate: float = 1.0, burst: int = 4, min_rate: float = None, backoff: float = 2.0, max_backoff: float = 300.0, ramp_after: int = 10):
+        if rate <= 0:
+            raise ValueError(f"rate should be positive (recieved {rate})")
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = float(min_rate) if min_rate is not None else self.max_rate / 16
+        self.burst = max(1, int(burst))
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.ramp_after = ramp_after
+
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._failures = 0
+        self._successes = 0
+        self._lock = threading.Lock()
+
+        self.stats = {
+            "requests": 0,           # number of acquire() calls
+            "throttled": 0,          # acquire() calls that had to wait
+            "throttled_seconds": 0.0,
+            "backoffs": 0,           # number of 403/429 responses
+        }
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self) -> float:
+        """
+        wait until a request is allowed, returns the number of seconds waited
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        self.stats["requests"] += 1
+                        if waited > 0:
+                            self.stats["throttled"] += 1
+                            self.stats["throttled_seconds"] += waited
+                        return waited
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._successes += 1
+            if self._successes >= self.ramp_after and self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate * 2)
+                self._successes = 0
+
+    def failure(self, retry_after: float|None = None):
+        """
+        the upstream asked us to slow down (403/429)
+        """
+        with self._lock:
+            self._successes = 0
+            self._failures += 1
+            self.stats["backoffs"] += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after is None:
+                delay = min(self.max_backoff, self.backoff * 2 ** (self._failures - 1))
+                delay *= random.uniform(0.5, 1.5)
+            else:
+                delay = min(self.max_backoff, retry_after)
+            self._tokens = 0.0
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+
+    def report(self, response) -> bool:
+        """
+        update the limiter using a `requests.Response`,
+        returns False if the response was a 403/429
+        """
+        if response.status_code in THROTTLE_STATUS:
+            self.failure(parse_retry_after(response.headers.get("Retry-After")))
+            return False
+        self.success()
+        return True
+
+    def __str__(self):
+        return (f"{self.stats['requests']} requests, "
+                f"throttled {self.stats['throttled']} times for {self.stats['throttled_seconds']:.1f}s, "
+                f"{self.stats['backoffs']} backoffs, "
+                f"current rate {self.rate:.2f}/s")
+
+
+# all YouTube traffic (search pages, oEmbed, yt-dlp downloads) goes through this
+youtube_limiter = RateLimiter(rate=config["yt_rate"], burst=config["yt_burst"])
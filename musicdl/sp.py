@@ -1,4 +1,6 @@
 
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Iterator
 from sqlite3 import Cursor
 import re
 
@@ -7,8 +9,14 @@ import spotipy
 
 
 from .containers import Track, Playlist, Album, Artist, TrackContainer
+from .cache import ResponseCache, CacheMissError, default_cache_path
 from .config import config
 
+# limits of the Spotify Web API
+ALBUMS_PER_REQUEST = 20
+PAGE_SIZE = 50
+PLAYLIST_PAGE_SIZE = 100
+
 
 class SpotifyInterface:
     """
@@ -24,15 +32,26 @@ class SpotifyInterface:
     track_id = re.search("track/([a-zA-Z0-9]+)", url).group(1)
     track = spi.construct_track(track_id)
     ```
+    `use_cache = True`: keep API responses in `user_cache_dir("musicdl")`, see `musicdl.cache.ResponseCache`
+
+    `offline = False`: only use cached responses, raises `CacheMissError` for anything not cached
+
+    `workers = 8`: number of concurrent requests used when retrieving an artist
     """
     #def __init__(self, cursor: Cursor):
-    def __init__(self):
+    def __init__(self, use_cache: bool = True, offline: bool = False, workers: int = 8):
         self.initialized = False
         self._sp = None
+        self.offline = offline
+        self.workers = max(1, int(workers))
+        self.cache = ResponseCache() if use_cache or offline else None
 
 
     def initialize(self):
-        client_id=config["client_id"],
+        self.initialized = True
+        if self.offline:
+            return
+        client_id=config["client_id"]
         client_secret=config["client_secret"]
         if client_id is None or client_secret is None or client_id == "" or client_secret == "":
             print("\n".join([f"Spotify API Credentials not found in environment variables",
@@ -49,10 +68,37 @@ class SpotifyInterface:
         self._sp = spotipy.Spotify(
             auth_manager=spotipy.oauth2.SpotifyClientCredentials(
                 client_id=config["client_id"],
-                client_secret=config["client_secret"]
+                client_secret=config["client_secret"],
+                # reuse the access token across runs (valid for an hour)
+                cache_handler=spotipy.cache_handler.CacheFileHandler(
+                    cache_path=default_cache_path("spotify_token.json")
+                    )
                 )
             )
 
+    def _call(self, endpoint: str, *args, **kwargs) -> dict:
+        """
+        `self._sp.<endpoint>(*args, **kwargs)`, served from the response cache when possible
+        """
+        if not self.initialized:
+            self.initialize()
+        key = ResponseCache.make_key(endpoint, *args, **kwargs)
+        if self.cache is not None:
+            response = self.cache.get_response(endpoint, key, offline=self.offline)
+            if response is not None:
+                return response
+        if self.offline:
+            raise CacheMissError(key)
+        response = getattr(self._sp, endpoint)(*args, **kwargs)
+        if self.cache is not None:
+            self.cache.set_response(key, response)
+        return response
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
     def parse_url(self, url) -> tuple[str, str]:
         """
         reads in a spotify url and returns the id and the url_type (track, album, playlist, or artist)
@@ -86,13 +132,83 @@ class SpotifyInterface:
         elif tc_type == "artist":
             return self.retrieve_artist(tc_id)
 
+    def iter_track_container(self, url) -> tuple[TrackContainer, Iterator[tuple]]:
+        """
+        streaming version of `retrieve_track_container`, follows pagination
+        lazily so that tracks on the first page can be used while later
+        pages are still being retrieved
+        ```
+        tc, tracks = spi.iter_track_container(url)
+        for key, track in tracks:
+            ...  # tc is filled in as tracks are yielded
+        ```
+        keys are track ids, or (album_id, track_id) for artists
+        """
+        if not self.initialized:
+            self.initialize()
+        tc_id, tc_type = self.parse_url(url)
+        if tc_type == "track":
+            track = self.retrieve_track(tc_id)
+            return track, iter([(None, track)])
+        elif tc_type == "album":
+            sp_album = self._call("album", tc_id)
+            album = Album.from_spotify(tc_id, sp_album=sp_album)
+            return album, self._iter_album(album, sp_album["tracks"])
+        elif tc_type == "playlist":
+            playlist = Playlist(playlist_id=tc_id, tracks={})
+            return playlist, self._iter_playlist(playlist)
+        elif tc_type == "artist":
+            sp_artist = self._call("artist", tc_id)
+            artist = Artist(sp_artist["name"], sp_artist["id"])
+            return artist, self._iter_artist(artist)
+
+    def _iter_album(self, album: Album, sp_tracks: dict) -> Iterator[tuple[str, Track]]:
+        """
+        yields the tracks already in `album` (the first page, `sp_tracks`),
+        then the tracks of any remaining pages
+        """
+        for track_id, track in list(album.tracks.items()):
+            yield track_id, track
+        offset = len(sp_tracks["items"])
+        next_page = sp_tracks.get("next")
+        while next_page is not None and offset > 0:
+            page = self._call("album_tracks", album.id, limit=PAGE_SIZE, offset=offset)
+            for track in album.extend_from_spotify(page["items"]):
+                yield track.id, track
+            next_page = page["next"]
+            if len(page["items"]) == 0:
+                break
+            offset += len(page["items"])
+
+    def _iter_playlist(self, playlist: Playlist) -> Iterator[tuple[str, Track]]:
+        offset = 0
+        while True:
+            page = self._call("playlist_tracks", playlist.id, limit=PLAYLIST_PAGE_SIZE, offset=offset)
+            for track in playlist.extend_from_spotify(page["items"]):
+                yield track.id, track
+            if page["next"] is None or len(page["items"]) == 0:
+                break
+            offset += len(page["items"])
+
+    def _iter_artist(self, artist: Artist) -> Iterator[tuple[tuple[str, str], Track]]:
+        """
+        albums are retrieved in chunks, one batch request per worker at a time
+        """
+        album_ids = self._artist_album_ids(artist.id)
+        chunk_size = ALBUMS_PER_REQUEST * self.workers
+        for i in range(0, len(album_ids), chunk_size):
+            for sp_album in self._albums(album_ids[i:i+chunk_size]):
+                album = Album.from_spotify(sp_album['id'], sp_album=sp_album)
+                artist.albums[album.id] = album
+                for track_id, track in album.tracks.items():
+                    yield (album.id, track_id), track
 
     def retrieve_track(self, track_id: str) -> Track:
         """
         retrieve individual track
         """
         try:
-            sp_track = self._sp.track(track_id)
+            sp_track = self._call("track", track_id)
         except requests.exceptions.ConnectionError as e:
             #print(str(e))
             print("[Errno -3] Temporary failure in name resolution")
@@ -105,14 +221,66 @@ class SpotifyInterface:
         retrieve all tracks in an album
         """
         try:
-            sp_album = self._sp.album(album_id)
+            sp_album = self._call("album", album_id)
         except requests.exceptions.ConnectionError as e:
             #print(str(e))
             print("[Errno -3] Temporary failure in name resolution")
             print("Check to see if you have a reliable internet connection")
             exit(1)
+        sp_album = self._with_all_tracks(sp_album)
         return Album.from_spotify(album_id, sp_album=sp_album)
 
+    def _with_all_tracks(self, sp_album: dict) -> dict:
+        """
+        album objects only embed the first page of tracks, this follows
+        the pagination for longer albums
+        """
+        sp_tracks = sp_album["tracks"]
+        if sp_tracks.get("next") is None:
+            return sp_album
+        items = list(sp_tracks["items"])
+        while True:
+            page = self._call("album_tracks", sp_album["id"], limit=PAGE_SIZE, offset=len(items))
+            items.extend(page["items"])
+            if page["next"] is None or len(page["items"]) == 0:
+                break
+        return {**sp_album, "tracks": {**sp_tracks, "items": items, "next": None}}
+
+    def _albums(self, album_ids: list[str]) -> list[dict]:
+        """
+        retrieve full album objects (every track included) for `album_ids`, in order
+
+        albums that aren't cached are requested `ALBUMS_PER_REQUEST` at a time
+        from the several-albums endpoint, with requests made concurrently
+        """
+        if not self.initialized:
+            self.initialize()
+        sp_albums = {}
+        missing = []
+        for album_id in album_ids:
+            sp_album = None
+            if self.cache is not None:
+                sp_album = self.cache.get_response("album", ResponseCache.make_key("album", album_id), offline=self.offline)
+            if sp_album is None:
+                missing.append(album_id)
+            else:
+                sp_albums[album_id] = sp_album
+        if missing and self.offline:
+            raise CacheMissError(ResponseCache.make_key("album", missing[0]))
+
+        batches = [missing[i:i+ALBUMS_PER_REQUEST] for i in range(0, len(missing), ALBUMS_PER_REQUEST)]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for response in pool.map(self._sp.albums, batches):
+                for sp_album in response["albums"]:
+                    if sp_album is None:
+                        continue
+                    if self.cache is not None:
+                        self.cache.set_response(ResponseCache.make_key("album", sp_album["id"]), sp_album)
+                    sp_albums[sp_album["id"]] = sp_album
+            found = [album_id for album_id in album_ids if album_id in sp_albums]
+            hydrated = pool.map(self._with_all_tracks, [sp_albums[album_id] for album_id in found])
+            return list(hydrated)
+
     def retrieve_artist(self, artist_id: str) -> Artist:
         """
         retrieve all albums by an artist (=> all tracks)
@@ -120,36 +288,42 @@ class SpotifyInterface:
         singles are considered albums
         """
         try:
-            sp_artist = self._sp.artist(artist_id)
+            sp_artist = self._call("artist", artist_id)
         except requests.exceptions.ConnectionError as e:
             #print(str(e))
             print("[Errno -3] Temporary failure in name resolution")
             print("Check to see if you have a reliable internet connection")
             exit(1)
         artist = Artist(sp_artist["name"], sp_artist["id"])
-
-        offset = 0
-        while True:
-            sp_artist_albums = self._sp.artist_albums(artist_id, include_groups='album,single', limit=50, offset=offset)
-            for sp_album in sp_artist_albums['items']:
-                album_id = sp_album['id']
-                album = self.retrieve_album(album_id)
-                artist.albums[album_id] = album
-            if len(sp_artist_albums['items']) == 50:
-                offset += 50
-            else:
-                break
+        for sp_album in self._albums(self._artist_album_ids(artist_id)):
+            artist.albums[sp_album['id']] = Album.from_spotify(sp_album['id'], sp_album=sp_album)
         return artist
 
+    def _artist_album_ids(self, artist_id: str) -> list[str]:
+        """
+        ids of every album and single by an artist
+        """
+        # the first page tells us how many pages there are, request the rest concurrently
+        retrieve_page = lambda offset: self._call("artist_albums", artist_id, include_groups='album,single', limit=PAGE_SIZE, offset=offset)
+        first_page = retrieve_page(0)
+        pages = [first_page]
+        offsets = range(PAGE_SIZE, first_page["total"], PAGE_SIZE)
+        if len(offsets) > 0:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                pages.extend(pool.map(retrieve_page, offsets))
+        return list(dict.fromkeys(sp_album['id'] for page in pages for sp_album in page['items']))
+
     def retrieve_playlist(self, playlist_id) -> Playlist:
         """
         retrieve all tracks in a playlist
         """
+        playlist = Playlist(playlist_id=playlist_id, tracks={})
         try:
-            sp_playlist_tracks = self._sp.playlist_tracks(playlist_id)
+            for _ in self._iter_playlist(playlist):
+                pass
         except requests.exceptions.ConnectionError as e:
             #print(str(e))
             print("[Errno -3] Temporary failure in name resolution")
             print("Check to see if you have a reliable internet connection")
             exit(1)
-        return Playlist.from_spotify(playlist_id, sp_playlist_tracks)
\ No newline at end of file
+        return playlist
\ No newline at end of file
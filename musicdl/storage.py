@@ -0,0 +1,176 @@
+import hashlib
+import re
+import os
+
+from .config import config
+
+
+# youtube video ids are 11 characters long, audio files end with _{video_id}.{ext}
+VIDEO_ID = re.compile(r"^[A-Za-z0-9_-]{11}$")
+
+# everything up to (and including) the last `audio` directory of a path
+_AUDIO_DIR = re.compile(r"^((?:.*[\\/])?audio)[\\/]")
+
+
+def shard_dir(video_id: str, width: int = None, depth: int = None) -> str:
+    """
+    directory (relative to the audio directory) for files of `video_id`
+    ```
+    shard_dir("dQw4w9WgXcQ", width=2, depth=2)  # "4b/38"
+    shard_dir("dQw4w9WgXcQ", depth=0)           # ""
+    ```
+    the first `width * depth` hex digits of sha1(video_id), split into
+    `depth` directories of `width` digits each: 16**width entries per directory
+
+    this is done for file system access reasons; individual folders
+    with many files are difficult for most file managers to work with
+    """
+    width = config["hash_width"] if width is None else width
+    depth = config["hash_depth"] if depth is None else depth
+    if not 1 <= width <= 8 or not 0 <= depth <= 4:
+        raise ValueError(f"hash width should be in [1,8] and depth in [0,4] (recieved width={width}, depth={depth})")
+    digest = hashlib.sha1(video_id.encode("utf-8")).hexdigest()
+    return "/".join(digest[i * width:(i + 1) * width] for i in range(depth))
+
+
+def layout_dir(video_id: str, hashed: bool = None, width: int = None, depth: int = None) -> str:
+    """
+    `shard_dir` if `hashed` (default: `config["hash_audio_storage"]`), otherwise ""
+    """
+    hashed = config["hash_audio_storage"] if hashed is None else hashed
+    if not hashed:
+        return ""
+    return shard_dir(video_id, width, depth)
+
+
+def video_id_from_path(audio_path: str) -> str|None:
+    """
+    `./audio/Artist_Track_dQw4w9WgXcQ.flac -> dQw4w9WgXcQ`
+    """
+    stem = os.path.splitext(os.path.basename(audio_path))[0]
+    video_id = stem[-11:]
+    return video_id if VIDEO_ID.match(video_id) else None
+
+
+def relocate(audio_path: str, video_id: str, **layout) -> str:
+    """
+    where `audio_path` belongs in the given layout (see `layout_dir`),
+    keeping whatever comes before its `audio` directory
+    ```
+    relocate("./tracks/audio/x_dQw4w9WgXcQ.flac", "dQw4w9WgXcQ", hashed=True)
+    # "./tracks/audio/4b/38/x_dQw4w9WgXcQ.flac"
+    ```
+    """
+    match = _AUDIO_DIR.match(audio_path)
+    audio_root = match.group(1) if match else os.path.join(os.path.dirname(audio_path), "audio")
+    directory = layout_dir(video_id, **layout)
+    return os.path.join(audio_root, directory, os.path.basename(audio_path)) if directory else \
+        os.path.join(audio_root, os.path.basename(audio_path))
+
+
+def locate_audio(audio_path: str, **layout) -> str:
+    """
+    `audio_path` if it exists, otherwise where the file would be after
+    `migrate_storage` (if it is there)
+    """
+    if os.path.exists(audio_path):
+        return audio_path
+    video_id = video_id_from_path(audio_path)
+    if video_id is None:
+        return audio_path
+    for hashed in (True, False):
+        candidate = relocate(audio_path, video_id, hashed=hashed, **layout)
+        if os.path.exists(candidate):
+            return candidate
+    return audio_path
+
+
+def _known_video_ids(datadir: str, db=None) -> dict[str, str]:
+    """
+    audio file name -> video id, from music.db and tracks.csv
+    """
+    known = {}
+    tracks_csv = os.path.join(datadir, "tracks.csv")
+    if os.path.exists(tracks_csv):
+        from .dataloader import iter_tracks
+        for track_info in iter_tracks(datadir, columns=["youtube_url", "audio_path"]):
+            if track_info["youtube_url"] and track_info["audio_path"]:
+                known[os.path.basename(track_info["audio_path"])] = track_info["youtube_url"][-11:]
+    if db is not None:
+        for video_id, audio_path in db.audio_paths():
+            if video_id and audio_path:
+                known[os.path.basename(audio_path)] = video_id
+    return known
+
+
+def migrate_storage(datadir: str = None, db=None, hashed: bool = None, width: int = None, depth: int = None, verbose: bool = True) -> dict[str, int]:
+    """
+    move the files in `datadir`/audio into the current layout (see `layout_dir`),
+    then update `audio_files.audio_path` in `db` (a `MusicDB`) and tracks.csv
+    ```
+    musicdl --migrate-storage
+    ```
+    every step can be repeated, so an interrupted migration is finished
+    by running it again. also works in reverse (hashed -> flat)
+
+    returns the number of files moved, already in place, and skipped
+    (unknown video id, or a different file already at the destination)
+    """
+    datadir = config["datadir"] if datadir is None else datadir
+    layout = {"hashed": hashed, "width": width, "depth": depth}
+    audio_root = os.path.join(datadir, "audio")
+    known = _known_video_ids(datadir, db)
+    stats = {"moved": 0, "in_place": 0, "skipped": 0}
+
+    files = [
+        os.path.join(root, file)
+        for root, _, filenames in os.walk(audio_root)
+        for file in filenames
+        if not file.startswith(".")
+    ]
+    for path in files:
+        file = os.path.basename(path)
+        video_id = known.get(file) or video_id_from_path(file)
+        if video_id is None:
+            if verbose: print(f"skipping {path}: no video id")
+            stats["skipped"] += 1
+            continue
+        destination = relocate(path, video_id, **layout)
+        if os.path.normpath(destination) == os.path.normpath(path):
+            stats["in_place"] += 1
+            continue
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        if os.path.exists(destination):
+            if os.path.getsize(destination) != os.path.getsize(path):
+                if verbose: print(f"skipping {path}: {destination} already exists")
+                stats["skipped"] += 1
+                continue
+            os.remove(path)
+        else:
+            os.replace(path, destination)
+        stats["moved"] += 1
+
+    # remove directories emptied by the move
+    for root, dirs, filenames in os.walk(audio_root, topdown=False):
+        if root != audio_root and not os.listdir(root):
+            os.rmdir(root)
+
+    def new_path(video_id: str|None, audio_path: str|None) -> str|None:
+        if not audio_path:
+            return audio_path
+        video_id = known.get(os.path.basename(audio_path)) or video_id or video_id_from_path(audio_path)
+        return relocate(audio_path, video_id, **layout) if video_id else audio_path
+
+    if db is not None:
+        stats["db_rows"] = db.relocate_audio(new_path)
+    tracks_csv = os.path.join(datadir, "tracks.csv")
+    if os.path.exists(tracks_csv):
+        from .containers import tracks_csv_journal
+        def update_row(row: dict) -> dict:
+            video_id = (row.get("youtube_url") or "")[-11:] or None
+            row["audio_path"] = new_path(video_id, row.get("audio_path"))
+            return row
+        stats["csv_rows"] = tracks_csv_journal(tracks_csv).update_rows(update_row)
+    if verbose:
+        print(", ".join(f"{value} {name.replace('_', ' ')}" for name, value in stats.items()))
+    return stats
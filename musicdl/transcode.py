@@ -0,0 +1,199 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+import subprocess
+import functools
+import threading
+import time
+import os
+
+import ffmpeg
+
+
+# output formats and the ffmpeg arguments used to encode them
+CODEC_ARGS = {
+    "mp3": ["-c:a", "libmp3lame"],
+    "flac": ["-c:a", "flac"],
+    "wav": ["-c:a", "pcm_s16le"],
+    "opus": ["-c:a", "libopus", "-b:a", "160k"],
+    "m4a": ["-c:a", "aac", "-b:a", "192k"],
+}
+
+# formats that keep YouTube's (lossy) audio stream as is when possible:
+# "native" keeps whatever container yt-dlp downloaded (usually webm or m4a),
+# "opus" / "m4a" remux the stream if it already has a matching codec
+PASSTHROUGH_FORMATS = ("native", "opus", "m4a")
+AUDIO_FORMATS = ("mp3", "wav", "flac", *PASSTHROUGH_FORMATS)
+
+# yt-dlp format selection, prefer a stream that doesn't need re-encoding
+FORMAT_SELECTORS = {
+    "opus": "bestaudio[acodec=opus]/bestaudio/best",
+    "m4a": "bestaudio[ext=m4a]/bestaudio/best",
+}
+DEFAULT_FORMAT_SELECTOR = "bestaudio/best"
+
+# codecs that can be copied into each container without re-encoding
+COPY_CODECS = {
+    "opus": {"opus"},
+    "m4a": {"aac", "alac"},
+    "mp3": {"mp3"},
+    "flac": {"flac"},
+}
+
+# codec implied by a file extension, the rest have to be probed
+EXTENSION_CODECS = {"mp3": "mp3", "flac": "flac", "wav": "pcm_s16le", "opus": "opus"}
+
+NATIVE_EXTENSIONS = ("webm", "m4a", "opus", "ogg", "mka", "mp4")
+
+
+def format_selector(audio_format: str) -> str:
+    return FORMAT_SELECTORS.get(audio_format, DEFAULT_FORMAT_SELECTOR)
+
+
+class TranscodeError(RuntimeError):
+    """Exception raised when ffmpeg fails to convert a downloaded audio stream."""
+    def __init__(self, source: str, stderr: str):
+        self.source = source
+        self.stderr = stderr
+        super().__init__(f"ffmpeg failed to convert {source}:\n{stderr}")
+
+
+@functools.cache
+def ffmpeg_path() -> str:
+    """
+    location of the static ffmpeg binary installed with `ffmpeg-binaries`
+    """
+    ffmpeg.init()
+    return str(ffmpeg.FFMPEG_PATH)
+
+
+@functools.cache
+def ffprobe_path() -> str:
+    ffmpeg.init()
+    return str(ffmpeg.FFPROBE_PATH)
+
+
+def probe_codec(path: str) -> str|None:
+    """
+    codec of the first audio stream in `path` (e.g. "opus", "aac"), None if there isn't one
+    """
+    cmd = [ffprobe_path(), "-v", "error", "-select_streams", "a:0",
+           "-show_entries", "stream=codec_name", "-of", "default=noprint_wrappers=1:nokey=1", path]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    codec = result.stdout.strip()
+    return codec or None
+
+
+@functools.lru_cache(maxsize=4096)
+def _probe_codec_cached(path: str, mtime_ns: int) -> str|None:
+    return probe_codec(path)
+
+
+def describe_audio(path: str|None) -> tuple[str|None, str|None]:
+    """
+    (container, codec) of an audio file, e.g. ("m4a", "aac"); the container
+    is the file extension, the codec is only probed when the extension
+    doesn't determine it
+    """
+    if not path:
+        return None, None
+    container = os.path.splitext(path)[1].lstrip(".").lower() or None
+    codec = EXTENSION_CODECS.get(container)
+    if codec is None and os.path.exists(path):
+        codec = _probe_codec_cached(path, os.stat(path).st_mtime_ns)
+    return container, codec
+
+
+def transcode(source: str, outputs: list[str]):
+    """
+    decode `source` once and encode it to every path in `outputs`,
+    the format of each output is based on its extension (see `CODEC_ARGS`)
+
+    the audio stream is copied instead of re-encoded when the output's
+    container supports its codec (see `COPY_CODECS`), or when the output
+    has the same extension as `source` ("native")
+
+    each output is written next to its destination and renamed into place
+    """
+    source_extension = os.path.splitext(source)[1].lstrip(".").lower()
+    source_codec = None
+    cmd = [ffmpeg_path(), "-y", "-nostdin", "-loglevel", "error", "-i", source]
+    partial = []
+    for output in outputs:
+        extension = os.path.splitext(output)[1].lstrip(".").lower()
+        if extension == source_extension:
+            codec_args = ["-c:a", "copy"]
+        else:
+            if extension not in CODEC_ARGS:
+                raise ValueError(f"Must use either {', '.join(map(repr, CODEC_ARGS))} (recieved {extension})")
+            if extension in COPY_CODECS and source_codec is None:
+                source_codec = probe_codec(source)
+            codec_args = ["-c:a", "copy"] if source_codec in COPY_CODECS.get(extension, ()) else CODEC_ARGS[extension]
+        directory, filename = os.path.split(output)
+        os.makedirs(directory or ".", exist_ok=True)
+        tmp_path = os.path.join(directory, f".{filename}.part.{extension}")
+        partial.append(tmp_path)
+        cmd += ["-map", "0:a:0", "-vn", *codec_args, tmp_path]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        for tmp_path in partial:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise TranscodeError(source, result.stderr.strip())
+    for tmp_path, output in zip(partial, outputs):
+        os.replace(tmp_path, output)
+
+
+class Transcoder:
+    """
+    Pool that converts downloaded audio streams, sized to the number of cores
+    ```
+    transcoder = Transcoder()
+    future = transcoder.submit("./tracks/.staging/dQw4w9WgXcQ.webm", ["./tracks/audio/x.flac", "./tracks/audio/x.mp3"])
+    future.result()  # raises TranscodeError if ffmpeg failed
+    print(transcoder)
+    ```
+    the encoding itself happens in ffmpeg processes, the threads of the pool
+    only wait on them, so they don't hold up downloads (or each other)
+
+    `remove_source = True`: delete the downloaded stream once it has been converted
+    """
+    def __init__(self, workers: int = None, remove_source: bool = True):
+        self.workers = workers or os.cpu_count() or 1
+        self.remove_source = remove_source
+        self.stats = {"files": 0, "outputs": 0, "failed": 0, "seconds": 0.0}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="transcode")
+
+    def _run(self, source: str, outputs: list[str]) -> list[str]:
+        start = time.perf_counter()
+        try:
+            transcode(source, outputs)
+        except Exception:
+            with self._lock:
+                self.stats["failed"] += 1
+            raise
+        finally:
+            if self.remove_source and os.path.exists(source):
+                os.remove(source)
+        with self._lock:
+            self.stats["files"] += 1
+            self.stats["outputs"] += len(outputs)
+            self.stats["seconds"] += time.perf_counter() - start
+        return outputs
+
+    def submit(self, source: str, outputs: list[str]) -> Future:
+        return self._executor.submit(self._run, source, outputs)
+
+    def run(self, source: str, outputs: list[str]) -> list[str]:
+        """
+        `submit` and wait for the result
+        """
+        return self.submit(source, outputs).result()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __str__(self):
+        files = self.stats["files"]
+        mean = self.stats["seconds"] / files if files else 0
+        return (f"{files} files converted to {self.stats['outputs']} outputs "
+                f"({mean:.1f}s each, {self.workers} workers), {self.stats['failed']} failed")
@@ -1,10 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from sqlite3 import Cursor
-from copy import deepcopy as copy
 from urllib.parse import quote
 from pathlib import Path
-import urllib.request
 import subprocess
+import functools
+import threading
 import platform
+import shutil
+import queue
+import json
 import time
 import re
 import os
@@ -18,7 +23,16 @@ import ffmpeg
 
 
 from .containers import Track, Playlist, Album, Artist, TrackContainer, update_csv, format_for_zip
+from .storage import shard_dir
+from .transcode import Transcoder, TranscodeError, transcode, AUDIO_FORMATS, NATIVE_EXTENSIONS, DEFAULT_FORMAT_SELECTOR, format_selector, describe_audio
+from .ratelimit import youtube_limiter, status_from_error, THROTTLE_STATUS
+from .cache import SearchCache
+from .db import MusicDB, lookup_audio, lookup_video
 from .config import config
+from . import httpclient
+
+# see SPTrackDownloader(reuse_audio=...)
+REUSE_MODES = ("share", "hardlink", "copy", "none")
 
 #cookies = io.StringIO(
     #"# Netscape HTTP Cookie File\n"
@@ -37,36 +51,267 @@ from .config import config
     #)
 
 
-def ytdlp_wrapper(url: str, download_path: str):
+def _extract(ydl: yt_dlp.YoutubeDL, url: str) -> tuple[str, dict]:
+    info = ydl.extract_info(url, download=True)
+    downloads = info.get("requested_downloads") or [{}]
+    return downloads[0].get("filepath") or ydl.prepare_filename(info), info
+
+
+class YtdlpSession:
     """
-    `download_path: ./tracks/audios/song.wav`
+    A single `yt_dlp.YoutubeDL` reused for many downloads, so that
+    extractor setup, YouTube's player / signature code, cookies and
+    open connections carry over from one track to the next
+    ```
+    session = YtdlpSession()
+    staged_path = session.fetch("https://www.youtube.com/watch?v=dQw4w9WgXcQ", "./tracks/.staging")
+    session.close()
+    ```
+    the output template and format selection are set for each download;
+    `YoutubeDL` isn't thread safe, so one session is used by one thread at
+    a time (see `YtdlpSessionPool`)
+
+    setting them means reaching into `YoutubeDL` (`params['outtmpl']`,
+    `format_selector`); with a yt-dlp release that doesn't have these,
+    `reusable` is False and each download gets a new `YoutubeDL` instead
 
-    Download mp3, wav, or flac from `url` to `download_path`
+    `params`: extra `YoutubeDL` options (e.g. `{"cookiefile": "./cookies.txt"}`)
     """
-    root, extension = os.path.splitext(download_path)
-    extension = extension.lstrip(".")
-    ffmpeg.init()
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'quiet': True,
-        'outtmpl': root,
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': extension,
-        }],
-        'ffmpeg_location': str(ffmpeg.FFMPEG_PATH),
-    }
-    #if os.path.exists("./cookies.txt"):
-        #ydl_opts["cookiefile"] = "./cookies.txt"
+    def __init__(self, params: dict = None):
+        ffmpeg.init()
+        ydl_opts = {
+            'format': DEFAULT_FORMAT_SELECTOR,
+            'quiet': True,
+            'noprogress': True,
+            'ffmpeg_location': str(ffmpeg.FFMPEG_PATH),
+        }
+        if params is not None:
+            ydl_opts.update(params)
+        self.ydl_opts = ydl_opts
+        self.ydl = yt_dlp.YoutubeDL(ydl_opts)
+        self.reusable = (isinstance(self.ydl.params.get('outtmpl'), dict) and hasattr(self.ydl, 'format_selector')
+                         and callable(getattr(self.ydl, 'build_format_selector', None)))
+        # compiled format selectors, building one means parsing the selector
+        self._selectors = {}
+        self._lock = threading.Lock()
+        self.stats = {"downloads": 0, "seconds": 0.0}
+
+    def _selector(self, format: str):
+        if format not in self._selectors:
+            self._selectors[format] = self.ydl.build_format_selector(format)
+        return self._selectors[format]
+
+    def fetch(self, url: str, staging_dir: str, format: str = DEFAULT_FORMAT_SELECTOR) -> str:
+        """
+        Download the best audio stream of `url` to `staging_dir` as is
+        (no conversion, see `musicdl.transcode`), returns the path of the stream
+
+        `format`: yt-dlp format selection (see `musicdl.transcode.format_selector`)
+        """
+        return self.extract(url, staging_dir, format)[0]
+
+    def extract(self, url: str, staging_dir: str, format: str = DEFAULT_FORMAT_SELECTOR) -> tuple[str, dict]:
+        """
+        `fetch`, also returning the metadata yt-dlp extracted for the download
+        (title, uploader, duration, chosen format, ... see `track_info_from`)
+        """
+        outtmpl = os.path.join(staging_dir, '%(id)s.%(ext)s')
+        with self._lock:
+            start = time.perf_counter()
+            if self.reusable:
+                self.ydl.params['outtmpl']['default'] = outtmpl
+                self.ydl.format_selector = self._selector(format)
+                staged_path, info = _extract(self.ydl, url)
+            else:
+                with yt_dlp.YoutubeDL({**self.ydl_opts, 'format': format, 'outtmpl': outtmpl}) as ydl:
+                    staged_path, info = _extract(ydl, url)
+            self.stats["downloads"] += 1
+            self.stats["seconds"] += time.perf_counter() - start
+            return staged_path, info
+
+    def download(self, url: str, download_path: str, staging_dir: str = None) -> str:
+        """
+        download the audio of `url` and convert it to
+        `download_path`, returns the path of the audio file (the extension
+        of "native" downloads depends on the stream)
+
+        `staging_dir`: where the stream is downloaded to before being converted
+        (default: `.staging` next to `download_path`)
+        """
+        root, extension = os.path.splitext(download_path)
+        extension = extension.lstrip(".")
+        if staging_dir is None:
+            staging_dir = os.path.join(os.path.dirname(download_path), ".staging")
+        staged_path = self.fetch(url, staging_dir, format_selector(extension))
+        if extension == "native":
+            download_path = root + os.path.splitext(staged_path)[1]
+        try:
+            transcode(staged_path, [download_path])
+        finally:
+            os.remove(staged_path)
+        return download_path
+
+    def close(self):
+        with self._lock:
+            self.ydl.close()
+
+    def __str__(self):
+        downloads = self.stats["downloads"]
+        mean = self.stats["seconds"] / downloads if downloads else 0
+        return f"{downloads} downloads ({mean:.1f}s each)"
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
+
+class YtdlpSessionPool:
+    """
+    `YtdlpSession`s shared by the threads downloading tracks
+    ```
+    pool = YtdlpSessionPool()
+    staged_path = pool.fetch(url, "./tracks/.staging")  # same as YtdlpSession.fetch
+    with pool.session() as session:
+        session.download(url, "./tracks/audio/song.flac")
+    pool.close()
+    ```
+    sessions are created the first time they are needed and kept around,
+    so there are as many as the highest number of concurrent downloads
+
+    `max_sessions`: once reached, threads wait for a session to be returned
+    """
+    def __init__(self, max_sessions: int = None, params: dict = None):
+        self.max_sessions = max_sessions
+        self.params = params
+        self.sessions: list[YtdlpSession] = []
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def session(self):
+        session = self._checkout()
+        try:
+            yield session
+        finally:
+            self._idle.put(session)
+
+    def _checkout(self) -> YtdlpSession:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self.max_sessions is None or len(self.sessions) < self.max_sessions
+            if create:
+                session = YtdlpSession(self.params)
+                self.sessions.append(session)
+                return session
+        return self._idle.get()
+
+    def fetch(self, url: str, staging_dir: str, format: str = DEFAULT_FORMAT_SELECTOR) -> str:
+        with self.session() as session:
+            return session.fetch(url, staging_dir, format)
+
+    def extract(self, url: str, staging_dir: str, format: str = DEFAULT_FORMAT_SELECTOR) -> tuple[str, dict]:
+        with self.session() as session:
+            return session.extract(url, staging_dir, format)
+
+    def download(self, url: str, download_path: str, staging_dir: str = None) -> str:
+        with self.session() as session:
+            return session.download(url, download_path, staging_dir)
+
+    def close(self):
+        with self._lock:
+            for session in self.sessions:
+                session.close()
+
+    def __str__(self):
+        downloads = sum(session.stats["downloads"] for session in self.sessions)
+        seconds = sum(session.stats["seconds"] for session in self.sessions)
+        mean = seconds / downloads if downloads else 0
+        return f"{downloads} downloads ({mean:.1f}s each) over {len(self.sessions)} yt-dlp sessions"
+
+
+def find_native(root: str) -> str|None:
+    """
+    the file downloaded to `root` with audio_format="native", whatever its extension
+    """
+    for extension in NATIVE_EXTENSIONS:
+        if os.path.exists(f"{root}.{extension}"):
+            return f"{root}.{extension}"
+    return None
+
+
+def _audio_formats(audio_format: str|list[str]) -> list[str]:
+    """
+    validated list of formats from `audio_format="flac"` or `audio_format=["flac", "mp3"]`
+    """
+    audio_formats = [audio_format] if isinstance(audio_format, str) else list(audio_format)
+    audio_formats = [audio_format.lower().lstrip(".") for audio_format in audio_formats]
+    if not audio_formats:
+        raise ValueError(f"Must use at least one of {', '.join(map(repr, AUDIO_FORMATS))}")
+    for audio_format in audio_formats:
+        if audio_format not in AUDIO_FORMATS:
+            raise ValueError(f"Must use either {', '.join(map(repr, AUDIO_FORMATS))} (recieved {audio_format})")
+    if "native" in audio_formats[1:]:
+        raise ValueError("'native' has to be the first audio format")
+    return list(dict.fromkeys(audio_formats))
+
+
+def _outputs(audio_path: str, audio_formats: list[str]) -> list[str]:
+    """
+    `audio_path` with the extension of each of `audio_formats` ("native" keeps the one it has)
+    """
+    root, extension = os.path.splitext(audio_path)
+    outputs = [f"{root}.{extension.lstrip('.') if audio_format == 'native' else audio_format}" for audio_format in audio_formats]
+    return list(dict.fromkeys(outputs))
+
+
+def throttled_download(ytdlp, url: str, download_path: str):
+    """
+    run `ytdlp(url, download_path)` through the shared YouTube rate limiter,
+    returns whatever `ytdlp` returns
+    """
+    youtube_limiter.acquire()
+    try:
+        result = ytdlp(url, download_path)
+    except yt_dlp.utils.DownloadError as e:
+        if status_from_error(e) in THROTTLE_STATUS:
+            youtube_limiter.failure()
+        raise
+    youtube_limiter.success()
+    return result
+
+
+# metadata of a download that is recorded in tracks.csv (see `track_info_from`)
+INFO_FIELDS = ("title", "uploader", "channel", "thumbnail", "duration", "channel_id", "upload_date", "format_id", "abr", "acodec")
+
+
+def track_info_from(youtube_url: str, info: dict, audio_path: str = "") -> dict:
+    """
+    track_info of a download, from the metadata yt-dlp extracted for it
+    (see `YtdlpSession.extract`), no extra request needed
+    """
+    return {
+        "youtube_url": youtube_url,
+        "title": info.get("title"),
+        "artist": info.get("uploader") or info.get("channel"),
+        "artwork_url": info.get("thumbnail"),
+        "audio_path": audio_path,
+        "duration_s": info.get("duration"),
+        "channel_id": info.get("channel_id"),
+        "upload_date": info.get("upload_date"),
+        "format_id": info.get("format_id"),
+        "abr": info.get("abr"),
+        "acodec": info.get("acodec"),
+    }
 
 
 def to_track_info(youtube_url: str, audio_path: str = "") -> dict:
+    """
+    title, channel name and thumbnail of `youtube_url` from YouTube's oEmbed endpoint
+    """
     track_info = {}
     url = f"https://www.youtube.com/oembed?format=json&url={youtube_url}"
-    response = requests.get(url)
+    youtube_limiter.acquire()
+    response = httpclient.get(url)
+    youtube_limiter.report(response)
     json_data = response.json()
     track_info["youtube_url"] = youtube_url
     track_info["title"] = json_data["title"]
@@ -80,7 +325,7 @@ class YoutubeDownloader:
     ```
     ydl = YoutubeDownloader(
             audio_directory = "./tracks" # where to save audio to
-            audio_format = "wav"         # mp3, wav, or flac
+            audio_format = "wav"         # mp3, wav, flac, or native / opus / m4a, or a list of them
             )
 
     tracks_info = ydl.download([
@@ -92,30 +337,54 @@ class YoutubeDownloader:
     #   'youtube_url': 'https://www.youtube.com/watch?v=TqxfdNm4gZQ'
     #   'title': 'Brad Mehldau - The Garden'
     #   'artist': 'Nonesuch Records'
-    #   'artwork_url': 'https://i.ytimg.com/vi/TqxfdNm4gZQ/hqdefault.jpg'
+    #   'artwork_url': 'https://i.ytimg.com/vi/TqxfdNm4gZQ/maxresdefault.jpg'
     #   'audio_path': './audio/BradMehldauTheGarden_NonsuchRecords.wav'
+    #   'duration_s': 378
+    #   'channel_id': 'UC...'
+    #   'upload_date': '20220329'
+    #   'format_id': '251'
+    #   'abr': 135.2
+    #   'acodec': 'opus'
+    #   'container': 'wav'
+    #   'codec': 'pcm_s16le'
     # }
 
     ydl.set_audio_directory("./tracks2")
     ydl.set_audio_format("mp3")
     ```
+    the metadata comes from the same yt-dlp extraction that downloads the audio
+
+    with a list of formats (e.g. `["flac", "mp3"]`), every format is converted
+    from a single download and the first one is recorded as `audio_path`
+
+    `oembed_fallback = True`: ask YouTube's oEmbed endpoint for the title /
+    channel name if yt-dlp didn't return them
+
+    `transcoder`: `Transcoder` pool that converts the downloaded streams
+    (default: a new one with a worker per core)
     """
-    def __init__(self, audio_directory=".", audio_format="flac", use_ytdlp_cli=False):
+    def __init__(self, audio_directory=".", audio_format="flac", use_ytdlp_cli=False, sessions: YtdlpSessionPool = None,
+                 oembed_fallback: bool = True, transcoder: Transcoder = None):
         self.audio_format = ""
+        self.audio_formats = []
         self.audio_directory = ""
         self.set_audio_format(audio_format)
         self.set_audio_directory(audio_directory)
-        self.ytdlp = ytdlpcli_wrapper if use_ytdlp_cli else ytdlp_wrapper
+        # yt-dlp sessions are kept between downloads (see YtdlpSession)
+        self.sessions = None if use_ytdlp_cli else (sessions if sessions is not None else YtdlpSessionPool())
+        self.extract = ytdlpcli_extract if use_ytdlp_cli else self.sessions.extract
+        self.oembed_fallback = oembed_fallback
+        self.transcoder = transcoder if transcoder is not None else Transcoder()
 
-    def set_audio_format(self, audio_format: str):
-        audio_format = audio_format.lower().lstrip(".")
-        if audio_format not in ["mp3", "wav", "flac"]:
-            raise ValueError(f"Must use either 'mp3', 'wav', or 'flac' (recieved {audio_format})")
-        self.audio_format=audio_format
+    def set_audio_format(self, audio_format: str|list[str]):
+        self.audio_formats = _audio_formats(audio_format)
+        self.audio_format = self.audio_formats[0]
 
     def set_audio_directory(self, audio_directory: str):
         os.makedirs(audio_directory, exist_ok=True)
         self.audio_directory = audio_directory
+        # `download` fetches each stream into it and removes it after writing audio/
+        self.staging_directory = os.path.join(audio_directory, ".staging")
 
     def download(self, url_list: list[str], filename_list: list[str]|None = None):
         """
@@ -134,8 +403,10 @@ class YoutubeDownloader:
         #   'youtube_url': 'https://www.youtube.com/watch?v=TqxfdNm4gZQ'
         #   'title': 'Brad Mehldau - The Garden'
         #   'artist': 'Nonesuch Records'
-        #   'artwork_url': 'https://i.ytimg.com/vi/TqxfdNm4gZQ/hqdefault.jpg'
+        #   'artwork_url': 'https://i.ytimg.com/vi/TqxfdNm4gZQ/maxresdefault.jpg'
         #   'audio_path': './audio/BradMehldauTheGarden_NonsuchRecords.wav'
+        #   'duration_s': 378
+        #   ...
         # }
         ```
         """
@@ -146,21 +417,42 @@ class YoutubeDownloader:
 
         tracks_info = []
         for i, url in enumerate(url_list):
-            track_info = to_track_info(url)
+            try:
+                os.makedirs(self.staging_directory, exist_ok=True)
+                extract = functools.partial(self.extract, format=format_selector(self.audio_format))
+                staged_path, info = throttled_download(extract, url, self.staging_directory)
+            except yt_dlp.utils.DownloadError:
+                tracks_info.append({k: "" for k in ["youtube_url", "title", "artist", "artwork_url", "audio_path"]})
+                continue
+
+            track_info = track_info_from(url, info)
+            if self.oembed_fallback and not (track_info["title"] and track_info["artist"]):
+                oembed = to_track_info(url)
+                for key in ("title", "artist", "artwork_url"):
+                    track_info[key] = track_info[key] or oembed[key]
             if filename_list is not None:
                 filename = filename_list[i]
             else:
-                filename =  create_filename(track_info["title"], track_info["artist"], self.audio_format)
+                # the name is only known once yt-dlp has extracted the metadata
+                filename = create_filename(track_info["title"] or "", track_info["artist"] or "", self.audio_format)
             audio_path = os.path.join(self.audio_directory, "audio", filename)
+            if self.audio_format == "native":
+                # the extension depends on the downloaded codec
+                audio_path = os.path.splitext(audio_path)[0] + os.path.splitext(staged_path)[1]
 
             try:
-                time.sleep(2)
-                self.ytdlp(url, audio_path)
-                track_info["audio_path"] = format_for_zip(audio_path)
-                tracks_info.append(track_info)
-            except yt_dlp.utils.DownloadError:
+                self.transcoder.run(staged_path, _outputs(audio_path, self.audio_formats))
+            except TranscodeError as e:
+                print(e)
                 tracks_info.append({k: "" for k in ["youtube_url", "title", "artist", "artwork_url", "audio_path"]})
                 continue
+            finally:
+                # the transcoder usually removes it already
+                if os.path.exists(staged_path):
+                    os.remove(staged_path)
+            track_info["audio_path"] = format_for_zip(audio_path)
+            track_info["container"], track_info["codec"] = describe_audio(audio_path)
+            tracks_info.append(track_info)
 
         update_csv(os.path.join(self.audio_directory, "tracks.csv"), tracks_info)
         return tracks_info
@@ -196,18 +488,100 @@ class YoutubeSearchError(requests.exceptions.ConnectionError):
             return f"{self.message}\nSearch query:\n{self.search_query}\nTrack:\n{str(self.track)}"
         return self.message
 
-def ytdlpcli_wrapper(url: str, download_path: str):
+def ytdlpcli_fetch(url: str, staging_dir: str, format: str = DEFAULT_FORMAT_SELECTOR) -> str:
+    """
+    `YtdlpSession.fetch` using the yt-dlp cli
     """
-    `download_path: ./tracks/song.wav`
+    return ytdlpcli_extract(url, staging_dir, format)[0]
 
-    Download mp3 or wav from `url` to `download_path`
+def ytdlpcli_extract(url: str, staging_dir: str, format: str = DEFAULT_FORMAT_SELECTOR) -> tuple[str, dict]:
+    """
+    `YtdlpSession.extract` using the yt-dlp cli, the metadata only has the fields in `INFO_FIELDS`
     """
-    root, audio_format = os.path.splitext(download_path)
-    audio_format = audio_format.lstrip(".")
     yt_dlp_cmd = install_ytdlpcli()
-    yt = [yt_dlp_cmd, '--extract-audio', '--audio-format', audio_format, '--quiet', '--no-warnings', '--progress', '--output', download_path, url]
-    output = subprocess.run(yt, capture_output=False, text=True)
+    yt = [yt_dlp_cmd, '--format', format, '--quiet', '--no-warnings', '--no-progress',
+          '--print', f'after_move:%(.{{{",".join(INFO_FIELDS)},filepath}})j',
+          '--output', os.path.join(staging_dir, '%(id)s.%(ext)s'), url]
+    output = subprocess.run(yt, capture_output=True, text=True)
+    if output.returncode != 0 or not output.stdout.strip():
+        # same exception as the python version, so 403/429s reach the rate limiter
+        raise yt_dlp.utils.DownloadError(output.stderr.strip())
+    info = json.loads(output.stdout.strip().splitlines()[-1])
+    return info.pop("filepath"), info
+
+def _video_id(url: str) -> str:
+    match = re.search(r"v=([A-Za-z0-9_-]{11})", url)
+    return match.group(1) if match else url
+
 
+def ytdlpcli_fetch_batch(urls: list[str], staging_dir: str, format: str = DEFAULT_FORMAT_SELECTOR, sleep_interval: float = 0) -> dict[str, str|Exception]:
+    """
+    `ytdlpcli_fetch` for many urls with a single run of the yt-dlp cli
+    (starting the binary takes a few seconds)
+    ```
+    results = ytdlpcli_fetch_batch(urls, "./tracks/.staging")
+    results[urls[0]]  # path of the downloaded stream, or the DownloadError if it failed
+    ```
+    the urls are passed in a batch file and each stream is written to
+    `staging_dir/{video id}.{ext}`; yt-dlp prints a json line for every
+    finished download and an ERROR line for every failed one, which is how
+    the results are mapped back onto `urls`
+
+    `sleep_interval`: seconds yt-dlp waits before each download
+    """
+    os.makedirs(staging_dir, exist_ok=True)
+    by_id = {_video_id(url): url for url in urls}
+    batch_file = os.path.join(staging_dir, f".batch-{os.getpid()}-{threading.get_ident()}.txt")
+    with open(batch_file, "w") as f:
+        f.write("\n".join(urls) + "\n")
+    yt_dlp_cmd = install_ytdlpcli()
+    yt = [yt_dlp_cmd, '--format', format, '--ignore-errors', '--no-warnings', '--no-progress',
+          '--print', 'after_move:%(.{id,filepath})j', '--output', os.path.join(staging_dir, '%(id)s.%(ext)s'),
+          '--batch-file', batch_file]
+    if sleep_interval > 0:
+        yt += ['--sleep-interval', f"{sleep_interval:.3f}"]
+    try:
+        output = subprocess.run(yt, capture_output=True, text=True)
+    finally:
+        os.remove(batch_file)
+
+    results = {}
+    for line in output.stdout.splitlines():
+        try:
+            info = json.loads(line)
+        except ValueError:
+            continue
+        if info.get("id") in by_id and info.get("filepath"):
+            results[by_id[info["id"]]] = info["filepath"]
+    errors = {}
+    for line in output.stderr.splitlines():
+        # ERROR: [youtube] dQw4w9WgXcQ: Video unavailable
+        match = re.match(r"ERROR: \[[^\]]+\] ([A-Za-z0-9_-]{11}): ", line)
+        if match and match.group(1) in by_id:
+            errors[by_id[match.group(1)]] = line
+    for url in urls:
+        if url not in results:
+            # this video's ERROR line if yt-dlp printed one, otherwise all of stderr
+            results[url] = yt_dlp.utils.DownloadError(errors.get(url) or output.stderr.strip() or f"{url} was not downloaded")
+    return results
+
+
+def throttled_batch(urls: list[str], staging_dir: str, format: str = DEFAULT_FORMAT_SELECTOR) -> dict[str, str|Exception]:
+    """
+    `ytdlpcli_fetch_batch` through the shared YouTube rate limiter: a token is
+    taken before yt-dlp starts, then yt-dlp waits 1 / rate seconds before each
+    download, so a batch is paced like the same number of separate downloads
+    """
+    youtube_limiter.acquire()
+    results = ytdlpcli_fetch_batch(urls, staging_dir, format, sleep_interval=1 / youtube_limiter.rate)
+    if any(isinstance(result, Exception) and status_from_error(result) in THROTTLE_STATUS for result in results.values()):
+        youtube_limiter.failure()
+    else:
+        youtube_limiter.success()
+    return results
+
+
+@functools.cache
 def install_ytdlpcli() -> str:
     """
     returns the location of the yt-dlp cli (platform dependent)
@@ -215,6 +589,7 @@ def install_ytdlpcli() -> str:
     ensures that yt-dlp is installed to user cache directory
 
     if ytdlp isn't installed, this installs it from the github latest release
+    (the result is cached, so the cache directory is only checked once)
 
     yt-dlp can be uninstalled with uninstall_ytdlpcli()
     """
@@ -234,11 +609,11 @@ def install_ytdlpcli() -> str:
     if not os.path.exists(binary_path):
         print(f"Downloading {binary} to {binary_path}...")
         try:
-            urllib.request.urlretrieve(
+            httpclient.download_file(
                 f"https://github.com/yt-dlp/yt-dlp/releases/latest/download/{binary}",
                 binary_path
             )
-        except urllib.error.URLError as e:
+        except requests.exceptions.RequestException as e:
             #print(str(e))
             print("[Errno -3] Temporary failure in name resolution")
             print("Check to see if you have a reliable internet connection")
@@ -259,11 +634,16 @@ def uninstall_ytdlpcli():
         raise RuntimeError(f"Unsupported platform: {system}")
     cache_dir = os.path.abspath(user_cache_dir("musicdl"))
     binary_path = os.path.abspath(os.path.join(cache_dir, binary))
+    install_ytdlpcli.cache_clear()
     if os.path.exists(binary_path):
         os.remove(binary_path)
-        os.rmdir(cache_dir)
         print(f"rm {binary_path}")
-        print(f"rmdir {cache_dir}")
+        try:
+            # also holds the search cache, see musicdl.cache
+            os.rmdir(cache_dir)
+            print(f"rmdir {cache_dir}")
+        except OSError:
+            pass
     else:
         print(f"Already uninstalled {cache_dir}")
 
@@ -288,76 +668,312 @@ class SPTrackDownloader:
     track.audio_path
     ```
     """
-    def __init__(self, cursor: 'Cursor' = None, audio_format: str = "wav", ytdlp_version: str = "py", audio_directory: str = "./tracks"):
+    def __init__(self, cursor: 'Cursor' = None, audio_format: str|list[str] = "wav", ytdlp_version: str = "py", audio_directory: str = "./tracks", workers: int = 1, db_lock: threading.Lock = None,
+                 search_cache: SearchCache = None, refresh_search: bool = False, reuse_audio: str = None, transcoder: Transcoder = None,
+                 sessions: YtdlpSessionPool = None, batch_size: int = None, db: MusicDB = None):
         """
+        audio_format: 'mp3', 'wav', 'flac', or a list of them (e.g. ["flac", "mp3"]);
+                 every format is converted from a single download, the first
+                 one is recorded as the track's audio_path
+
         ytdlp_version: either 'py' or 'cli'
                 - py uses the yt-dlp python package, with static version of ffmpeg
                 - cli uses the cli version from github (autoinstalls)
+
+        workers: number of tracks to search for / download at the same time
+                 when adding audio to an Album, Playlist, or Artist
+
+        db_lock: lock guarding `cursor`, shared with whatever else writes to the
+                 same sqlite connection (see `MusicDB.lock`)
+
+
+        search_cache: optional `SearchCache` used to skip repeated YouTube searches
+
+        refresh_search: ignore (but still update) cached search results
+
+        reuse_audio: when a track resolves to a video that was already downloaded
+                 (single vs album version, the same song in several playlists):
+                - "share" uses the existing audio file as the track's audio_path
+                - "hardlink" / "copy" give the track its own file without downloading it again
+                - "none" downloads it again
+                 (default: `config["reuse_audio"]`)
+
+        transcoder: `Transcoder` pool that converts the downloaded streams
+                 (default: a new one with a worker per core)
+
+        sessions: `YtdlpSessionPool` used with ytdlp_version='py', so that yt-dlp
+                 isn't set up again for every track (default: a new one)
+
+        batch_size: with ytdlp_version='cli', number of tracks downloaded by a single run
+                 of the yt-dlp cli (default: `config["ytdlp_batch_size"]`)
+
+        db: `MusicDB` to look tracks / videos up in instead of `cursor`, so that
+                 tracks it is still buffering are written (and found) first
         """
-        self.cursor = cursor
+        reuse_audio = config["reuse_audio"] if reuse_audio is None else reuse_audio
+        if reuse_audio not in REUSE_MODES:
+            raise ValueError(f"Must use either {', '.join(map(repr, REUSE_MODES))} (recieved {reuse_audio})")
+        self.reuse_audio = reuse_audio
+        self.db = db
+        self.cursor = db.cursor if db is not None else cursor
         self.audio_format = ""
+        self.audio_formats = []
         self.set_audio_format(audio_format)
-        self.ytdlp = ytdlp_wrapper if ytdlp_version == "py" else ytdlpcli_wrapper
+        self.sessions = None
+        if ytdlp_version == "py":
+            self.sessions = sessions if sessions is not None else YtdlpSessionPool()
+            self.fetch = self.sessions.fetch
+        else:
+            self.fetch = ytdlpcli_fetch
+        batch_size = config["ytdlp_batch_size"] if batch_size is None else batch_size
+        # the python version doesn't have any startup cost to spread out
+        self.batch_size = max(1, int(batch_size)) if ytdlp_version == "cli" else 1
+        self.transcoder = transcoder if transcoder is not None else Transcoder()
         self.audio_directory = os.path.join(audio_directory, "audio")
+        # downloaded streams wait here until they have been converted
+        self.staging_directory = os.path.join(audio_directory, ".staging")
+        self.workers = max(1, int(workers))
+        self.search_cache = search_cache
+        self.refresh_search = refresh_search
+        self._db_lock = db.lock if db is not None else (db_lock if db_lock is not None else threading.Lock())
+        # two tracks can resolve to the same video (same song on an album and a single),
+        # only one of them downloads it
+        self._video_locks: dict[str, threading.Lock] = {}
+        self._video_locks_lock = threading.Lock()
+        # video_id -> audio_path of downloads that may not be in music.db yet
+        self._video_paths: dict[str, str] = {}
+        # video_id -> set once the downloaded stream has been converted
+        self._converting: dict[str, threading.Event] = {}
+        self.stats = {"downloaded": 0, "reused": 0}
+
 
+    def set_audio_format(self, audio_format: str|list[str]):
+        self.audio_formats = _audio_formats(audio_format)
+        self.audio_format = self.audio_formats[0]
 
-    def set_audio_format(self, audio_format: str):
-        audio_format = audio_format.lower().lstrip(".")
-        if audio_format not in ["mp3", "wav", "flac"]:
-            raise ValueError(f"Must use either 'mp3', 'wav', or 'flac' (recieved {audio_format})")
-        self.audio_format=audio_format
+    def outputs(self, audio_path: str) -> list[str]:
+        """
+        every file produced for `audio_path` (one per entry of `self.audio_formats`)
+        """
+        return _outputs(audio_path, self.audio_formats)
+
+    def _has_format(self, audio_path: str) -> bool:
+        extension = os.path.splitext(audio_path)[1].lstrip(".")
+        if self.audio_format == "native":
+            return extension in NATIVE_EXTENSIONS
+        return extension == self.audio_format
 
-    def add_audio(self, tc: TrackContainer, force_replace_existing_download=False, verbose=False) -> TrackContainer|None:
+    def add_audio(self, tc: TrackContainer, force_replace_existing_download=False, verbose=False, inplace=False) -> TrackContainer|None:
         """
         adds audio mp3(s) to a TrackContainer
+
+        by default `tc` is left untouched and a copy is returned; the copy
+        shares every unchanged object with `tc`, only tracks that get audio
+        are copied (see `Track.with_audio`)
+
+        `inplace = True`: update the tracks of `tc` directly and return `tc`
         """
         assert isinstance(tc, TrackContainer)
         if isinstance(tc, Track):
-            video_id, audio_path = retrieve_db_audio(self.cursor, tc.id)
-            if video_id is None:
-                return self._add_audio_to_track(tc, force_replace_existing_download, verbose)
-            else:
-                tc.video_id = video_id
-                tc.audio_path = audio_path
-                return tc
-        tc = copy(tc)
+            return self._add_audio_to_track(tc, force_replace_existing_download, verbose, inplace=inplace)
+        if not inplace:
+            tc = tc.shallow_copy()
         if isinstance(tc, Album) or isinstance(tc, Playlist):
-            for track_id, track in tc.tracks.items():
-                tc.tracks[track_id] = self._add_audio_to_track(track, force_replace_existing_download, verbose)
+            tc.tracks = self._add_audio_to_tracks(tc.tracks, force_replace_existing_download, verbose, inplace)
         elif isinstance(tc, Artist):
-            for album_id, album in tc.albums.items():
-                tc.albums[album_id] = self.add_audio(album, force_replace_existing_download, verbose)
+            # pool the tracks of every album together so that small albums
+            # and singles don't leave workers idle
+            tracks = {
+                (album_id, track_id): track
+                for album_id, album in tc.albums.items()
+                for track_id, track in album.tracks.items()
+            }
+            tracks = self._add_audio_to_tracks(tracks, force_replace_existing_download, verbose, inplace)
+            for (album_id, track_id), track in tracks.items():
+                tc.albums[album_id].tracks[track_id] = track
         return tc
 
-    def _add_audio_to_track(self, track: Track, force=False, verbose=False) -> Track:
+    def _add_audio_to_tracks(self, tracks: dict, force=False, verbose=False, inplace=False) -> dict:
+        """
+        adds audio to each track in `tracks`, using up to `self.workers` threads
+
+        returns a new dict with the same keys in the same order
+        """
+        # one query for the whole container instead of one per track
+        found = self.lookup_many(tracks.values())
+        cached = lambda track: found.get(track.id, (None, None))
+        if self.batch_size > 1 and len(tracks) > 1:
+            return self._add_audio_batched(tracks, force, verbose, cached, inplace)
+        if self.workers == 1 or len(tracks) <= 1:
+            return {key: self._add_audio_to_track(track, force, verbose, cached(track), inplace) for key, track in tracks.items()}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {key: pool.submit(self._add_audio_to_track, track, force, verbose, cached(track), inplace) for key, track in tracks.items()}
+            return {key: future.result() for key, future in futures.items()}
+
+    def _add_audio_batched(self, tracks: dict, force, verbose, cached, inplace) -> dict:
+        """
+        `_add_audio_to_tracks` with the yt-dlp cli: search for every track first,
+        then download `self.batch_size` videos per run of yt-dlp (see `_fetch_many`)
+        """
+        results = {}
+        missing = {}
+        for key, track in tracks.items():
+            video_id, audio_path = cached(track)
+            if video_id is None or force:
+                missing[key] = track
+            else:
+                if verbose: print(f'"{track.name}" already exists in database')
+                results[key] = self._set_audio(track, video_id, audio_path, inplace)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            video_ids = dict(zip(missing, pool.map(self._search, missing.values())))
+        audio_paths = {}
+        # streams are converted while the next batch is being downloaded
+        with ThreadPoolExecutor(max_workers=self.transcoder.workers) as pool:
+            transcoding = []
+            keys = list(missing)
+            for start in range(0, len(keys), self.batch_size):
+                chunk = keys[start:start + self.batch_size]
+                fetched = self._fetch_many([(missing[key], video_ids[key]) for key in chunk], force=force)
+                for key, result in zip(chunk, fetched):
+                    if result is None:
+                        continue
+                    if isinstance(result, Exception):
+                        print(result)
+                        audio_paths[key] = self._audio_path(missing[key], video_ids[key])
+                        continue
+                    audio_paths[key], staged_path = result
+                    if staged_path is not None:
+                        transcoding.append(pool.submit(self._transcode, video_ids[key], staged_path, audio_paths[key]))
+            for future in transcoding:
+                future.result()
+        for key, track in missing.items():
+            if key not in audio_paths:
+                # same video as another track, which has been converted by now
+                audio_paths[key] = self._download(track, video_ids[key], force=False)
+            if verbose: print(f'Audio added to "{track.name}"')
+            results[key] = self._set_audio(track, video_ids[key], audio_paths[key], inplace)
+        return {key: results[key] for key in tracks}
+
+    def lookup(self, track: Track) -> tuple[str, str] | tuple[None, None]:
+        """
+        returns the (video_id, audio_path) already recorded for `track` in music.db
+        """
+        if self.db is not None:
+            return self.db.lookup_audio([track.id]).get(track.id, (None, None))
+        with self._db_lock:
+            return retrieve_db_audio(self.cursor, track.id)
+
+    def lookup_many(self, tracks: list[Track]) -> dict[str, tuple[str, str]]:
+        """
+        `lookup` for several tracks at once, returns {track_id: (video_id, audio_path)}
+        for the tracks that are already in music.db
+        """
+        if self.db is not None:
+            return self.db.lookup_audio([track.id for track in tracks])
+        if self.cursor is None:
+            return {}
+        with self._db_lock:
+            return lookup_audio(self.cursor, [track.id for track in tracks])
+
+    def _video_lock(self, video_id: str) -> threading.Lock:
+        with self._video_locks_lock:
+            return self._video_locks.setdefault(video_id, threading.Lock())
+
+    def _count(self, stat: str):
+        with self._video_locks_lock:
+            self.stats[stat] += 1
+
+    def _find_video(self, video_id: str) -> str|None:
+        """
+        path of an existing audio file for `video_id`, if any
+        """
+        candidates = []
+        if video_id in self._video_paths:
+            candidates.append(self._video_paths[video_id])
+        if self.db is not None:
+            candidates.extend(self.db.lookup_video(video_id))
+        elif self.cursor is not None:
+            with self._db_lock:
+                candidates.extend(lookup_video(self.cursor, video_id))
+        for audio_path in candidates:
+            if self._has_format(audio_path) and os.path.exists(audio_path):
+                return audio_path
+        return None
+
+    def _reuse(self, existing_path: str, audio_path: str) -> str:
+        """
+        give a track the audio at `existing_path` according to `self.reuse_audio`
+        """
+        if self.reuse_audio == "share":
+            return existing_path
+        if self.audio_format == "native":
+            # `audio_path` still has the placeholder extension from `_audio_path`
+            audio_path = os.path.splitext(audio_path)[0] + os.path.splitext(existing_path)[1]
+        for source, output in zip(self.outputs(existing_path), self.outputs(audio_path)):
+            if os.path.exists(output) or not os.path.exists(source):
+                continue
+            if self.reuse_audio == "hardlink":
+                try:
+                    os.link(source, output)
+                    continue
+                except OSError:
+                    # different file system, or links aren't supported
+                    pass
+            shutil.copyfile(source, output)
+        return audio_path
+
+    def _add_audio_to_track(self, track: Track, force=False, verbose=False, cached: tuple = None, inplace=False) -> Track:
         """
         adds audio mp3 to track (video_id and audio_path)
+
+        `cached`: result of `lookup(track)` if already known
         """
-        track = copy(track)
-        video_id, audio_path = retrieve_db_audio(self.cursor, track.id)
+        video_id, audio_path = cached if cached is not None else self.lookup(track)
         if video_id is None or force:
             video_id = self._search(track)
             audio_path = self._download(track, video_id, force=force)
             if verbose: print(f'Audio added to "{track.name}"')
         else:
             if verbose: print(f'"{track.name}" already exists in database')
+        return self._set_audio(track, video_id, audio_path, inplace)
+
+    def _set_audio(self, track: Track, video_id: str, audio_path: str, inplace=False) -> Track:
+        container, codec = describe_audio(audio_path)
+        if not inplace:
+            return track.with_audio(video_id, audio_path, container, codec)
         track.video_id = video_id
         track.audio_path = audio_path
+        track.container = container
+        track.codec = codec
         return track
 
 
-    def _search(self, track: Track) -> str:
+    def _search(self, track: Track, max_attempts: int = 4) -> str:
         """
         obtain youtube video id by searching youtube.com and retrieving the first search result
 
+        403/429 responses are retried (up to `max_attempts` requests) after the
+        shared rate limiter has backed off
+
         returns the video id
         """
-        search_query = f"{track.name} by {track.artist_name} official audio".replace("+", "%2B").replace(" ", "+").replace('"', "%22")
+        query = f"{track.name} by {track.artist_name} official audio"
+        if self.search_cache is not None and not self.refresh_search:
+            video_id = self.search_cache.get_video_id(query)
+            if video_id is not None:
+                return video_id
+
+        search_query = query.replace("+", "%2B").replace(" ", "+").replace('"', "%22")
         search_query = quote(search_query, safe="+")
 
         search_url = "https://www.youtube.com/results?search_query=" + search_query
 
-        request = requests.get(search_url)
+        for _ in range(max_attempts):
+            youtube_limiter.acquire()
+            request = httpclient.get(search_url)
+            if youtube_limiter.report(request):
+                break
         if request.status_code != 200:
             print(request.status_code)
             print(request.headers)
@@ -368,6 +984,8 @@ class SPTrackDownloader:
         match = re.search(r'"videoId":"(.*?)"', html_content)
         if match:
             video_id = match.group(1)
+            if self.search_cache is not None:
+                self.search_cache.set_video_id(query, video_id)
             return video_id
         else:
             #print("todo: implement YouTube Data API call as alternative (rate limited to 100 searches / day)")
@@ -377,22 +995,13 @@ class SPTrackDownloader:
     @staticmethod
     def _hash_id(video_id: str) -> str:
         """
-        generate hash for splitting downloaded mp3 into seperate folders,
-        based on the youtube video id
+        directory for splitting downloaded audio into seperate folders,
+        based on the youtube video id (see `musicdl.storage.shard_dir`)
         
         this is done for file system access reasons; individual folders 
         with many files are difficult for most file managers to work with
         """
-        num_bins = int(config["num_bins"])
-        hash_value = sum(ord(char) for char in video_id) % num_bins + 1
-        if num_bins == 1:
-            return "."
-        elif num_bins > 0 and num_bins <= 10:
-            return f"{hash_value:02}"
-        elif num_bins <= 100:
-            return f"{hash_value:03}"
-        else:
-            raise ValueError("num_bins should be in the interval [1,100]")
+        return shard_dir(video_id) or "."
 
     #def add_missing_video_ids(self, tracks: list[Track], max_calls: int|None = 5) -> list[dict]:
         #if max_calls is None:
@@ -411,16 +1020,7 @@ class SPTrackDownloader:
             #new_tracks.append(track)
         #return new_tracks
 
-    def _download(self, track: Track, video_id: str, force=False) -> str:
-        """
-        use yt-dlp to download the youtube audio stream and save to file
-
-        returns the path to the audio file
-        """
-        artist_name = track.artist_name
-        track_name = track.name
-        url = f"https://www.youtube.com/watch?v={video_id}"
-
+    def _audio_path(self, track: Track, video_id: str) -> str:
         if config["hash_audio_storage"]:
             #output_dir = os.path.join(config["audio_storage"], SPTrackDownloader._hash_id(video_id))
             output_dir = os.path.join(self.audio_directory, SPTrackDownloader._hash_id(video_id))
@@ -428,18 +1028,141 @@ class SPTrackDownloader:
             #output_dir = config["audio_storage"]
             output_dir = self.audio_directory
         os.makedirs(output_dir, exist_ok=True)
+        artist_name = track.artist_name
+        track_name = track.name
+        return os.path.join(output_dir, f"{''.join(c for c in artist_name if c.isalnum())}_{''.join(c for c in track_name if c.isalnum())}_{video_id}.{self.audio_format}")
 
-        audio_path = os.path.join(output_dir, f"{''.join(c for c in artist_name if c.isalnum())}_{''.join(c for c in track_name if c.isalnum())}_{video_id}.{self.audio_format}")
-        if os.path.exists(audio_path):
-            if force:
-                os.remove(audio_path)
-            else:
-                return audio_path
+    def _download(self, track: Track, video_id: str, force=False) -> str:
+        """
+        use yt-dlp to download the youtube audio stream and convert it
+        to every format in `self.audio_formats`
 
-        #ytdlpcli_wrapper(url, audio_path)
-        #ytdlp_wrapper(url, audio_path)
+        returns the path to the audio file
+        """
         try:
-            self.ytdlp(url, audio_path)
+            audio_path, staged_path = self._fetch(track, video_id, force=force)
         except yt_dlp.utils.DownloadError as e:
             print(e)
+            return self._audio_path(track, video_id)
+        if staged_path is not None:
+            self._transcode(video_id, staged_path, audio_path)
         return audio_path
+
+    def _fetch(self, track: Track, video_id: str, force=False) -> tuple[str, str|None]:
+        """
+        download half of `_download`: returns the path to the audio file, and the path
+        of the downloaded stream that still needs to go through `_transcode`
+        (None if there is nothing to convert)
+
+        raises yt-dlp's `DownloadError` if the video couldn't be downloaded
+        """
+        url = f"https://www.youtube.com/watch?v={video_id}"
+        audio_path = self._audio_path(track, video_id)
+        while True:
+            with self._video_lock(video_id):
+                converting = self._converting.get(video_id)
+                if converting is None:
+                    return self._fetch_locked(url, video_id, audio_path, force)
+            # the same video was just downloaded for another track, wait for it to be converted
+            converting.wait()
+
+    def _fetch_locked(self, url: str, video_id: str, audio_path: str, force=False) -> tuple[str, str|None]:
+        """
+        `_fetch` while holding the lock for `video_id`
+        """
+        audio_path, done = self._existing(video_id, audio_path, force)
+        if done:
+            return audio_path, None
+
+        os.makedirs(self.staging_directory, exist_ok=True)
+        fetch = functools.partial(self.fetch, format=format_selector(self.audio_format))
+        staged_path = throttled_download(fetch, url, self.staging_directory)
+        self._converting[video_id] = threading.Event()
+        return self._fetched(video_id, audio_path, staged_path)
+
+    def _existing(self, video_id: str, audio_path: str, force=False) -> tuple[str, bool]:
+        """
+        (audio_path, True) if `video_id` doesn't have to be downloaded for `audio_path`
+        (already there, or reusing another track's download), otherwise (audio_path, False)
+        """
+        if self.audio_format == "native":
+            # the extension is only known once the stream has been downloaded
+            audio_path = find_native(os.path.splitext(audio_path)[0]) or audio_path
+        outputs = self.outputs(audio_path)
+        if all(os.path.exists(output) for output in outputs):
+            if not force:
+                return audio_path, True
+            for output in outputs:
+                os.remove(output)
+        if not force and self.reuse_audio != "none":
+            existing_path = self._find_video(video_id)
+            if existing_path is not None:
+                self._count("reused")
+                return self._reuse(existing_path, audio_path), True
+        return audio_path, False
+
+    def _fetched(self, video_id: str, audio_path: str, staged_path: str) -> tuple[str, str]:
+        """
+        record a download of `video_id`, returns (audio_path, staged_path) for `_transcode`
+        """
+        if self.audio_format == "native":
+            audio_path = os.path.splitext(audio_path)[0] + os.path.splitext(staged_path)[1]
+        self._count("downloaded")
+        self._video_paths[video_id] = audio_path
+        return audio_path, staged_path
+
+    def _fetch_many(self, requests: list[tuple[Track, str]], force=False) -> list[tuple[str, str|None]|Exception|None]:
+        """
+        `_fetch` for several (track, video_id) pairs with a single run of the
+        yt-dlp cli (see `ytdlpcli_fetch_batch`)
+
+        the result is None for tracks whose video is already being downloaded,
+        for another track of the batch or by another thread; call `_fetch` for
+        those once the rest of the batch has gone through `_transcode`
+
+        tracks whose video couldn't be downloaded get the `DownloadError` instead
+        """
+        results = [None] * len(requests)
+        batch = {}  # video_id -> (index, audio_path)
+        for i, (track, video_id) in enumerate(requests):
+            audio_path = self._audio_path(track, video_id)
+            with self._video_lock(video_id):
+                if video_id in self._converting:
+                    continue
+                audio_path, done = self._existing(video_id, audio_path, force)
+                if done:
+                    results[i] = (audio_path, None)
+                    continue
+                # other tracks of the same video wait for the conversion (see `_fetch`)
+                self._converting[video_id] = threading.Event()
+            batch[video_id] = (i, audio_path)
+        if not batch:
+            return results
+
+        urls = {video_id: f"https://www.youtube.com/watch?v={video_id}" for video_id in batch}
+        try:
+            staged = throttled_batch(list(urls.values()), self.staging_directory, format_selector(self.audio_format))
+        except BaseException:
+            for video_id in batch:
+                with self._video_lock(video_id):
+                    self._converting.pop(video_id).set()
+            raise
+        for video_id, (i, audio_path) in batch.items():
+            staged_path = staged[urls[video_id]]
+            if isinstance(staged_path, Exception):
+                with self._video_lock(video_id):
+                    self._converting.pop(video_id).set()
+                results[i] = staged_path
+            else:
+                results[i] = self._fetched(video_id, audio_path, staged_path)
+        return results
+
+    def _transcode(self, video_id: str, staged_path: str, audio_path: str):
+        """
+        convert the stream downloaded by `_fetch` (blocks until done)
+        """
+        try:
+            self.transcoder.run(staged_path, self.outputs(audio_path))
+        finally:
+            with self._video_lock(video_id):
+                self._converting.pop(video_id).set()
@@ -0,0 +1,171 @@
+from unittest import mock
+import threading
+import os
+import io
+import tempfile
+import unittest
+import zipfile
+
+from musicdl.archive import ArchiveWriter, write_archive, export_library
+from musicdl.dataloader import extract_zip, load
+
+
+class Unseekable(io.RawIOBase):
+    """write-only stream, like a pipe"""
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self.buffer.write(b)
+
+
+class TestArchiveWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp.name, "tracks")
+        os.makedirs(os.path.join(self.source, "audio"))
+        for i in range(10):
+            with open(os.path.join(self.source, "audio", f"{i}.flac"), "wb") as f:
+                f.write(os.urandom(10_000))
+        with open(os.path.join(self.source, "tracks.csv"), "w") as f:
+            f.write("youtube_url,title\n" + "".join(f"u{i},t{i}\n" for i in range(500)))
+        with open(os.path.join(self.source, "music.db"), "w") as f:
+            f.write("not exported")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def check(self, zf: zipfile.ZipFile):
+        self.assertIsNone(zf.testzip())
+        self.assertNotIn("music.db", zf.namelist())
+        self.assertEqual(len(zf.namelist()), 11)
+        self.assertEqual(zf.getinfo("audio/0.flac").compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(zf.getinfo("tracks.csv").compress_type, zipfile.ZIP_DEFLATED)
+        with open(os.path.join(self.source, "tracks.csv"), "rb") as f:
+            self.assertEqual(zf.read("tracks.csv"), f.read())
+
+    def test_file(self):
+        path = os.path.join(self.tmp.name, "tracks.zip")
+        archive = write_archive(path, self.source, exclude={"music.db"}, workers=2)
+        self.assertEqual(archive.stats["stored"], 10)
+        self.assertEqual(archive.stats["bytes_out"], os.path.getsize(path))
+        with zipfile.ZipFile(path) as zf:
+            self.check(zf)
+
+    def test_unseekable_sink(self):
+        sink = Unseekable()
+        write_archive(sink, self.source, exclude={"music.db"})
+        with zipfile.ZipFile(io.BytesIO(sink.buffer.getvalue())) as zf:
+            self.check(zf)
+
+    def test_without_raw_writes(self):
+        # a zipfile whose internals changed: deflated on the calling thread, same archive
+        path = os.path.join(self.tmp.name, "tracks.zip")
+        with mock.patch("musicdl.archive.MAX_RAW_WRITE_VERSION", (3, 0)):
+            with ArchiveWriter(path, workers=2) as archive:
+                self.assertFalse(archive.raw_writes)
+                with mock.patch.object(archive, "_write_deflated") as write_deflated:
+                    archive.write_tree(self.source, exclude={"music.db"})
+        write_deflated.assert_not_called()
+        with zipfile.ZipFile(path) as zf:
+            self.check(zf)
+
+    def test_discard_on_error(self):
+        path = os.path.join(self.tmp.name, "tracks.zip")
+        with self.assertRaises(RuntimeError):
+            with ArchiveWriter(path) as archive:
+                archive.write_tree(self.source)
+                raise RuntimeError
+        self.assertEqual(os.listdir(self.tmp.name), ["tracks"])
+
+
+class TestIncrementalExport(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp.name, "tracks")
+        self.dest = os.path.join(self.tmp.name, "copy")
+        os.makedirs(os.path.join(self.source, "audio"))
+        with open(os.path.join(self.source, "tracks.csv"), "w") as f:
+            f.write("youtube_url,title,audio_path\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def add_track(self, i):
+        with open(os.path.join(self.source, "audio", f"{i}.flac"), "wb") as f:
+            f.write(os.urandom(1000))
+        with open(os.path.join(self.source, "tracks.csv"), "a") as f:
+            f.write(f"u{i},t{i},./audio/{i}.flac\n")
+
+    def export(self, name, **kwargs):
+        path = os.path.join(self.tmp.name, name)
+        export_library(path, self.source, **kwargs)
+        return path
+
+    def test_delta_contains_only_new_tracks(self):
+        for i in range(3):
+            self.add_track(i)
+        self.export("full.zip")
+        self.add_track(3)
+        delta = self.export("delta.zip", since_last_export=True)
+        with zipfile.ZipFile(delta) as zf:
+            self.assertEqual(sorted(zf.namelist()), ["audio/3.flac", "manifest.json", "tracks.csv"])
+            self.assertEqual(zf.read("tracks.csv"), b"youtube_url,title,audio_path\nu3,t3,./audio/3.flac\n")
+
+    def test_deltas_apply_in_order(self):
+        self.add_track(0)
+        full = self.export("full.zip")
+        self.add_track(1)
+        delta_1 = self.export("delta_1.zip", since_last_export=True)
+        self.add_track(2)
+        delta_2 = self.export("delta_2.zip", since_last_export=True)
+
+        with self.assertRaises(ValueError):
+            extract_zip(delta_1, self.dest)
+        extract_zip(full, self.dest)
+        with self.assertRaises(ValueError):
+            extract_zip(delta_2, self.dest)
+        extract_zip(delta_1, self.dest)
+        extract_zip(delta_2, self.dest)
+        self.assertEqual([track_info["youtube_url"] for track_info in load(self.dest)], ["u0", "u1", "u2"])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dest, "audio"))), ["0.flac", "1.flac", "2.flac"])
+
+    def test_extract_skips_existing_files(self):
+        for i in range(3):
+            self.add_track(i)
+        full = self.export("full.zip")
+        extract_zip(full, self.dest)
+        modified = os.path.join(self.dest, "audio", "1.flac")
+        with open(modified, "wb") as f:
+            f.write(b"corrupted")
+        mtime = os.stat(os.path.join(self.dest, "audio", "0.flac")).st_mtime_ns
+        extract_zip(full, self.dest)
+        self.assertEqual(os.stat(os.path.join(self.dest, "audio", "0.flac")).st_mtime_ns, mtime)
+        with open(modified, "rb") as f, open(os.path.join(self.source, "audio", "1.flac"), "rb") as g:
+            self.assertEqual(f.read(), g.read())
+        self.assertEqual(len(load(self.dest)), 3)
+
+    def test_extract_into_new_directories(self):
+        # two threads find audio/ missing at the same time, only one of them can create it
+        for i in range(2):
+            self.add_track(i)
+        full = self.export("full.zip")
+        barrier = threading.Barrier(2)
+        makedirs = os.makedirs
+        def racing_makedirs(name, mode=0o777, exist_ok=False):
+            if not exist_ok:
+                try:
+                    barrier.wait(timeout=1)
+                except threading.BrokenBarrierError:
+                    pass
+            makedirs(name, mode, exist_ok)
+        with mock.patch("os.makedirs", racing_makedirs):
+            extract_zip(full, self.dest, workers=2)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dest, "audio"))), ["0.flac", "1.flac"])
+
+
+if __name__ == "__main__":
+    unittest.main()
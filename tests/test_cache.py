@@ -0,0 +1,97 @@
+from unittest import mock
+import os
+import time
+import tempfile
+import unittest
+
+from musicdl.cache import SQLiteCache, SearchCache, ResponseCache
+
+
+class TestSQLiteCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "cache.db")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_ttl_and_stats(self):
+        cache = SQLiteCache(self.path, table="things", ttl=60)
+        cache.set("a", "1")
+        self.assertEqual(cache.get("a"), "1")
+        self.assertIsNone(cache.get("a", ttl=-1))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats["hits"], 1)
+        self.assertEqual(cache.stats["misses"], 2)
+        self.assertEqual(cache.stats["expired"], 1)
+        cache.close()
+
+    def test_lru_eviction(self):
+        cache = SQLiteCache(self.path, table="things", max_entries=2)
+        cache.evict_every = 1
+        cache.touch_after = 0
+        cache.set("a", "1")
+        cache.set("b", "2")
+        cache.get("a")
+        cache.set("c", "3")
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "1")
+        cache.close()
+
+    def test_hits_are_written_in_batches(self):
+        cache = SQLiteCache(self.path, table="things")
+        cache.set("a", "1")
+        changes = cache.conn.total_changes
+        # recently accessed: nothing to write
+        for _ in range(10):
+            self.assertEqual(cache.get("a"), "1")
+        self.assertEqual(cache.conn.total_changes, changes)
+
+        cache.touch_after = 0
+        cache.touch_every = 3
+        for key in "bcd":
+            cache.set(key, key)
+        changes = cache.conn.total_changes
+        cache.get("a")
+        cache.get("b")
+        self.assertEqual(cache.conn.total_changes, changes)
+        cache.get("c")
+        self.assertEqual(cache.conn.total_changes, changes + 3)
+        with mock.patch("time.time", return_value=time.time() + 1000):
+            cache.get("d")
+        cache.close()
+        # pending access times are written on close
+        cache = SQLiteCache(self.path, table="things")
+        accessed = dict(cache.conn.execute("SELECT key, accessed FROM things").fetchall())
+        self.assertGreater(accessed["d"], time.time() + 500)
+        cache.close()
+
+    def test_search_query_normalized(self):
+        cache = SearchCache(self.path)
+        cache.set_video_id("No Idea by Don Toliver official audio", "_r-nPqWGG6c")
+        self.assertEqual(cache.get_video_id("no idea  by DON TOLIVER official audio "), "_r-nPqWGG6c")
+        cache.close()
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = ResponseCache(os.path.join(tmp.name, "spotify_cache.db"))
+        self.addCleanup(self.cache.close)
+
+    def test_every_endpoint_expires(self):
+        self.assertIsNotNone(self.cache.max_entries)
+        for endpoint in ["album_tracks", "not_an_endpoint"]:
+            key = ResponseCache.make_key(endpoint, "0ESBFn4IKNcvgD53QJPlpD", limit=50, offset=0)
+            self.cache.set_response(key, {"items": []})
+            self.assertEqual(self.cache.get_response(endpoint, key), {"items": []})
+            with mock.patch("time.time", return_value=time.time() + 365 * 24 * 60 * 60):
+                self.assertIsNone(self.cache.get_response(endpoint, key))
+                # still there when offline
+                self.assertEqual(self.cache.get_response(endpoint, key, offline=True), {"items": []})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+
+import pandas as pd
+
+from musicdl.containers import Track, Album, Artist, TrackTable
+
+
+def album(album_id: str, num_tracks: int) -> Album:
+    tracks = {}
+    for i in range(num_tracks):
+        track = Track(f"{album_id}-{i}", f"song {i}", "a1", "Artist", album_id, f"Album {album_id}", "img", "2020",
+                      video_id=f"v{i}", audio_path=f"./audio/{album_id}-{i}.flac" if i % 2 == 0 else None)
+        tracks[track.id] = track
+    return Album(f"Album {album_id}", album_id, "Artist", "a1", "2020", "img", tracks)
+
+
+class TestTrackTable(unittest.TestCase):
+    def setUp(self):
+        self.artist = Artist("Artist", "a1")
+        for album_id in ("b1", "b2"):
+            self.artist.albums[album_id] = album(album_id, 3)
+        self.tracks = [track for album in self.artist.albums.values() for track in album.tracks.values()]
+
+    def assertSameTracks(self, tracks, expected):
+        self.assertEqual([{c: getattr(t, c) for c in Track.__slots__} for t in tracks],
+                         [{c: getattr(t, c) for c in Track.__slots__} for t in expected])
+
+    def test_to_table(self):
+        table = self.artist.to_table()
+        self.assertEqual(len(table), 6)
+        self.assertSameTracks(table, self.tracks)
+        self.assertSameTracks([table[-1]], [self.tracks[-1]])
+        with self.assertRaises(IndexError):
+            table[6]
+        self.assertEqual(table.column("album_id"), ["b1"] * 3 + ["b2"] * 3)
+        self.assertEqual(table.column("audio_path")[:2], ["./audio/b1-0.flac", None])
+        # repeated values are stored once
+        self.assertEqual(table._values["artist_name"], ["Artist"])
+        self.assertEqual(table._values["album_id"], ["b1", "b2"])
+        self.assertEqual(table._values["codec"], [])
+        self.assertSameTracks(self.tracks[0].to_table(), self.tracks[:1])
+        self.assertSameTracks(self.artist.albums["b2"].to_table(), self.tracks[3:])
+
+    def test_snapshot(self):
+        table = self.artist.to_table()
+        self.tracks[0].audio_path = "./audio/moved.flac"
+        self.assertEqual(table[0].audio_path, "./audio/b1-0.flac")
+
+    def test_dataframe_round_trip(self):
+        table = TrackTable.from_tracks(self.tracks)
+        df = table.to_dataframe()
+        self.assertIsInstance(df["album_id"].dtype, pd.CategoricalDtype)
+        self.assertEqual(list(df["album_id"].cat.categories), ["b1", "b2"])
+        self.assertTrue(df["codec"].isna().all())
+        self.assertSameTracks(TrackTable.from_dataframe(df), self.tracks)
+        # plain (not categorical) columns, and frames without the newer columns
+        df = df.astype({"album_id": object}).drop(columns=["container", "codec"])
+        self.assertSameTracks(TrackTable.from_dataframe(df), self.tracks)
+
+    def test_arrow_round_trip(self):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+        arrow_table = TrackTable.from_tracks(self.tracks).to_arrow()
+        self.assertEqual(arrow_table.schema.field("album_id").type, pa.dictionary(pa.int32(), pa.string()))
+        self.assertEqual(arrow_table.column("codec").null_count, 6)
+        self.assertSameTracks(TrackTable.from_arrow(arrow_table), self.tracks)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import tempfile
+import unittest
+import math
+import os
+
+from musicdl.dataloader import load, iter_tracks
+
+
+TRACKS_CSV = (
+    "youtube_url,title,artist,artwork_url,audio_path,duration_s\n"
+    "https://www.youtube.com/watch?v=aaaaaaaaaaa,song 1,artist,https://i.ytimg.com/1.jpg,./audio/1.flac,12\n"
+    "https://www.youtube.com/watch?v=bbbbbbbbbbb,song 2,artist,,./audio/2.flac,181\n"
+)
+
+
+class TestLoad(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+        with open(os.path.join(self.directory, "tracks.csv"), "w") as f:
+            f.write(TRACKS_CSV)
+
+    def test_load_types(self):
+        tracks = load(self.directory)
+        self.assertEqual([track["title"] for track in tracks], ["song 1", "song 2"])
+        self.assertEqual(tracks[0]["duration_s"], 12)
+        self.assertIsInstance(tracks[0]["duration_s"], int)
+        self.assertTrue(math.isnan(tracks[1]["artwork_url"]))
+        self.assertEqual(tracks[0]["audio_path"], os.path.join(self.directory, "audio", "1.flac"))
+
+    def test_iter_tracks_strings(self):
+        tracks = list(iter_tracks(self.directory))
+        self.assertEqual(tracks[0]["duration_s"], "12")
+        self.assertIsNone(tracks[1]["artwork_url"])
+        self.assertEqual(tracks[0]["audio_path"], os.path.join(self.directory, "audio", "1.flac"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+from unittest import mock
+from sqlite3 import connect, OperationalError
+import tempfile
+import unittest
+import os
+
+from musicdl.containers import Track
+from musicdl.db import MusicDB, MIGRATIONS
+from musicdl.yt import SPTrackDownloader
+
+
+def track(i: int, video_id: str, audio_path: str) -> Track:
+    return Track(f"t{i}", f"song {i}", "artist", "Artist", "album", "Album", "img", "2020", video_id=video_id, audio_path=audio_path)
+
+
+class TestLookups(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+        # nothing is written until flush() is called
+        self.db = MusicDB(os.path.join(self.directory, "music.db"), batch_size=1000, flush_interval=3600)
+        self.addCleanup(self.db.close)
+        self.yt = SPTrackDownloader(audio_format="flac", ytdlp_version="cli", audio_directory=self.directory, db=self.db)
+        self.addCleanup(self.yt.transcoder.close)
+
+    def test_buffered_tracks_are_found(self):
+        audio_path = os.path.join(self.directory, "audio", "song0.flac")
+        os.makedirs(os.path.dirname(audio_path))
+        open(audio_path, "w").close()
+        self.db.add(track(0, "aaaaaaaaaaa", audio_path))
+        self.assertEqual(self.db.stats["commits"], 0)
+
+        self.assertEqual(self.yt.lookup(track(0, None, None)), ("aaaaaaaaaaa", audio_path))
+        self.assertEqual(self.yt.lookup(track(1, None, None)), (None, None))
+        self.assertEqual(self.yt.lookup_many([track(0, None, None), track(1, None, None)]), {"t0": ("aaaaaaaaaaa", audio_path)})
+        self.db.add(track(2, "bbbbbbbbbbb", audio_path))
+        self.assertEqual(self.yt._find_video("bbbbbbbbbbb"), audio_path)
+        self.assertEqual(self.db.stats["rows"], 2)
+
+
+# music.db as created before `MIGRATIONS` existed
+BASELINE_SCHEMA = """
+CREATE TABLE artists (id TEXT PRIMARY KEY, name TEXT);
+CREATE TABLE albums (id TEXT PRIMARY KEY, name TEXT, artist_id TEXT, release_date TEXT, image_url TEXT,
+                     FOREIGN KEY (artist_id) REFERENCES artists(id));
+CREATE TABLE tracks (id TEXT PRIMARY KEY, name TEXT, album_id TEXT, artist_id TEXT,
+                     FOREIGN KEY (album_id) REFERENCES albums(id), FOREIGN KEY (artist_id) REFERENCES artists(id));
+CREATE TABLE audio_files (track_id TEXT PRIMARY KEY, video_id TEXT, audio_path TEXT,
+                          FOREIGN KEY (track_id) REFERENCES tracks(id));
+INSERT INTO audio_files VALUES ('t0', 'aaaaaaaaaaa', './tracks/audio/song0.flac');
+"""
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.music_db = os.path.join(tmp.name, "music.db")
+        conn = connect(self.music_db)
+        conn.executescript(BASELINE_SCHEMA)
+        conn.close()
+
+    def schema(self) -> tuple[int, list[str], list[str]]:
+        conn = connect(self.music_db)
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(audio_files)")]
+            indexes = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name NOT LIKE 'sqlite_%'")]
+            return version, columns, sorted(indexes)
+        finally:
+            conn.close()
+
+    def test_upgrade_baseline(self):
+        db = MusicDB(self.music_db)
+        self.assertEqual(db.lookup_audio(["t0"]), {"t0": ("aaaaaaaaaaa", "./tracks/audio/song0.flac")})
+        db.close()
+        version, columns, indexes = self.schema()
+        self.assertEqual(version, len(MIGRATIONS))
+        self.assertEqual(columns, ["track_id", "video_id", "audio_path", "container", "codec"])
+        self.assertEqual(indexes, ["audio_files_video_id", "tracks_album_id", "tracks_artist_id"])
+        # opening it again doesn't apply anything twice
+        MusicDB(self.music_db).close()
+        self.assertEqual(self.schema()[0], len(MIGRATIONS))
+
+    def test_failed_migration_is_rolled_back(self):
+        broken = MIGRATIONS + ["ALTER TABLE audio_files ADD COLUMN bitrate INTEGER; ALTER TABLE missing ADD COLUMN x;"]
+        with mock.patch("musicdl.db.MIGRATIONS", broken):
+            with self.assertRaises(OperationalError):
+                MusicDB(self.music_db)
+        # the migrations before it were committed, the broken one left nothing behind
+        version, columns, _ = self.schema()
+        self.assertEqual(version, len(MIGRATIONS))
+        self.assertNotIn("bitrate", columns)
+        with mock.patch("musicdl.db.MIGRATIONS", broken[:-1] + ["ALTER TABLE audio_files ADD COLUMN bitrate INTEGER;"]):
+            MusicDB(self.music_db).close()
+        self.assertEqual(self.schema()[1][-1], "bitrate")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import tempfile
+import unittest
+import time
+import os
+
+import requests
+
+from musicdl.httpclient import make_session, download_file
+
+
+class Handler(BaseHTTPRequestHandler):
+    # path -> status codes to answer with, the last one repeats
+    responses = {}
+    hits = {}
+
+    def do_GET(self):
+        Handler.hits[self.path] = Handler.hits.get(self.path, 0) + 1
+        statuses = Handler.responses.get(self.path, [200])
+        status = statuses[min(Handler.hits[self.path], len(statuses)) - 1]
+        if self.path == "/slow":
+            time.sleep(0.5)
+        body = b"ok" * 1000
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 503:
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHTTPClient(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        cls.base = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        Handler.hits.clear()
+        self.session = make_session(timeout=(1, 0.2), retries=2, pool_size=2)
+
+    def test_retries_server_errors(self):
+        Handler.responses["/flaky"] = [503, 503, 200]
+        response = self.session.get(self.base + "/flaky")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Handler.hits["/flaky"], 3)
+
+    def test_throttling_is_not_retried(self):
+        # 403/429 are handled by musicdl.ratelimit
+        Handler.responses["/throttled"] = [429]
+        response = self.session.get(self.base + "/throttled")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(Handler.hits["/throttled"], 1)
+
+    def test_default_timeout(self):
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.session.get(self.base + "/slow")
+
+    def test_download_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "yt-dlp")
+            download_file(self.base + "/binary", path)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"ok" * 1000)
+            Handler.responses["/missing"] = [404]
+            with self.assertRaises(requests.exceptions.HTTPError):
+                download_file(self.base + "/missing", path + "2")
+            self.assertEqual(os.listdir(tmp), ["yt-dlp"])
+
+
+if __name__ == "__main__":
+    unittest.main()
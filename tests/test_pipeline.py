@@ -0,0 +1,279 @@
+from unittest import mock
+import tempfile
+import threading
+import unittest
+import asyncio
+import random
+import time
+import csv
+import os
+
+import yt_dlp
+
+from musicdl.containers import Track, Album
+from musicdl.yt import SPTrackDownloader
+from musicdl import pipeline
+from musicdl.pipeline import Pipeline
+
+
+class FakeSpotify:
+    """
+    albums of `num_tracks` tracks, added to the album as they are yielded
+    (like SpotifyInterface.iter_track_container); raises after `fail_after` tracks
+    """
+    def __init__(self, num_tracks: int = 4, fail_after: int = None, fail_urls=()):
+        self.num_tracks = num_tracks
+        self.fail_after = fail_after
+        self.fail_urls = set(fail_urls)
+
+    def iter_track_container(self, url):
+        if url in self.fail_urls:
+            raise ConnectionError("album request failed")
+        album_id = url[-3:]
+        album = Album(album_id, album_id, "Artist", "artist", "2020", "img", {})
+
+        def tracks():
+            for i in range(self.num_tracks):
+                if self.fail_after is not None and i == self.fail_after:
+                    raise ConnectionError("page request failed")
+                track = Track(f"{album_id}-{i}", f"{album_id} song {i}", "artist", "Artist", album_id, album_id, "img", "2020")
+                album.tracks[track.id] = track
+                yield track.id, track
+        return album, tracks()
+
+
+class FakeYT:
+    """
+    stands in for SPTrackDownloader, `fail_search` / `fail_fetch` are track ids
+    """
+    def __init__(self, directory: str, batch_size: int = 1, cached: dict = None, fail_search=(), fail_fetch=(), defer=()):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.cached = cached or {}
+        self.fail_search = set(fail_search)
+        self.fail_fetch = set(fail_fetch)
+        # _fetch_many leaves these for `_fetch` (their video is already being downloaded)
+        self.defer = set(defer)
+        self.fail_batch = False
+        self.searched = []
+        self.batches = []
+
+    def lookup_many(self, tracks):
+        return {track.id: self.cached[track.id] for track in tracks if track.id in self.cached}
+
+    def _search(self, track):
+        self.searched.append(track.id)
+        if track.id in self.fail_search:
+            raise ConnectionError("search failed")
+        # finish out of order
+        time.sleep(random.uniform(0, 0.01))
+        return "v" + track.id
+
+    def _fetch(self, track, video_id, force=False):
+        if track.id in self.fail_fetch:
+            raise ConnectionError("download failed")
+        return os.path.join(self.directory, "audio", f"{video_id}.flac"), None
+
+    def _fetch_many(self, requests, force=False):
+        self.batches.append([track.id for track, _ in requests])
+        if self.fail_batch:
+            raise ConnectionError("yt-dlp failed to start")
+        return [None if track.id in self.defer else self._fetch(track, video_id) for track, video_id in requests]
+
+    def _transcode(self, video_id, staged_path, audio_path):
+        pass
+
+
+class FakeYoutubeDownloader:
+    def __init__(self, wait_for=None):
+        # called before returning, e.g. to wait for another url to make progress
+        self.wait_for = wait_for
+
+    def download(self, urls):
+        if self.wait_for is not None:
+            self.wait_for()
+        return [{"youtube_url": url, "title": "video", "artist": "channel", "artwork_url": "", "audio_path": "./audio/video.flac"} for url in urls]
+
+
+class FakeDB:
+    def __init__(self):
+        self.added = []
+
+    def add(self, track):
+        self.added.append(track.id)
+
+
+class WritingTranscoder:
+    workers = 1
+
+    def run(self, source, outputs):
+        for output in outputs:
+            open(output, "w").close()
+        return outputs
+
+
+class FakeMDL:
+    def __init__(self, directory: str, sp: FakeSpotify, yt_cli: FakeYT, use_db: bool = False):
+        self.audio_directory = directory
+        self.sp = sp
+        self.yt_cli = yt_cli
+        self.yt = FakeYoutubeDownloader()
+        self.use_db = use_db
+        self.db = FakeDB() if use_db else None
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.directory = self.tmp.name
+
+    def run_pipeline(self, mdl, urls, **kwargs):
+        async def run():
+            # a bookkeeping bug shows up as a run that never finishes
+            return await asyncio.wait_for(Pipeline(mdl, verbose=False, **kwargs).run(urls), timeout=10)
+        with mock.patch("sys.stderr"):
+            return asyncio.run(run())
+
+    def csv_rows(self):
+        with open(os.path.join(self.directory, "tracks.csv"), newline="") as f:
+            return [row["title"] for row in csv.DictReader(f)]
+
+    def test_output_follows_input_order(self):
+        yt_cli = FakeYT(self.directory)
+        mdl = FakeMDL(self.directory, FakeSpotify(num_tracks=5), yt_cli)
+        urls = [f"https://open.spotify.com/album/{i:03}" for i in range(4)]
+        output = self.run_pipeline(mdl, urls, concurrency={"search": 4, "download": 3})
+        expected = [f"{i:03} song {j}" for i in range(4) for j in range(5)]
+        self.assertEqual([info["title"] for info in output], expected)
+        self.assertEqual(sorted(self.csv_rows()), sorted(expected))
+
+    def test_track_failure(self):
+        yt_cli = FakeYT(self.directory, fail_search={"000-1"}, fail_fetch={"001-3"})
+        mdl = FakeMDL(self.directory, FakeSpotify(num_tracks=4), yt_cli, use_db=True)
+        with mock.patch("builtins.print"):
+            output = self.run_pipeline(mdl, ["https://open.spotify.com/album/000", "https://open.spotify.com/album/001"])
+        expected = ["000 song 0", "000 song 2", "000 song 3", "001 song 0", "001 song 1", "001 song 2"]
+        self.assertEqual([info["title"] for info in output], expected)
+        self.assertEqual(sorted(mdl.db.added), ["000-0", "000-2", "000-3", "001-0", "001-1", "001-2"])
+
+    def test_metadata_failure(self):
+        yt_cli = FakeYT(self.directory)
+        mdl = FakeMDL(self.directory, FakeSpotify(num_tracks=2, fail_urls={"https://open.spotify.com/album/000"}), yt_cli)
+        with mock.patch("builtins.print"):
+            output = self.run_pipeline(mdl, ["https://open.spotify.com/album/000", "https://open.spotify.com/album/001"])
+        self.assertEqual([info["title"] for info in output], ["001 song 0", "001 song 1"])
+        self.assertEqual(self.csv_rows(), ["001 song 0", "001 song 1"])
+
+    def test_batch_failure(self):
+        # yt-dlp itself fails, every track of the batch is dropped and the run still ends
+        yt_cli = FakeYT(self.directory, batch_size=8)
+        yt_cli.fail_batch = True
+        mdl = FakeMDL(self.directory, FakeSpotify(num_tracks=3), yt_cli)
+        with mock.patch.object(pipeline, "BATCH_LINGER", 0.2), mock.patch("builtins.print"):
+            output = self.run_pipeline(mdl, ["https://open.spotify.com/album/000"])
+        self.assertEqual(yt_cli.batches, [["000-0", "000-1", "000-2"]])
+        self.assertEqual(output, [])
+
+    def test_cached_tracks(self):
+        # tracks already in music.db aren't searched for or added again
+        cached = {"000-1": ("v000-1", os.path.join(self.directory, "audio", "cached.flac"))}
+        yt_cli = FakeYT(self.directory, cached=cached)
+        mdl = FakeMDL(self.directory, FakeSpotify(num_tracks=3), yt_cli, use_db=True)
+        output = self.run_pipeline(mdl, ["https://open.spotify.com/album/000"])
+        self.assertEqual(sorted(yt_cli.searched), ["000-0", "000-2"])
+        self.assertEqual(sorted(mdl.db.added), ["000-0", "000-2"])
+        self.assertEqual(output[1]["audio_path"], "./audio/cached.flac")
+        self.assertEqual([info["title"] for info in output], ["000 song 0", "000 song 1", "000 song 2"])
+
+    def test_metadata_failure_then_track_failure(self):
+        # the album's third page fails after two chunks of tracks were emitted,
+        # then one of the emitted tracks fails to download
+        yt_cli = FakeYT(self.directory, fail_fetch={"001-1"})
+        mdl = FakeMDL(self.directory, FakeSpotify(num_tracks=6, fail_after=5), yt_cli)
+        with mock.patch.object(pipeline, "LOOKUP_CHUNK_SIZE", 2), mock.patch("builtins.print"):
+            output = self.run_pipeline(mdl, ["https://open.spotify.com/album/001"])
+        self.assertEqual([info["title"] for info in output], ["001 song 0", "001 song 2", "001 song 3"])
+        self.assertEqual(self.csv_rows(), ["001 song 0", "001 song 2", "001 song 3"])
+
+    def test_deferred_failure_in_batch(self):
+        # the track that started the batch fails in `_fetch`, the other deferred tracks still finish
+        yt_cli = FakeYT(self.directory, batch_size=4, defer={"001-0", "001-1", "001-2"}, fail_fetch={"001-0"})
+        mdl = FakeMDL(self.directory, FakeSpotify(num_tracks=4), yt_cli)
+        with mock.patch.object(pipeline, "BATCH_LINGER", 0.2), mock.patch("builtins.print"):
+            output = self.run_pipeline(mdl, ["https://open.spotify.com/album/001"])
+        self.assertEqual(yt_cli.batches, [["001-0", "001-1", "001-2", "001-3"]])
+        self.assertEqual([info["title"] for info in output], ["001 song 1", "001 song 2", "001 song 3"])
+
+    def test_youtube_urls_overlap_with_spotify(self):
+        # the spotify album after a youtube video is searched while the video is still downloading
+        yt_cli = FakeYT(self.directory)
+        mdl = FakeMDL(self.directory, FakeSpotify(num_tracks=2), yt_cli)
+        searched = threading.Event()
+        yt_cli._search = lambda track, search=yt_cli._search: (searched.set(), search(track))[1]
+        mdl.yt = FakeYoutubeDownloader(wait_for=lambda: self.assertTrue(searched.wait(timeout=5)))
+        output = self.run_pipeline(mdl, ["https://www.youtube.com/watch?v=aaaaaaaaaaa", "https://open.spotify.com/album/002"])
+        self.assertEqual([info["title"] for info in output], ["video", "002 song 0", "002 song 1"])
+
+
+class TestPipelineDownloadErrors(unittest.TestCase):
+    """
+    yt-dlp failing to download a video, with the real `SPTrackDownloader`
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.directory = self.tmp.name
+
+    def downloader(self, **kwargs) -> SPTrackDownloader:
+        yt_cli = SPTrackDownloader(audio_format="flac", audio_directory=self.directory, reuse_audio="none",
+                                   transcoder=WritingTranscoder(), **kwargs)
+        yt_cli._search = lambda track: ("bad" if track.id == self.fail else "v") + track.id
+        return yt_cli
+
+    def staged(self, url, staging_dir):
+        video_id = url.split("v=")[1]
+        if video_id.startswith("bad"):
+            return yt_dlp.utils.DownloadError(f"ERROR: [youtube] {video_id}: Video unavailable")
+        os.makedirs(staging_dir, exist_ok=True)
+        path = os.path.join(staging_dir, f"{video_id}.webm")
+        open(path, "w").close()
+        return path
+
+    def throttled_download(self, fetch, url, staging_dir):
+        result = self.staged(url, staging_dir)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def throttled_batch(self, urls, staging_dir, format=None):
+        return {url: self.staged(url, staging_dir) for url in urls}
+
+    def check(self, yt_cli, fail: str):
+        self.fail = fail
+        mdl = FakeMDL(self.directory, FakeSpotify(num_tracks=3), yt_cli, use_db=True)
+        with mock.patch("musicdl.yt.throttled_download", self.throttled_download), \
+             mock.patch("musicdl.yt.throttled_batch", self.throttled_batch), \
+             mock.patch.object(pipeline, "BATCH_LINGER", 0.2), mock.patch("builtins.print"), mock.patch("sys.stderr"):
+            output = asyncio.run(asyncio.wait_for(Pipeline(mdl, verbose=False).run(["https://open.spotify.com/album/001"]), timeout=10))
+        # the track that failed isn't recorded anywhere
+        expected = [i for i in range(3) if f"001-{i}" != fail]
+        self.assertEqual([info["title"] for info in output], [f"001 song {i}" for i in expected])
+        self.assertEqual(sorted(mdl.db.added), [f"001-{i}" for i in expected])
+        with open(os.path.join(self.directory, "tracks.csv"), newline="") as f:
+            self.assertEqual([row["title"] for row in csv.DictReader(f)], [f"001 song {i}" for i in expected])
+        self.assertEqual(yt_cli._converting, {})
+
+    def test_fetch(self):
+        self.check(self.downloader(ytdlp_version="py"), fail="001-1")
+
+    def test_fetch_many(self):
+        # the track that started the batch, then another one
+        for fail in ("001-0", "001-1"):
+            with self.subTest(fail=fail):
+                self.directory = os.path.join(self.tmp.name, fail)
+                self.check(self.downloader(ytdlp_version="cli", batch_size=4), fail)
+
+
+if __name__ == "__main__":
+    unittest.main()
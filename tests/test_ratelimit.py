@@ -0,0 +1,38 @@
+import time
+import unittest
+
+from musicdl.ratelimit import RateLimiter, parse_retry_after, status_from_error
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_burst_then_throttle(self):
+        limiter = RateLimiter(rate=20, burst=3)
+        start = time.monotonic()
+        for _ in range(3):
+            limiter.acquire()
+        self.assertLess(time.monotonic() - start, 0.04)
+        limiter.acquire()
+        self.assertEqual(limiter.stats["requests"], 4)
+        self.assertEqual(limiter.stats["throttled"], 1)
+        self.assertGreater(limiter.stats["throttled_seconds"], 0)
+
+    def test_backoff_and_ramp_up(self):
+        limiter = RateLimiter(rate=8, burst=1, ramp_after=2)
+        limiter.failure(retry_after=0.05)
+        self.assertEqual(limiter.rate, 4)
+        self.assertEqual(limiter.stats["backoffs"], 1)
+        self.assertGreaterEqual(limiter.acquire(), 0.04)
+        limiter.success()
+        limiter.success()
+        self.assertEqual(limiter.rate, 8)
+
+    def test_parse_helpers(self):
+        self.assertEqual(parse_retry_after("12"), 12.0)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0.0)
+        self.assertEqual(status_from_error(Exception("ERROR: HTTP Error 429: Too Many Requests")), 429)
+        self.assertIsNone(status_from_error(Exception("Video unavailable")))
+
+
+if __name__ == "__main__":
+    unittest.main()
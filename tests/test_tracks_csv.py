@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from musicdl.containers import TracksCSV
+
+
+def track_info(i, **extra):
+    return {
+        "youtube_url": f"https://www.youtube.com/watch?v={i:011d}",
+        "title": f"title {i}",
+        "artist": "artist",
+        "artwork_url": "https://i.ytimg.com/vi/x/hqdefault.jpg",
+        "audio_path": f"./audio/{i}.flac",
+        **extra,
+    }
+
+
+class TestTracksCSV(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "tracks.csv")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_append_skips_duplicates(self):
+        journal = TracksCSV(self.path)
+        self.assertEqual(journal.append([track_info(1), track_info(2)]), 2)
+        self.assertEqual(journal.append([track_info(2), track_info(3), track_info(3)]), 1)
+        df = pd.read_csv(self.path)
+        self.assertEqual(df["title"].tolist(), ["title 1", "title 2", "title 3"])
+
+    def test_external_rewrite_is_noticed(self):
+        journal = TracksCSV(self.path)
+        journal.append([track_info(1)])
+        pd.DataFrame([track_info(5)]).to_csv(self.path, index=False)
+        self.assertEqual(journal.append([track_info(1), track_info(5)]), 1)
+        self.assertEqual(len(pd.read_csv(self.path)), 2)
+
+    def test_new_columns(self):
+        journal = TracksCSV(self.path)
+        journal.append([track_info(1)])
+        journal.append([track_info(2, duration_s=12)])
+        df = pd.read_csv(self.path)
+        self.assertEqual(len(df), 2)
+        self.assertEqual(df["duration_s"].tolist()[1], 12)
+
+    def test_failed_append_is_undone(self):
+        journal = TracksCSV(self.path)
+        journal.append([track_info(1)])
+        with open(self.path, "rb") as f:
+            before = f.read()
+        real_write = os.write
+        def torn_write(fd, data):
+            real_write(fd, bytes(data[:10]))
+            raise OSError("No space left on device")
+        with mock.patch("os.write", torn_write):
+            with self.assertRaises(OSError):
+                journal.append([track_info(2)])
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), before)
+        self.assertEqual(journal.append([track_info(2)]), 1)
+
+    def test_no_trailing_newline(self):
+        # a valid file written by something else, reading it must not change it
+        with open(self.path, "w", newline="") as f:
+            f.write("youtube_url,title\nu1,a\nu2,b")
+        journal = TracksCSV(self.path)
+        self.assertIn("u2", journal)
+        self.assertEqual(len(journal), 2)
+        with open(self.path, newline="") as f:
+            self.assertEqual(f.read(), "youtube_url,title\nu1,a\nu2,b")
+        journal.append([{"youtube_url": "u3", "title": "c"}])
+        self.assertEqual(pd.read_csv(self.path)["title"].tolist(), ["a", "b", "c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,345 @@
+from unittest import mock
+import threading
+import tempfile
+import unittest
+import json
+import sys
+import os
+
+import yt_dlp
+
+from musicdl.containers import Track
+from musicdl.yt import SPTrackDownloader, YoutubeDownloader, YtdlpSession, YtdlpSessionPool, track_info_from, INFO_FIELDS
+from musicdl.transcode import format_selector
+from musicdl.ratelimit import RateLimiter
+
+
+# stands in for the yt-dlp binary: "downloads" every video in the batch file
+# except the ones whose id starts with "bad", and records its arguments
+FAKE_YTDLP = f"""#!{sys.executable}
+import json, os, sys
+args = sys.argv[1:]
+with open(os.path.join(os.path.dirname(__file__), "argv.json"), "w") as f:
+    json.dump(args, f)
+output = args[args.index("--output") + 1]
+with open(args[args.index("--batch-file") + 1]) as f:
+    urls = f.read().split()
+for url in urls:
+    video_id = url.split("v=")[1]
+    if video_id.startswith("bad"):
+        print(f"ERROR: [youtube] {{video_id}}: Video unavailable", file=sys.stderr)
+        continue
+    path = output.replace("%(id)s", video_id).replace("%(ext)s", "webm")
+    open(path, "w").close()
+    print("ignored, not json")
+    print(json.dumps({{"id": video_id, "filepath": path}}))
+"""
+
+
+def track(i: int) -> Track:
+    return Track(f"t{i}", f"song {i}", "artist", "Artist", "album", "Album", "img", "2020")
+
+
+class TestFetchMany(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+        self.bin = os.path.join(self.directory, "bin")
+        os.makedirs(self.bin)
+        yt_dlp_cmd = os.path.join(self.bin, "yt-dlp")
+        with open(yt_dlp_cmd, "w") as f:
+            f.write(FAKE_YTDLP)
+        os.chmod(yt_dlp_cmd, 0o755)
+        patcher = mock.patch("musicdl.yt.install_ytdlpcli", return_value=yt_dlp_cmd)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.yt = SPTrackDownloader(audio_format="flac", ytdlp_version="cli", audio_directory=self.directory, batch_size=4, reuse_audio="none")
+        self.addCleanup(self.yt.transcoder.close)
+
+    def argv(self) -> list[str]:
+        with open(os.path.join(self.bin, "argv.json")) as f:
+            return json.load(f)
+
+    def test_results_and_failures(self):
+        requests = [(track(0), "aaaaaaaaaa0"), (track(1), "badaaaaaaa1"), (track(2), "aaaaaaaaaa2"), (track(3), "aaaaaaaaaa0")]
+        results = self.yt._fetch_many(requests)
+
+        staging = os.path.join(self.directory, ".staging")
+        audio_path, staged_path = results[0]
+        self.assertEqual(staged_path, os.path.join(staging, "aaaaaaaaaa0.webm"))
+        self.assertTrue(audio_path.endswith("Artist_song0_aaaaaaaaaa0.flac"))
+        self.assertEqual(results[2][1], os.path.join(staging, "aaaaaaaaaa2.webm"))
+        # a failed download gets yt-dlp's error line
+        self.assertIsInstance(results[1], yt_dlp.utils.DownloadError)
+        self.assertIn("badaaaaaaa1: Video unavailable", str(results[1]))
+        # the same video for another track waits for the first one (`_fetch`)
+        self.assertIsNone(results[3])
+
+        self.assertEqual(sorted(self.yt._converting), ["aaaaaaaaaa0", "aaaaaaaaaa2"])
+        self.assertEqual(self.yt.stats["downloaded"], 2)
+        # yt-dlp paces the batch itself
+        argv = self.argv()
+        self.assertGreater(float(argv[argv.index("--sleep-interval") + 1]), 0)
+        # the batch file is removed
+        self.assertEqual(sorted(os.listdir(staging)), ["aaaaaaaaaa0.webm", "aaaaaaaaaa2.webm"])
+
+    def test_failed_run(self):
+        # yt-dlp doesn't print anything: every track fails with the same error
+        with open(os.path.join(self.bin, "yt-dlp"), "w") as f:
+            f.write(f"#!{sys.executable}\nimport sys\nprint('ERROR: unable to start', file=sys.stderr)\n")
+        results = self.yt._fetch_many([(track(0), "aaaaaaaaaa0"), (track(1), "aaaaaaaaaa1")])
+        for result in results:
+            self.assertIsInstance(result, yt_dlp.utils.DownloadError)
+            self.assertIn("unable to start", str(result))
+        self.assertEqual(self.yt._converting, {})
+
+
+class BlockingTranscoder:
+    """
+    writes every output once `release` is set
+    """
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def run(self, source, outputs):
+        self.started.set()
+        self.release.wait(timeout=5)
+        for output in outputs:
+            with open(output, "w") as f:
+                f.write(source)
+        return outputs
+
+
+class TestReuseAudio(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+        self.fetched = []
+        patcher = mock.patch("musicdl.yt.youtube_limiter", RateLimiter(rate=1000, burst=100))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch(self, url, staging_dir, format=None):
+        self.fetched.append(url)
+        os.makedirs(staging_dir, exist_ok=True)
+        path = os.path.join(staging_dir, url.split("v=")[1] + ".webm")
+        open(path, "w").close()
+        return path
+
+    def downloader(self, reuse_audio: str, audio_format: str = "flac") -> SPTrackDownloader:
+        self.transcoder = BlockingTranscoder()
+        yt = SPTrackDownloader(audio_format=audio_format, ytdlp_version="cli", audio_directory=self.directory,
+                               reuse_audio=reuse_audio, transcoder=self.transcoder)
+        yt.fetch = self.fetch
+        return yt
+
+    def download_twice(self, yt: SPTrackDownloader) -> tuple[str, str]:
+        """
+        two tracks of the same video: the second one waits for the first one's transcode
+        """
+        results = {}
+        first = threading.Thread(target=lambda: results.__setitem__(0, yt._download(track(0), "aaaaaaaaaaa")))
+        first.start()
+        self.assertTrue(self.transcoder.started.wait(timeout=5))
+        second = threading.Thread(target=lambda: results.__setitem__(1, yt._download(track(1), "aaaaaaaaaaa")))
+        second.start()
+        second.join(timeout=0.2)
+        self.assertTrue(second.is_alive())
+        self.transcoder.release.set()
+        first.join(timeout=5)
+        second.join(timeout=5)
+        self.assertEqual(len(self.fetched), 1)
+        self.assertEqual((yt.stats["downloaded"], yt.stats["reused"]), (1, 1))
+        self.assertEqual(yt._converting, {})
+        return results[0], results[1]
+
+    def test_share(self):
+        first, second = self.download_twice(self.downloader("share"))
+        self.assertTrue(first.endswith("Artist_song0_aaaaaaaaaaa.flac"))
+        self.assertEqual(second, first)
+
+    def test_hardlink(self):
+        first, second = self.download_twice(self.downloader("hardlink"))
+        self.assertTrue(second.endswith("Artist_song1_aaaaaaaaaaa.flac"))
+        self.assertTrue(os.path.samefile(first, second))
+
+    def test_copy(self):
+        first, second = self.download_twice(self.downloader("copy"))
+        self.assertFalse(os.path.samefile(first, second))
+        with open(first) as f, open(second) as g:
+            self.assertEqual(f.read(), g.read())
+
+    def test_native(self):
+        # the second track gets the extension of the downloaded stream too
+        for reuse_audio in ("share", "hardlink", "copy"):
+            with self.subTest(reuse_audio=reuse_audio):
+                self.fetched.clear()
+                first, second = self.download_twice(self.downloader(reuse_audio, audio_format="native"))
+                self.assertTrue(first.endswith("Artist_song0_aaaaaaaaaaa.webm"))
+                if reuse_audio == "share":
+                    self.assertEqual(second, first)
+                else:
+                    self.assertTrue(second.endswith("Artist_song1_aaaaaaaaaaa.webm"))
+                    self.assertTrue(os.path.exists(second))
+                    self.assertEqual(os.path.samefile(first, second), reuse_audio == "hardlink")
+                for path in {first, second}:
+                    os.remove(path)
+
+    def test_none(self):
+        yt = self.downloader("none")
+        self.transcoder.release.set()
+        yt._download(track(0), "aaaaaaaaaaa")
+        yt._download(track(1), "aaaaaaaaaaa")
+        self.assertEqual(len(self.fetched), 2)
+        self.assertEqual((yt.stats["downloaded"], yt.stats["reused"]), (2, 0))
+
+
+class TestYtdlpSession(unittest.TestCase):
+    def setUp(self):
+        self.session = YtdlpSession()
+        self.addCleanup(self.session.close)
+        self.calls = []
+        self.session.ydl.extract_info = self.extract_info
+
+    def extract_info(self, url, download=True):
+        # what the download would have used
+        ydl = self.session.ydl
+        self.calls.append((ydl.params["outtmpl"]["default"], ydl.format_selector))
+        video_id = url.split("v=")[1]
+        return {"id": video_id, "requested_downloads": [{"filepath": ydl.params["outtmpl"]["default"].replace("%(id)s", video_id)}]}
+
+    def test_template_and_format_switching(self):
+        url = "https://www.youtube.com/watch?v=aaaaaaaaaaa"
+        staged_path, info = self.session.extract(url, "/staging/1", format_selector("flac"))
+        self.assertEqual(staged_path, os.path.join("/staging/1", "aaaaaaaaaaa.%(ext)s"))
+        self.assertEqual(info["id"], "aaaaaaaaaaa")
+        self.session.fetch(url, "/staging/2", "bestaudio[ext=m4a]")
+        self.session.fetch(url, "/staging/1", format_selector("flac"))
+
+        self.assertEqual([outtmpl for outtmpl, _ in self.calls], [os.path.join(f"/staging/{i}", "%(id)s.%(ext)s") for i in (1, 2, 1)])
+        flac, m4a, flac_again = [selector for _, selector in self.calls]
+        self.assertIsNot(flac, m4a)
+        # selectors are only compiled once per format
+        self.assertIs(flac, flac_again)
+        self.assertEqual(self.session.stats["downloads"], 3)
+
+    def test_without_reusable_internals(self):
+        # a yt-dlp release without them gets a new YoutubeDL per download
+        self.session.reusable = False
+        with mock.patch("yt_dlp.YoutubeDL") as YoutubeDL:
+            ydl = YoutubeDL.return_value.__enter__.return_value
+            ydl.extract_info.return_value = {"requested_downloads": [{"filepath": "/staging/aaaaaaaaaaa.webm"}]}
+            staged_path = self.session.fetch("https://www.youtube.com/watch?v=aaaaaaaaaaa", "/staging", "bestaudio")
+        self.assertEqual(staged_path, "/staging/aaaaaaaaaaa.webm")
+        params = YoutubeDL.call_args[0][0]
+        self.assertEqual((params["format"], params["outtmpl"]), ("bestaudio", os.path.join("/staging", "%(id)s.%(ext)s")))
+        self.assertTrue(params["quiet"])
+        self.assertEqual(self.calls, [])
+
+
+class TestYtdlpSessionPool(unittest.TestCase):
+    def test_reuse(self):
+        pool = YtdlpSessionPool(max_sessions=2)
+        self.addCleanup(pool.close)
+        with mock.patch.object(YtdlpSession, "extract", return_value=("/staging/a.webm", {})):
+            # one at a time: the same session every time
+            for _ in range(3):
+                pool.fetch("https://www.youtube.com/watch?v=aaaaaaaaaaa", "/staging")
+            self.assertEqual(len(pool.sessions), 1)
+
+            # two at a time: a second session, then the third thread waits for one of them
+            with pool.session() as first, pool.session() as second:
+                self.assertIsNot(first, second)
+                waited = threading.Event()
+                def fetch():
+                    pool.fetch("https://www.youtube.com/watch?v=aaaaaaaaaaa", "/staging")
+                    waited.set()
+                thread = threading.Thread(target=fetch)
+                thread.start()
+                self.assertFalse(waited.wait(timeout=0.2))
+            thread.join(timeout=5)
+            self.assertTrue(waited.is_set())
+            self.assertEqual(len(pool.sessions), 2)
+
+
+class TestTrackInfo(unittest.TestCase):
+    # trimmed down from what yt-dlp extracts for a video
+    INFO = {
+        "id": "dQw4w9WgXcQ",
+        "title": "Rick Astley - Never Gonna Give You Up (Official Music Video)",
+        "uploader": "Rick Astley",
+        "channel": "Rick Astley Official",
+        "channel_id": "UCuAXFkgsw1L7xaCfnd5JJOw",
+        "thumbnail": "https://i.ytimg.com/vi/dQw4w9WgXcQ/maxresdefault.jpg",
+        "duration": 213,
+        "upload_date": "20091025",
+        "format_id": "251",
+        "abr": 129.5,
+        "acodec": "opus",
+        "formats": [{"format_id": "251"}],
+    }
+
+    def test_mapping(self):
+        url = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+        track_info = track_info_from(url, self.INFO, "./audio/song.flac")
+        self.assertEqual(track_info, {
+            "youtube_url": url,
+            "title": "Rick Astley - Never Gonna Give You Up (Official Music Video)",
+            "artist": "Rick Astley",
+            "artwork_url": "https://i.ytimg.com/vi/dQw4w9WgXcQ/maxresdefault.jpg",
+            "audio_path": "./audio/song.flac",
+            "duration_s": 213,
+            "channel_id": "UCuAXFkgsw1L7xaCfnd5JJOw",
+            "upload_date": "20091025",
+            "format_id": "251",
+            "abr": 129.5,
+            "acodec": "opus",
+        })
+
+    def test_cli_fields(self):
+        # the cli only prints INFO_FIELDS (see `ytdlpcli_extract`), which is all track_info_from needs
+        info = {field: self.INFO[field] for field in INFO_FIELDS}
+        self.assertEqual(track_info_from("u", info), track_info_from("u", self.INFO))
+
+    def test_missing_fields(self):
+        # no uploader: the channel name, anything else missing is None
+        track_info = track_info_from("u", {"title": "t", "channel": "c"})
+        self.assertEqual(track_info["artist"], "c")
+        self.assertIsNone(track_info["duration_s"])
+        self.assertIsNone(track_info["artwork_url"])
+        self.assertEqual(track_info["audio_path"], "")
+
+
+class TestYoutubeDownloader(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+        self.transcoder = BlockingTranscoder()
+        self.transcoder.release.set()
+        # `transcode` creates it for the outputs
+        os.makedirs(os.path.join(self.directory, "audio"))
+
+    def fake_download(self, extract, url, staging_directory):
+        staged_path = os.path.join(staging_directory, url.split("v=")[1] + ".webm")
+        open(staged_path, "w").close()
+        return staged_path, TestTrackInfo.INFO
+
+    def test_audio_formats(self):
+        ydl = YoutubeDownloader(audio_directory=self.directory, audio_format=["flac", "mp3"], use_ytdlp_cli=True,
+                                transcoder=self.transcoder)
+        with mock.patch("musicdl.yt.throttled_download", self.fake_download):
+            tracks_info = ydl.download(["https://www.youtube.com/watch?v=dQw4w9WgXcQ"])
+        root = os.path.join(self.directory, "audio", "RickAstleyNeverGonnaGiveYouUpOfficialMusicVideo_RickAstley")
+        self.assertTrue(os.path.exists(root + ".flac"))
+        self.assertTrue(os.path.exists(root + ".mp3"))
+        # the first format is the one recorded
+        self.assertTrue(tracks_info[0]["audio_path"].endswith("RickAstley.flac"))
+        self.assertEqual(os.listdir(ydl.staging_directory), [])
+
+
+if __name__ == "__main__":
+    unittest.main()